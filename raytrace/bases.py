@@ -475,3 +475,22 @@ class Result(HasTraits, RaytraceObject):
         @param tracer: the RayTraceModel instance
         """
         raise NotImplementedError
+    
+    def prepare_to_trace(self, tracer):
+        """
+        Called at the start of a tracing operation, before any source is 
+        traced, so state kept from the previous trace can be dropped
+        
+        @param tracer: the RayTraceModel instance
+        """
+        pass
+    
+    def get_sink(self, source):
+        """
+        Called before each source is traced. A result which can be 
+        accumulated while the rays are traced returns a RaySink to receive
+        them, which it can use in calc_result. Otherwise, returns None.
+        
+        @param source: the ray source about to be traced
+        """
+        return None
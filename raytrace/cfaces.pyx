@@ -11,7 +11,7 @@ Cython module for Face definitions
 #maybe this is a cython .15 thing?
 #from libc.math import INFINITY, M_PI, sqrt, pow, fabs, cos, sin, acos, atan2
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double M_PI
     double sqrt(double)
     double atan2 (double y, double x )
@@ -24,16 +24,21 @@ cdef extern from "math.h":
 cdef extern from "float.h":
     double DBL_MAX
 
-cdef INF=(DBL_MAX+DBL_MAX)
+cdef double INF=(DBL_MAX+DBL_MAX)
+
+from libc.stdlib cimport malloc, free
 
 from ctracer cimport Face, sep_, \
         vector_t, ray_t, FaceList, subvv_, dotprod_, mag_sq_, norm_,\
             addvv_, multvs_, mag_, transform_t, Transform, transform_c,\
-                rotate_c
+                rotate_c, aabb_t, ray_soa_t, hit_t, transform_stamp_, vtk_transforms_,\
+                    set_v, FACE_DISC, FACE_RECT
 
 import numpy as np
 cimport numpy as np_
 
+from raytrace.ctracer import _bvh_partition
+
 cdef struct flatvector_t:
     double x,y
 
@@ -44,9 +49,10 @@ cdef class CircularFace(Face):
     params = ['diameter', 'offset']
     
     def __cinit__(self, **kwds):
+        self.planar = 1
         self.z_plane = kwds.get('z_plane', 0.0)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -73,8 +79,39 @@ cdef class CircularFace(Face):
             #print "X", X, "Y", Y
             return 0
         return h * max_length
+    
+    cdef void intersect_batch_c(self, ray_soa_t segs, double *dist) nogil:
+        cdef:
+            size_t i
+            double h, X, Y
+            double z=self.z_plane, offset=self.offset, tol=self.tolerance
+            double r2=self.diameter*self.diameter/4
+        
+        for i in range(segs.n):
+            h = (z-segs.oz[i])/segs.dz[i]
+            X = segs.ox[i] + h*segs.dx[i] - offset
+            Y = segs.oy[i] + h*segs.dy[i]
+            if (h<tol) or (h>1.0) or ((X*X + Y*Y) > r2):
+                dist[i] = 0
+            else:
+                dist[i] = h*sqrt(segs.dx[i]*segs.dx[i] + segs.dy[i]*segs.dy[i] +
+                                 segs.dz[i]*segs.dz[i])
+    
+    cdef int face_params_c(self, double *params):
+        params[0] = self.z_plane
+        params[1] = self.offset
+        params[2] = self.diameter*self.diameter/4
+        return FACE_DISC
+    
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        cdef double r = fabs(self.diameter)/2
+        b.lower.x, b.upper.x = self.offset - r, self.offset + r
+        b.lower.y, b.upper.y = -r, r
+        b.lower.z = b.upper.z = self.z_plane
+        return b
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -91,10 +128,11 @@ cdef class ElipticalPlaneFace(Face):
     params = ['diameter']
     
     def __cinit__(self, **kwds):
+        self.planar = 1
         self.g_x = kwds.get('g_x', 0.0)
         self.g_y = kwds.get('g_y', 0.0)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         cdef:
             double max_length = sep_(p1, p2)
             double h = (self.g_x*p1.x + self.g_y*p1.y - p1.z) / \
@@ -112,7 +150,16 @@ cdef class ElipticalPlaneFace(Face):
             return 0
         return h * max_length
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        cdef double r = fabs(self.diameter)/2
+        cdef double dz = (fabs(self.g_x) + fabs(self.g_y))*r
+        b.lower.x = b.lower.y = -r
+        b.upper.x = b.upper.y = r
+        b.lower.z, b.upper.z = -dz, dz
+        return b
+    
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -129,9 +176,10 @@ cdef class RectangularFace(Face):
     params = ['length', 'width', 'offset']
     
     def __cinit__(self, **kwds):
+        self.planar = 1
         self.z_plane = kwds.get('z_plane', 0.0)
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -163,8 +211,40 @@ cdef class RectangularFace(Face):
         if Y*Y > wdth*wdth/4:
             return 0 
         return h * max_length
+    
+    cdef void intersect_batch_c(self, ray_soa_t segs, double *dist) nogil:
+        cdef:
+            size_t i
+            double h, X, Y
+            double z=self.z_plane, offset=self.offset, tol=self.tolerance
+            double l2=self.length*self.length/4, w2=self.width*self.width/4
+        
+        for i in range(segs.n):
+            h = (z-segs.oz[i])/segs.dz[i]
+            X = segs.ox[i] + h*segs.dx[i] - offset
+            Y = segs.oy[i] + h*segs.dy[i]
+            if (h<tol) or (h>1.0) or (X*X > l2) or (Y*Y > w2):
+                dist[i] = 0
+            else:
+                dist[i] = h*sqrt(segs.dx[i]*segs.dx[i] + segs.dy[i]*segs.dy[i] +
+                                 segs.dz[i]*segs.dz[i])
+    
+    cdef int face_params_c(self, double *params):
+        params[0] = self.z_plane
+        params[1] = self.offset
+        params[2] = self.length*self.length/4
+        params[3] = self.width*self.width/4
+        return FACE_RECT
+    
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        cdef double l = fabs(self.length)/2, w = fabs(self.width)/2
+        b.lower.x, b.upper.x = self.offset - l, self.offset + l
+        b.lower.y, b.upper.y = -w, w
+        b.lower.z = b.upper.z = self.z_plane
+        return b
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -184,7 +264,7 @@ cdef class SphericalFace(Face):
     def __cinit__(self, **kwds):
         self.z_height = kwds.get('z_height', 0.0)
     
-    cdef double intersect_c(self, vector_t r, vector_t p2):
+    cdef double intersect_c(self, vector_t r, vector_t p2, hit_t *hit) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -248,7 +328,53 @@ cdef class SphericalFace(Face):
             return 0
         return a1 * sep_(r, p2)
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef void intersect_batch_c(self, ray_soa_t segs, double *dist) nogil:
+        cdef:
+            size_t i
+            double A, B, C, D, a1, a2, z1, z2, r1, r2, x, y, z
+            double c=self.curvature, cz=self.z_height - self.curvature
+            double rad2=self.diameter*self.diameter/4., tol=self.tolerance
+            double sgn = 1.0 if c >= 0 else -1.0
+        
+        for i in range(segs.n):
+            x, y, z = segs.ox[i], segs.oy[i], segs.oz[i] - cz
+            A = segs.dx[i]*segs.dx[i] + segs.dy[i]*segs.dy[i] + segs.dz[i]*segs.dz[i]
+            B = 2*(segs.dx[i]*x + segs.dy[i]*y + segs.dz[i]*z)
+            C = x*x + y*y + z*z - c*c
+            D = B*B - 4*A*C
+            if D < 0:
+                dist[i] = 0
+                continue
+            D = sqrt(D)
+            a1 = (-B+D)/(2*A)
+            a2 = (-B-D)/(2*A)
+            #heights of the two intersections above the sphere centre, and
+            #their radial distances from the axis
+            z1 = z + a1*segs.dz[i]
+            z2 = z + a2*segs.dz[i]
+            r1 = (x + a1*segs.dx[i])**2 + (y + a1*segs.dy[i])**2
+            r2 = (x + a2*segs.dx[i])**2 + (y + a2*segs.dy[i])**2
+            if sgn*z1 < 0 or r1 > rad2:
+                a1 = INF
+            if sgn*z2 < 0 or r2 > rad2:
+                a2 = INF
+            if a2 < a1:
+                a1 = a2
+            if a1>1.0 or a1<tol:
+                dist[i] = 0
+            else:
+                dist[i] = a1*sqrt(A)
+    
+    cdef aabb_t bounds_c(self):
+        """The cap lies between its vertex and the sphere centre"""
+        cdef aabb_t b
+        cdef double r = fabs(self.diameter)/2, cz = self.z_height - self.curvature
+        b.lower.x = b.lower.y = -r
+        b.upper.x = b.upper.y = r
+        b.lower.z, b.upper.z = min(cz, self.z_height), max(cz, self.z_height)
+        return b
+    
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -268,6 +394,7 @@ cdef class ExtrudedPlanarFace(Face):
         vector_t normal
         
     def __cinit__(self, **kwds):
+        self.planar = 1
         self.x1 = kwds.get('x1',0)
         self.y1 = kwds.get('y1',0)
         self.x2 = kwds.get('x2',0)
@@ -315,16 +442,16 @@ cdef class ExtrudedPlanarFace(Face):
         n.z = 0
         self.normal = norm_(n)
         
-    cdef double intersect_c(self, vector_t r, vector_t p2):
+    cdef double intersect_c(self, vector_t r, vector_t p2, hit_t *hit) nogil:
         cdef: 
             vector_t s, u, v
             double a, dz
             
-        u.x = self.x1
-        u.y = self.y1
+        u.x = self.x1_
+        u.y = self.y1_
         
-        v.x = self.x2 - u.x
-        v.y = self.y2 - u.y
+        v.x = self.x2_ - u.x
+        v.y = self.y2_ - u.y
         
         s = subvv_(p2, r)
         
@@ -346,8 +473,15 @@ cdef class ExtrudedPlanarFace(Face):
             return a * mag_(s)
         else:
             return 0
+        
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        b.lower.x, b.upper.x = min(self.x1_, self.x2_), max(self.x1_, self.x2_)
+        b.lower.y, b.upper.y = min(self.y1_, self.y2_), max(self.y1_, self.y2_)
+        b.lower.z, b.upper.z = self.z1, self.z2
+        return b
     
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         return self.normal
 
 #
@@ -356,11 +490,11 @@ cdef class ExtrudedPlanarFace(Face):
 
 
     
-cdef double eval_bezier(double t, double cp0, double cp1, double cp2, double cp3):
+cdef double eval_bezier(double t, double cp0, double cp1, double cp2, double cp3) nogil:
     #just evaluate a cubic bezier spline
     return cp0*((1-t)**3) + 3*cp1*t*((1-t)**2) + 3*cp2*(1-t)*(t**2) + cp3*(t**3)
 
-cdef double dif_bezier(double t, double cp0, double cp1, double cp2, double cp3):
+cdef double dif_bezier(double t, double cp0, double cp1, double cp2, double cp3) nogil:
     #calc the derivative of a cubic bezier when parameter = t
     cdef long double A, B, C     #just doin this old school polynomial style
     A = cp3-3*cp2+3*cp1-cp0
@@ -374,7 +508,7 @@ cdef struct poly_roots:
     double roots[3] 
     int n
     
-cdef poly_roots roots_of_cubic(double a, double b, double c, double d):
+cdef poly_roots roots_of_cubic(double a, double b, double c, double d) nogil:
     #this code is known not to work in the case of (x-c)^3 (triple zero)
     # **TODO ** fix this
     # TODO: cubic solution explodes with small a, co quadratic is used.
@@ -386,6 +520,7 @@ cdef poly_roots roots_of_cubic(double a, double b, double c, double d):
         long double R2_Q3 = R*R - Q*Q*Q
         long double theta
         poly_roots x
+    x.roots[0] = x.roots[1] = x.roots[2] = 0
     if fabs(a) <= 0.0000000001:
         #^this, precision is less than ideal here
         if fabs(b) <= 0.0000000001:
@@ -421,32 +556,113 @@ cdef poly_roots roots_of_cubic(double a, double b, double c, double d):
         else:
             x.n = 1
             a2 = pow(sqrt(R2_Q3)+fabs(R), 1/3.0)
-            a2 += Q/x.roots[0]
+            if a2 != 0:
+                a2 += Q/a2
             a2 *= (1 if (R < 0.0) else -1)
             a2 -= a1/3.0
             x.roots[0] = a2 
             #print "single: ",x.roots[0]
     return x
 
-cdef flatvector_t rotate2D(double phi, flatvector_t p):
+cdef flatvector_t rotate2D(double phi, flatvector_t p) nogil:
     cdef flatvector_t result
     result.x = p.x*cos(phi) - p.y*sin(phi)
     result.y = p.x*sin(phi) + p.y*cos(phi)     
     return result
 
+cdef inline double seg_box_entry_(flatvector_t lower, flatvector_t upper,
+                                 flatvector_t origin, flatvector_t d) nogil:
+    #fraction along the 2D segment origin to origin+d at which it enters 
+    #the box, or -1 if it misses
+    cdef double t0=0.0, t1=1.0, ta, tb
+    if d.x == 0:
+        if origin.x < lower.x or origin.x > upper.x:
+            return -1
+    else:
+        ta = (lower.x - origin.x)/d.x
+        tb = (upper.x - origin.x)/d.x
+        if ta > tb:
+            ta, tb = tb, ta
+        t0 = max(t0, ta)
+        t1 = min(t1, tb)
+    if d.y == 0:
+        if origin.y < lower.y or origin.y > upper.y:
+            return -1
+    else:
+        ta = (lower.y - origin.y)/d.y
+        tb = (upper.y - origin.y)/d.y
+        if ta > tb:
+            ta, tb = tb, ta
+        t0 = max(t0, ta)
+        t1 = min(t1, tb)
+    if t0 > t1:
+        return -1
+    return t0
+
+
+cdef inline flatvector_t to_ray_frame_(flatvector_t p, flatvector_t origin,
+                                       double cos_t, double sin_t) nogil:
+    #translates p to origin, then rotates it by -theta
+    cdef flatvector_t result
+    p.x -= origin.x
+    p.y -= origin.y
+    result.x = p.x*cos_t + p.y*sin_t
+    result.y = p.y*cos_t - p.x*sin_t
+    return result
+
+cdef enum:
+    SEG_STACK_SIZE = 64
+
+
+cdef struct seg_node_t:
+    #a node of the 2D tree over the x-y boxes of the segments of an 
+    #extruded face
+    flatvector_t lower, upper
+    int left, right #child node indices, or -1 for a leaf
+    int start, stop #range of segments under the node
+    
+    
+cdef seg_node_t *seg_tree_(list nodes) except NULL:
+    #copies the nodes made by _bvh_partition into a C array
+    cdef:
+        seg_node_t *tree
+        seg_node_t *node
+        int i
+    tree = <seg_node_t*>malloc(max(len(nodes),1)*sizeof(seg_node_t))
+    if tree is NULL:
+        raise MemoryError()
+    for i, (lo, hi, left, right, start, stop) in enumerate(nodes):
+        node = tree + i
+        node.lower.x, node.lower.y = lo
+        node.upper.x, node.upper.y = hi
+        node.left = left
+        node.right = right
+        node.start = start
+        node.stop = stop
+    return tree
+
+
+cdef struct bezier_seg_t:
+    flatvector_t cp[4] #control points of one cubic segment
+    flatvector_t lower, upper #x-y bounding box of the control points
+
+
 cdef class ExtrudedBezierFace(Face):
 
     cdef:
         double z_height_1, z_height_2
         flatvector_t mincorner, maxcorner         #corners of x-y box that bounds entire spline
         np_.ndarray curves_array        
+        bezier_seg_t *segs #C copy of curves_array, in tree order
+        seg_node_t *nodes #2D bounding-interval tree over segs
+        readonly int n_segs, n_nodes
 
-    cdef int ccw(self, flatvector_t  A, flatvector_t  B, flatvector_t  C):
+    cdef int ccw(self, flatvector_t  A, flatvector_t  B, flatvector_t  C) nogil:
         #used by an ingenious line segment intersect algorithim I found.
         #determines counter clockwiseness of points
         return (C.y-A.y)*(B.x-A.x) > (B.y-A.y)*(C.x-A.x)
 
-    cdef int line_seg_overlap(self, flatvector_t A, flatvector_t B, flatvector_t C, flatvector_t D):
+    cdef int line_seg_overlap(self, flatvector_t A, flatvector_t B, flatvector_t C, flatvector_t D) nogil:
         #check if two line segments overlap eachother.  Used for rough tests of
         #intersection before committing to much computation to the potential intersection.
         # A and B are the begin and end of one line; C,D the other. 
@@ -454,7 +670,7 @@ cdef class ExtrudedBezierFace(Face):
         #AB crosses CD if ABCD are all cw or ccw.
         return self.ccw(A,C,D) != self.ccw(B,C,D) and self.ccw(A,B,C) != self.ccw(A,B,D)
         
-    cdef int pnt_in_hull(self,flatvector_t p, flatvector_t A, flatvector_t B, flatvector_t C, flatvector_t D):
+    cdef int pnt_in_hull(self,flatvector_t p, flatvector_t A, flatvector_t B, flatvector_t C, flatvector_t D) nogil:
         #instead of convex hull, just use xy bounding box, which is quicker to construct
 
         cdef int i,j,k
@@ -487,152 +703,208 @@ cdef class ExtrudedBezierFace(Face):
         return i and k
 
     def __cinit__(self,np_.ndarray[np_.float64_t ,ndim=3] beziercurves,double z_height_1=0,double z_height_2=0, **kwds):
-        cdef flatvector_t temp1, temp2
+        cdef: 
+            int i, j
+            bezier_seg_t *seg
+            
         self.curves_array = beziercurves
         self.z_height_1 = z_height_1
         self.z_height_2 = z_height_2
-        temp1.x = beziercurves[0,0,0]
-        temp1.y = beziercurves[0,0,1]
-        temp2.x = beziercurves[0,0,0]
-        temp2.y = beziercurves[0,0,1]
-
-        for bezierpts in beziercurves:
-            for pair in bezierpts:
-                if pair[0] < temp1.x: temp1.x=pair[0]
-                if pair[0] > temp2.x: temp2.x=pair[0]
-                if pair[1] < temp1.y: temp1.y=pair[1]
-                if pair[1] > temp2.y: temp2.y=pair[1]
-
-        self.mincorner = temp1
-        self.maxcorner = temp2
-
-    cdef double intersect_c(self, vector_t ar, vector_t pee2):
+        
+        lower = beziercurves.min(axis=1)
+        upper = beziercurves.max(axis=1)
+        nodes, order = _bvh_partition(lower, upper)
+        
+        self.n_segs = beziercurves.shape[0]
+        self.segs = <bezier_seg_t*>malloc(max(self.n_segs,1)*sizeof(bezier_seg_t))
+        if self.segs is NULL:
+            raise MemoryError()
+        self.n_nodes = len(nodes)
+        self.nodes = seg_tree_(nodes)
+        for i, k in enumerate(order):
+            seg = self.segs + i
+            for j in range(4):
+                seg.cp[j].x = beziercurves[k,j,0]
+                seg.cp[j].y = beziercurves[k,j,1]
+            seg.lower.x, seg.lower.y = lower[k]
+            seg.upper.x, seg.upper.y = upper[k]
+        if self.n_nodes:
+            self.mincorner = self.nodes[0].lower
+            self.maxcorner = self.nodes[0].upper
+        else:
+            #no segments: a degenerate box on the z axis, which intersect_c
+            #always misses
+            self.mincorner.x = self.mincorner.y = 0
+            self.maxcorner.x = self.maxcorner.y = 0
+                
+    def __dealloc__(self):
+        free(self.segs)
+        free(self.nodes)
 
+    cdef double intersect_seg_c(self, bezier_seg_t *seg, flatvector_t r, 
+                                double cos_t, double sin_t, flatvector_t s,
+                                double dZ, double z0, double *t_hit) nogil:
+        """Intersects the ray with one spline segment. The ray starts at r 
+        and runs to s, once rotated onto the x axis by cos_t and sin_t. 
+        Returns the 3D distance to the nearest valid intersection, or INF,
+        and sets t_hit to the curve parameter there.
+        """
         cdef: 
-            flatvector_t tempvector
-            flatvector_t r, p2, s, origin
+            flatvector_t origin
             flatvector_t cp0,cp1,cp2,cp3  #holds control points for spline segment under scrutiny
+            double result = INF
+            double A,B,C,D,t,a,b,c
+            poly_roots ts
+            
+        origin.x = 0 
+        origin.y = 0
+        #translate to the ray origin and rotate ctrl points such that 
+        #ray is along the x axis
+        cp0 = to_ray_frame_(seg.cp[0], r, cos_t, sin_t)
+        cp1 = to_ray_frame_(seg.cp[1], r, cos_t, sin_t)
+        cp2 = to_ray_frame_(seg.cp[2], r, cos_t, sin_t)
+        cp3 = to_ray_frame_(seg.cp[3], r, cos_t, sin_t)
+        #test for intersection between ray (actually segment) and convex hull
+        if self.line_seg_overlap(origin,s,cp0,cp1) or self.line_seg_overlap(origin,s,cp1,cp2) or self.line_seg_overlap(origin,s,cp2,cp3) or self.line_seg_overlap(origin,s,cp3,cp0):
+            #Ray does intersect this convex hull.  Find solution:
+            #Setup A,B,C and D (bernstein polynomials)
+            A = cp3.y-3*cp2.y+3*cp1.y-cp0.y
+            B = 3*cp2.y-6*cp1.y+3*cp0.y
+            C = 3*cp1.y-3*cp0.y
+            D = cp0.y
+            #solve for t
+            ts = roots_of_cubic(A,B,C,D)
+            while ts.n > 0:
+                ts.n-=1
+                t = ts.roots[ts.n]
+                #make sure solution is on valid interval
+                if 0.<t<1.:
+                    #the x value will also be the length, which is the form of result
+                    b = eval_bezier(t,cp0.x,cp1.x,cp2.x,cp3.x)
+                    #is x within bounds?
+                    if 0 < b < s.x:
+                        #is point within Z bounds?
+                        c = dZ*b/s.x   
+                        a = c+z0
+                        if self.z_height_1 < a < self.z_height_2:
+                            #is this the shortest length to an intersection so far?
+                            b = sqrt(c**2+b**2)
+                            if b < result and b > self.tolerance:
+                                result = b
+                                t_hit[0] = t
+        return result
+    
+    cdef double intersect_c(self, vector_t ar, vector_t pee2, hit_t *hit) nogil:
+        """Intersects the ray with the spline segments whose boxes it 
+        crosses, found by traversing the segment tree. The segment index 
+        and curve parameter of the intersection are kept in hit.param.x 
+        and hit.param.y, for compute_normal_hit_c.
+        """
+        cdef: 
+            flatvector_t r, s, d
             double result = INF            #length of ray before it intersects surface. 0 if no valid intersection
             double dZ                       #rate of change of z. dZ*result+Z0 gives Z coordinate
-            double A,B,C,D,t,a,b,c,d
-            poly_roots ts
+            double cos_t, sin_t, s_len, length, t_entry, dist, t, t_best=0
+            int i, top, i_best=0
+            int stack[SEG_STACK_SIZE]
+            seg_node_t *node
             vector_t    tempv
-        #print "\ncalled intersection"
 
-        origin.x = 0 
-        origin.y = 0
         #first off, does ray even enter the depth of the extrusion?
         if (ar.z < self.z_height_1 and pee2.z <self.z_height_1) or (ar.z > self.z_height_2 and pee2.z > self.z_height_2):
             return 0    #does not
-        #print "ray passes z test"
+        if self.n_nodes == 0:
+            return 0
         #strip useless thrid dimension from ray vector
-        r.x = ar.x
-        r.y = ar.y
-        p2.x = pee2.x
-        p2.y = pee2.y
-
-
-        #check if ray intersects x-y bounding box of spline at all
-        tempvector.x = self.mincorner.x
-        tempvector.y = self.maxcorner.y
-        if not self.line_seg_overlap(r,p2,self.mincorner,tempvector):
-            if not  self.line_seg_overlap(r,p2,tempvector,self.maxcorner):
-                tempvector.x = self.maxcorner.x
-                tempvector.y = self.mincorner.y
-                if not self.line_seg_overlap(r,p2,self.maxcorner,tempvector):
-                    if not self.line_seg_overlap(r,p2,tempvector,self.mincorner):
-                        return 0    #no intersections
-        #print "ray is in big bounding box"
-        #segment intersects with gross bounding box,
-        #Calc dZ and the 2D origin adjusted ray, because they will probably be used.
         tempv = subvv_ (pee2,ar) 
         dZ = tempv.z
-        s.x=tempv.x
-        s.y=tempv.y
-        theta = atan2(s.y,s.x)
-                
-        s = rotate2D(-theta,s)
-        # now, loop through curves and see if segment 1) intersects with individual convex hulls
-        # 2) intersects with spline (return points)
-        for curve in self.curves_array.copy():            #load up control points
-            for pt in curve:
-                pt[0]=pt[0]-ar.x
-                pt[1]=pt[1]-ar.y 
-            cp0.x,cp0.y = curve[0].copy()
-            cp1.x,cp1.y = curve[1].copy()
-            cp2.x,cp2.y = curve[2].copy()
-            cp3.x,cp3.y = curve[3].copy()
-            
-            
-            #rotate ctrl points such that ray is along the x axis
-            cp0 = rotate2D(-theta,cp0)
-            cp1 = rotate2D(-theta,cp1)
-            cp2 = rotate2D(-theta,cp2)
-            cp3 = rotate2D(-theta,cp3)
-            #test for intersection between ray (actually segment) and convex hull
-            if self.line_seg_overlap(origin,s,cp0,cp1) or self.line_seg_overlap(origin,s,cp1,cp2) or self.line_seg_overlap(origin,s,cp2,cp3) or self.line_seg_overlap(origin,s,cp3,cp0):
-                #print "inside intersect hull"
-                #Ray does intersect this convex hull.  Find solution:
-                #Setup A,B,C and D (bernstein polynomials)
-                A = cp3.y-3*cp2.y+3*cp1.y-cp0.y
-                B = 3*cp2.y-6*cp1.y+3*cp0.y
-                C = 3*cp1.y-3*cp0.y
-                D = cp0.y
-                #solve for t
-                #print "ABCD: ",A,B,C,D
-                ts = roots_of_cubic(A,B,C,D)
-                while ts.n > 0:
-                    ts.n-=1
-                    t = ts.roots[ts.n]
-                    #print "root: ", t
-                    #make sure solution is on valid interval
-                    if 0.<t<1.:
-                        #the x value will also be the length, which is the form of result
-                        b = eval_bezier(t,cp0.x,cp1.x,cp2.x,cp3.x)
-                        #print "b at t",b,t
-                        #is x within bounds?
-                        if 0 < b < s.x:
-                            #print "in range"
-                            #is point within Z bounds?
-                            c = dZ*b/s.x   
-                            a = c+ar.z     
-                            if self.z_height_1 < a < self.z_height_2:
-                                #print "in z: ",B,result
-                                #is this the shortest length to an intersection so far?
-                                b = sqrt(c**2+b**2)
-                                #print "this: ",b
-                                if b < result and b > self.tolerance:
-                                    result = b
-                                    #print "b at t",b,t
-
-        if result == INF: result = 0
+        length = mag_(tempv)
+        r.x = ar.x
+        r.y = ar.y
+        d.x = tempv.x
+        d.y = tempv.y
+        s_len = sqrt(d.x*d.x + d.y*d.y)
+        if s_len == 0:
+            return 0
+        #rotation by -theta, which puts the ray along the x axis
+        cos_t = d.x/s_len
+        sin_t = d.y/s_len
+        s.x = s_len
+        s.y = 0
+        
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = self.nodes + stack[top]
+            t_entry = seg_box_entry_(node.lower, node.upper, r, d)
+            #skip nodes the ray misses, or which start beyond the nearest hit
+            if t_entry < 0 or t_entry*length >= result:
+                continue
+            #a full stack falls back to testing every segment under the node
+            if node.left < 0 or top+2 > SEG_STACK_SIZE:
+                for i in range(node.start, node.stop):
+                    dist = self.intersect_seg_c(self.segs + i, r, cos_t, sin_t,
+                                                s, dZ, ar.z, &t)
+                    if dist < result:
+                        result = dist
+                        i_best = i
+                        t_best = t
+            else:
+                stack[top] = node.right
+                stack[top+1] = node.left
+                top += 2
 
+        if result == INF: return 0
+        
+        hit.param.x = i_best
+        hit.param.y = t_best
+        hit.param.z = 0
         return result
+    
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        b.lower.x, b.lower.y = self.mincorner.x, self.mincorner.y
+        b.upper.x, b.upper.y = self.maxcorner.x, self.maxcorner.y
+        b.lower.z, b.upper.z = self.z_height_1, self.z_height_2
+        return b
 
 
+    cdef vector_t compute_normal_hit_c(self, hit_t *hit) nogil:
+        """The normal from the derivative of the segment, at the curve 
+        parameter recorded by intersect_c
+        """
+        cdef:
+            bezier_seg_t *seg = self.segs + <int>hit.param.x
+            double t = hit.param.y
+            vector_t n
+        #direction of normal is to the left of the parametric curve
+        n.x = -dif_bezier(t, seg.cp[0].y, seg.cp[1].y, seg.cp[2].y, seg.cp[3].y)
+        n.y = dif_bezier(t, seg.cp[0].x, seg.cp[1].x, seg.cp[2].x, seg.cp[3].x)
+        n.z = 0     #trough has no slope in z
+        return norm_(n)
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         cdef:
             flatvector_t ray,cp0,cp1,cp2,cp3,rotated
-            double theta, tmp, t
+            double theta, tmp, t, A, B, C, D
+            int i
+            bezier_seg_t *seg
             poly_roots ts
-            np_.ndarray box
-        #print "called looking for normal",p.x,p.y
         ray.x = p.x
         ray.y = p.y
         theta = atan2(p.y,p.x)
         #find which curve this point is in
-        for curve in self.curves_array.copy():            #load up control points
-            cp0.x,cp0.y = curve[0].copy()
-            cp1.x,cp1.y = curve[1].copy()
-            cp2.x,cp2.y = curve[2].copy()
-            cp3.x,cp3.y = curve[3].copy()
+        for i in range(self.n_segs):
+            seg = self.segs + i
+            cp0 = seg.cp[0]
+            cp1 = seg.cp[1]
+            cp2 = seg.cp[2]
+            cp3 = seg.cp[3]
 
             #is point even in this hull?
-            #print "tried at least"
             if self.pnt_in_hull(ray,cp0,cp1,cp2,cp3):
                 #then, solve for t
-                #print "in hull"
                 cp0 = rotate2D(-theta,cp0)
                 cp1 = rotate2D(-theta,cp1)
                 cp2 = rotate2D(-theta,cp2)
@@ -645,21 +917,16 @@ cdef class ExtrudedBezierFace(Face):
                 D = cp0.y
                 ts = roots_of_cubic(A,B,C,D)
                 
-                #print "normal roots: ",ts.n,ts.roots[0],ts.roots[1],ts.roots[2]
                 while ts.n > 0:
                     ts.n -=1
                     t = ts.roots[ts.n]
                     #make sure solution is within interval
-                    #print "normal t: ",t
                     if 0<=t<=1:
                         #ok, then is this the t to the same point p? 
                         tmp = eval_bezier(t,cp0.x,cp1.x,cp2.x,cp3.x)
-                        #print "normal b at t: ",tmp,t
                         #I will generously allow for rounding error 
-                        #print "got here with point: ",tmp,
-                        if tmp**2 - (ray.x**2+ray.y**2) < .0001:
+                        if fabs(tmp**2 - (ray.x**2+ray.y**2)) < .0001:
                             #this is the single solution. return the derivative dy/dx = dy/dt / dx/dt
-                            #print "that was it!"
                             ray.x = dif_bezier(t,cp0.x,cp1.x,cp2.x,cp3.x)
                             ray.y = dif_bezier(t,cp0.y,cp1.y,cp2.y,cp3.y)
                             ray = rotate2D(theta,ray)
@@ -680,47 +947,75 @@ cdef class ExtrudedBezierFace(Face):
 
 
         #how did you get here?  p was supposed to be a point on the curve!
-        print "error: Bezier normal not found, point not actually on curve!"
         p.x=p.y=p.z = 0
         return p
 
 
     
-cdef int point_in_polygon_c(double X, double Y, object obj):
-    cdef int i, size, ct=0
-    cdef double y1, y2, h, x, x1, x2
-    cdef np_.ndarray[np_.float64_t, ndim=2] pts=obj
-    
-    size = pts.shape[0]
+cdef inline int edge_crossing_(double X, double Y, double x1, double y1,
+                               double x2, double y2) nogil:
+    #does a ray from (X,Y) along +x cross the edge from (x1,y1) to (x2,y2)
+    cdef double h, x
+    h = (Y - y1) / (y2 - y1)
+    if 0 < h <= 1.0:
+        x = x1 + h*(x2 - x1)
+        if x > X:
+            return 1
+    return 0
+
+
+cdef int point_in_polygon_c(double X, double Y, double *pts, int size) nogil:
+    """Crossing test over all the edges of the closed polygon with vertices
+    pts[2*i], pts[2*i+1]
+    """
+    cdef int i, ct=0
+    cdef double y1, x1
     
-    y1 = pts[size-1,1]
-    x1 = pts[size-1,0]
+    if size == 0:
+        return 0
+    y1 = pts[2*size-1]
+    x1 = pts[2*size-2]
     for i in xrange(size):
-        y2 = pts[i,1]
-        x2 = pts[i,0]
-        h = (Y - y1) / (y2 - y1)
-        if 0 < h <= 1.0:
-            x = x1 + h*(x2 - x1)
-            if x > X:
-                ct = not ct
-        y1 = y2
-        x1 = x2
+        if edge_crossing_(X, Y, x1, y1, pts[2*i], pts[2*i+1]):
+            ct = not ct
+        y1 = pts[2*i+1]
+        x1 = pts[2*i]
     return ct
 
 
 def point_in_polygon(double X, double Y, point_list):
-    pts = np.ascontiguousarray(point_list, dtype=np.float64)
+    cdef np_.ndarray pts = np.ascontiguousarray(point_list, dtype=np.float64)
     assert pts.shape[1]==2
-    return bool(point_in_polygon_c(X, Y, pts))
+    return bool(point_in_polygon_c(X, Y, <double*>pts.data, pts.shape[0]))
     
     
 cdef class PolygonFace(Face):
+    """A planar polygon at z=z_plane. 
+    
+    For the inside test, the polygon's y-extent is divided into uniform
+    slabs, each listing the edges which overlap it. A point then only needs
+    the crossing test against the edges of its own slab. The slabs are 
+    rebuilt whenever xy_points is set.
+    """
     cdef public double z_plane
     cdef object _xy_points
+    cdef:
+        double *verts #copy of xy_points as x,y pairs
+        int n_verts
+        int n_slabs
+        double slab_y0, slab_scale #slab of y is (y-slab_y0)*slab_scale
+        int *slab_start #edges of slab k are slab_edges[slab_start[k]:slab_start[k+1]]
+        int *slab_edges #edge i runs from vertex i-1 to vertex i
     
     def __cinit__(self, z_plane=0.0, xy_points=[[]], **kwds):
+        self.planar = 1
         self.z_plane = z_plane
         self.xy_points = xy_points
+        
+    def __dealloc__(self):
+        free(self.verts)
+        free(self.slab_start)
+        free(self.slab_edges)
     
     property xy_points:
         def __get__(self):
@@ -729,25 +1024,120 @@ cdef class PolygonFace(Face):
         def __set__(self, pts):
             data = np.ascontiguousarray(pts, dtype=np.float64).reshape(-1,2)
             self._xy_points=data
+            self.build_slabs(data)
+            
+    cdef inline int slab_of(self, double y) nogil:
+        cdef double k = (y - self.slab_y0)*self.slab_scale
+        if k < 0:
+            return 0
+        if k >= self.n_slabs:
+            return self.n_slabs-1
+        return <int>k
+            
+    cdef build_slabs(self, np_.ndarray pts):
+        cdef:
+            int i, k, n=pts.shape[0]
+            double *v
+            double y_lo, y_hi
+            list slabs
+        
+        free(self.verts)
+        free(self.slab_start)
+        free(self.slab_edges)
+        self.verts = self.slab_start = self.slab_edges = NULL
+        self.n_verts = self.n_slabs = 0
+        
+        v = <double*>malloc(max(2*n,1)*sizeof(double))
+        if v is NULL:
+            raise MemoryError()
+        for i in range(n):
+            v[2*i] = pts[i,0]
+            v[2*i+1] = pts[i,1]
+        self.verts = v
+        self.n_verts = n
+        if n == 0:
+            return
+        
+        y_lo = pts[:,1].min()
+        y_hi = pts[:,1].max()
+        self.n_slabs = n
+        self.slab_y0 = y_lo
+        self.slab_scale = n/(y_hi - y_lo) if y_hi > y_lo else 0.0
+        
+        slabs = [[] for k in range(n)]
+        for i in range(n):
+            y1, y2 = v[2*((i+n-1)%n)+1], v[2*i+1]
+            for k in range(self.slab_of(min(y1,y2)), self.slab_of(max(y1,y2))+1):
+                slabs[k].append(i)
+        
+        self.slab_start = <int*>malloc((n+1)*sizeof(int))
+        self.slab_edges = <int*>malloc(max(sum(len(e) for e in slabs),1)*sizeof(int))
+        if self.slab_start is NULL or self.slab_edges is NULL:
+            raise MemoryError()
+        self.slab_start[0] = 0
+        for k in range(n):
+            for i, e in enumerate(slabs[k]):
+                self.slab_edges[self.slab_start[k] + i] = e
+            self.slab_start[k+1] = self.slab_start[k] + len(slabs[k])
+            
+    cdef int inside_c(self, double X, double Y) nogil:
+        """Crossing test for (X,Y), against the edges in its slab"""
+        cdef:
+            int k, j, i, i0, ct=0
+            double *v = self.verts
+        if self.n_slabs == 0:
+            return 0
+        k = self.slab_of(Y)
+        for j in range(self.slab_start[k], self.slab_start[k+1]):
+            i = self.slab_edges[j]
+            i0 = i-1 if i > 0 else self.n_verts-1
+            if edge_crossing_(X, Y, v[2*i0], v[2*i0+1], v[2*i], v[2*i+1]):
+                ct = not ct
+        return ct
             
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         cdef:
             double max_length = sep_(p1, p2)
             double h = (self.z_plane-p1.z)/(p2.z-p1.z)
             double X, Y
         
         if (h<self.tolerance) or (h>1.0):
-            #print "H", h
             return 0
         X = p1.x + h*(p2.x-p1.x)
         Y = p1.y + h*(p2.y-p1.y)
         #test for (X,Y) in polygon
-        if point_in_polygon_c(X,Y, self._xy_points)==1:
+        if self.inside_c(X,Y):
             return h * max_length
         else:
             return 0.0
         
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef void intersect_batch_c(self, ray_soa_t segs, double *dist) nogil:
+        cdef:
+            size_t i
+            double h, z=self.z_plane, tol=self.tolerance
+        
+        for i in range(segs.n):
+            h = (z-segs.oz[i])/segs.dz[i]
+            if (h<tol) or (h>1.0):
+                dist[i] = 0
+            elif self.inside_c(segs.ox[i] + h*segs.dx[i],
+                               segs.oy[i] + h*segs.dy[i]):
+                dist[i] = h*sqrt(segs.dx[i]*segs.dx[i] + segs.dy[i]*segs.dy[i] +
+                                 segs.dz[i]*segs.dz[i])
+            else:
+                dist[i] = 0
+        
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        cdef np_.ndarray pts=self._xy_points
+        if pts.shape[0] == 0:
+            return Face.bounds_c(self)
+        b.lower.x, b.lower.y = pts.min(axis=0)
+        b.upper.x, b.upper.y = pts.max(axis=0)
+        b.lower.z = b.upper.z = self.z_plane
+        return b
+        
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -758,11 +1148,223 @@ cdef class PolygonFace(Face):
         return normal
     
     
+cdef struct extruded_edge_t:
+    flatvector_t a #start of the edge
+    flatvector_t v #vector from the start to the end of the edge
+    flatvector_t normal
+    int idx #index of the edge in the profile
+    
+    
+cdef class ExtrudedPolygonFace(Face):
+    """All the sides of a polygon extruded along z, between z1 and z2, as
+    a single face. Edge i runs from xy_points[i] to xy_points[i+1] (the 
+    last closes the polygon), and has the same normal as the 
+    ExtrudedPlanarFace which Extrusion used to make for it. 
+    
+    Unlike a chain of ExtrudedPlanarFaces, the face is not planar: a ray 
+    leaving one side can hit another. The edges are held in a 2D tree over
+    their x-y boxes, so a ray is only tested against the edges it passes 
+    near, after clipping it to the z-range. The edge which was hit is kept
+    in hit.param for the normal; the edge for a given point on the face can
+    be found with edge_index(). 
+    
+    Each edge has its own idx, from idx to idx+n_edges-1, so end_face_idx 
+    tells the sides apart as it did for separate faces.
+    """
+    cdef:
+        public double z1, z2
+        object _xy_points
+        extruded_edge_t *edges #in tree order
+        seg_node_t *nodes
+        readonly int n_edges, n_nodes
+        
+    def __cinit__(self, xy_points=[[]], **kwds):
+        self.z1 = kwds.get('z1',0)
+        self.z2 = kwds.get('z2',0)
+        self.xy_points = xy_points
+        
+    def __dealloc__(self):
+        free(self.edges)
+        free(self.nodes)
+        
+    property xy_points:
+        def __get__(self):
+            return self._xy_points
+        
+        def __set__(self, pts):
+            data = np.ascontiguousarray(pts, dtype=np.float64).reshape(-1,2)
+            self._xy_points=data
+            self.build_edges(data)
+            
+    cdef build_edges(self, np_.ndarray pts):
+        cdef:
+            int i, k, n=pts.shape[0]
+            extruded_edge_t *edge
+            vector_t nm
+            
+        free(self.edges)
+        free(self.nodes)
+        self.edges = NULL
+        self.nodes = NULL
+        self.n_edges = self.n_nodes = 0
+        
+        ends = np.roll(pts, -1, axis=0)
+        nodes, order = _bvh_partition(np.minimum(pts, ends), 
+                                      np.maximum(pts, ends))
+        self.edges = <extruded_edge_t*>malloc(max(n,1)*sizeof(extruded_edge_t))
+        if self.edges is NULL:
+            raise MemoryError()
+        self.nodes = seg_tree_(nodes)
+        self.n_edges = n
+        self.n_nodes = len(nodes)
+        for i, k in enumerate(order):
+            edge = self.edges + i
+            edge.idx = k
+            edge.a.x, edge.a.y = pts[k]
+            edge.v.x = ends[k,0] - edge.a.x
+            edge.v.y = ends[k,1] - edge.a.y
+            nm.x = edge.v.y
+            nm.y = -edge.v.x
+            nm.z = 0
+            nm = norm_(nm)
+            edge.normal.x, edge.normal.y = nm.x, nm.y
+            
+    cdef double intersect_c(self, vector_t r, vector_t p2, hit_t *hit) nogil:
+        """Intersects the ray with the edges whose boxes its x-y projection
+        crosses, within the part of the ray between z1 and z2. The index 
+        of the edge (in tree order) is kept in hit.param.x
+        """
+        cdef: 
+            flatvector_t o, d, u, v
+            vector_t s
+            double t0=0.0, t1=1.0, ta, tb, a, det, best=INF, t_entry
+            int i, top, i_best=-1
+            int stack[SEG_STACK_SIZE]
+            seg_node_t *node
+            extruded_edge_t *edge
+            
+        if self.n_nodes == 0:
+            return 0
+        s = subvv_(p2, r)
+        
+        #clip the ray to the z-range of the extrusion
+        if s.z == 0:
+            if not (self.z1 < r.z < self.z2):
+                return 0
+        else:
+            ta = (self.z1 - r.z)/s.z
+            tb = (self.z2 - r.z)/s.z
+            if ta > tb:
+                ta, tb = tb, ta
+            t0 = max(t0, ta)
+            t1 = min(t1, tb)
+            if t0 > t1:
+                return 0
+        
+        o.x, o.y = r.x, r.y
+        d.x, d.y = s.x, s.y
+        
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = self.nodes + stack[top]
+            t_entry = seg_box_entry_(node.lower, node.upper, o, d)
+            if t_entry < 0 or t_entry > t1 or t_entry >= best:
+                continue
+            #a full stack falls back to testing every edge under the node
+            if node.left < 0 or top+2 > SEG_STACK_SIZE:
+                for i in range(node.start, node.stop):
+                    edge = self.edges + i
+                    u = edge.a
+                    v = edge.v
+                    det = s.x*v.y - s.y*v.x
+                    if det == 0:
+                        continue
+                    #fractional distance of intersection along edge
+                    a = (s.y*(u.x-r.x) - s.x*(u.y-r.y)) / det
+                    if a<0 or a>1:
+                        continue
+                    #fractional distance of intersection along ray
+                    a = (v.x*(r.y-u.y) - v.y*(r.x-u.x)) / det
+                    if t0 < a < t1 and a < best:
+                        best = a
+                        i_best = i
+            else:
+                stack[top] = node.right
+                stack[top+1] = node.left
+                top += 2
+                
+        if i_best < 0:
+            return 0
+        hit.param.x = i_best
+        hit.param.y = hit.param.z = 0
+        return best * mag_(s)
+        
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        if self.n_nodes == 0:
+            return Face.bounds_c(self)
+        b.lower.x, b.lower.y = self.nodes[0].lower.x, self.nodes[0].lower.y
+        b.upper.x, b.upper.y = self.nodes[0].upper.x, self.nodes[0].upper.y
+        b.lower.z, b.upper.z = self.z1, self.z2
+        return b
+    
+    cdef int nearest_edge_c(self, vector_t p) nogil:
+        #the edge (in tree order) closest to p, in the x-y plane
+        cdef:
+            int i, i_best=0
+            double a, dx, dy, dist, best=INF
+            extruded_edge_t *edge
+        for i in range(self.n_edges):
+            edge = self.edges + i
+            dx = p.x - edge.a.x
+            dy = p.y - edge.a.y
+            a = (dx*edge.v.x + dy*edge.v.y)/(edge.v.x*edge.v.x + edge.v.y*edge.v.y)
+            a = min(max(a, 0.0), 1.0)
+            dx -= a*edge.v.x
+            dy -= a*edge.v.y
+            dist = dx*dx + dy*dy
+            if dist < best:
+                best = dist
+                i_best = i
+        return i_best
+    
+    property n_idx:
+        def __get__(self):
+            return max(self.n_edges, 1)
+            
+    cdef int hit_idx_c(self, hit_t *hit) nogil:
+        return self.idx + self.edges[<int>hit.param.x].idx
+        
+    def edge_index(self, point):
+        """Returns the index of the profile edge nearest to the given point
+        on the face, in local coordinates.
+        """
+        if self.n_edges == 0:
+            return -1
+        return self.edges[self.nearest_edge_c(set_v(point))].idx
+        
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
+        cdef hit_t hit
+        hit.param.x = self.nearest_edge_c(p)
+        return self.compute_normal_hit_c(&hit)
+    
+    cdef vector_t compute_normal_hit_c(self, hit_t *hit) nogil:
+        cdef:
+            vector_t n
+            extruded_edge_t *edge = self.edges + <int>hit.param.x
+        n.x = edge.normal.x
+        n.y = edge.normal.y
+        n.z = 0
+        return n
+    
+    
 cdef class OffAxisParabolicFace(Face):
     cdef:
         public double EFL, diameter, height
                 
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         """Intersects the given ray with this face.
         
         params:
@@ -776,7 +1378,7 @@ cdef class OffAxisParabolicFace(Face):
         cdef:
             double max_length = sep_(p1, p2)
             double A = 1 / (2*self.EFL), efl = self.EFL
-            double a,b,c,d
+            double a,b,c,d, a1, a2
             vector_t s, r, pt1, pt2
             
             
@@ -831,7 +1433,7 @@ cdef class OffAxisParabolicFace(Face):
                 return 0
             return a1 * sep_(p1, p2)
 #
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         """Compute the surface normal in local coordinates,
         given a point on the surface (also in local coords).
         """
@@ -855,6 +1457,7 @@ cdef class EllipsoidalFace(Face):
     cdef:
         public double major, minor #axis lengths
         transform_t trans, inv_trans
+        object transform_stamp
         public double x1, x2, y1, y2, z1, z2 #local bounds of the ellpsoid block
         
     property transform:
@@ -865,19 +1468,21 @@ cdef class EllipsoidalFace(Face):
         
         def __set__(self, Transform t):
             self.trans = t.trans
+            self.transform_stamp = None
             
     property inverse_transform:
         def __set__(self, Transform t):
             self.inv_trans = t.trans
+            self.transform_stamp = None
            
         def __get__(self):
             cdef Transform t=Transform()
             t.trans = self.inv_trans
             return t
             
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         cdef:
-            double B,A, a, b, c, d
+            double B,A, a, b, c, d, root1, root2
             
             vector_t S = subvv_(p2, p1)
             vector_t r = transform_c(self.trans, p1)
@@ -921,12 +1526,24 @@ cdef class EllipsoidalFace(Face):
             root1 = root2
         if root1 > 1:
             return 0
+        #keep the point in the ellipse frame for compute_normal_hit_c
+        hit.param = addvv_(r, multvs_(s, root1))
         return root1*mag_(S)
+    
+    cdef aabb_t bounds_c(self):
+        cdef aabb_t b
+        b.lower.x, b.upper.x = self.x1, self.x2
+        b.lower.y, b.upper.y = self.y1, self.y2
+        b.lower.z, b.upper.z = self.z1, self.z2
+        return b
         
-    cdef vector_t compute_normal_c(self, vector_t p):
-        cdef vector_t n
-        
-        p = transform_c(self.trans, p)
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
+        cdef hit_t hit
+        hit.param = transform_c(self.trans, p)
+        return self.compute_normal_hit_c(&hit)
+    
+    cdef vector_t compute_normal_hit_c(self, hit_t *hit) nogil:
+        cdef vector_t n, p=hit.param
         
         n.x = p.x/-(self.major**2)
         n.y = p.y/-(self.minor**2)
@@ -945,14 +1562,9 @@ cdef class EllipsoidalFace(Face):
         self.z1, self.z2 = owner.Z_bounds
         
     def sync_transform(self, vtk_trans):
-        m = vtk_trans.matrix
-        rot = [[m.get_element(i,j) for j in xrange(3)] for i in xrange(3)]
-        dt = [m.get_element(i,3) for i in xrange(3)]
-        #print "TRANS", rot, dt
-        self.transform = Transform(rotation=rot, translation=dt)
-        inv_trans = vtk_trans.linear_inverse
-        m = inv_trans.matrix
-        rot = [[m.get_element(i,j) for j in xrange(3)] for i in xrange(3)]
-        dt = [m.get_element(i,3) for i in xrange(3)]
-        self.inverse_transform = Transform(rotation=rot, translation=dt)
+        stamp = transform_stamp_(vtk_trans)
+        if stamp is not None and stamp == self.transform_stamp:
+            return
+        self.transform, self.inverse_transform = vtk_transforms_(vtk_trans)
+        self.transform_stamp = stamp
     
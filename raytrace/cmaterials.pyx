@@ -1,6 +1,7 @@
 cimport cython
+from libc.stdlib cimport malloc, free
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double sqrt(double arg)
     double fabs(double arg)
     double sin(double arg)
@@ -12,14 +13,14 @@ cdef extern from "float.h":
     double DBL_MAX
 
 IF UNAME_SYSNAME == "Windows":
-    cdef extern from "complex.h":
+    cdef extern from "complex.h" nogil:
         double complex csqrt "sqrt" (double complex)
         double cabs "abs" (double complex)
         double complex cexp "exp" (double complex)
 	
     cdef double complex I = 1j
 ELSE:
-    cdef extern from "complex.h":
+    cdef extern from "complex.h" nogil:
         double complex csqrt (double complex)
         double cabs (double complex)
         double complex cexp (double complex)
@@ -30,13 +31,13 @@ cdef double INF=(DBL_MAX+DBL_MAX)
 from ctracer cimport InterfaceMaterial, norm_, dotprod_, \
         multvs_, subvv_, vector_t, ray_t, RayCollection, \
         complex_t, mag_sq_, Ray, cross_, set_v, ray_power_, \
-        orientation_t, addvv_
+        orientation_t, addvv_, surface_hit_t
 
 import numpy as np
 cimport numpy as np_
 
 
-cdef ray_t convert_to_sp(ray_t ray, vector_t normal):
+cdef ray_t convert_to_sp(ray_t ray, vector_t normal) nogil:
     """Project the E-field components of a given ray
     onto the S- and P-polarisations defined by the 
     surface normal
@@ -187,12 +188,12 @@ cdef class BaseDispersionCurve(object):
 cdef class OpaqueMaterial(InterfaceMaterial):
     """A perfect absorber i.e. it generates no rays
     """
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         pass
     
     
@@ -202,12 +203,12 @@ cdef class TransparentMaterial(InterfaceMaterial):
     to the incoming ray. It does project the polarisation
     vectors to it's S- and P-directions, however.
     """
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         cdef:
             vector_t cosThetaNormal, reflected, normal
             ray_t sp_ray
@@ -222,53 +223,81 @@ cdef class TransparentMaterial(InterfaceMaterial):
         new_rays.add_ray_c(sp_ray)
 
 
+cdef inline void pec_child_(ray_t *in_ray, 
+                            unsigned int idx, 
+                            vector_t point,
+                            orientation_t orient,
+                            RayCollection new_rays) nogil:
+    """PEC reflection of a single ray. Shared by PECMaterial.eval_child_ray_c
+    and eval_children_batch_c
+    
+       ray - the ingoing ray
+       idx - the index of ray in it's RayCollection
+       point - the position of the intersection (in global coords)
+       normal - the outward normal vector for the surface
+    """
+    cdef:
+        vector_t cosThetaNormal, reflected, normal
+        ray_t sp_ray
+        complex_t cpx
+        double cosTheta
+
+    normal = norm_(orient.normal)
+    sp_ray = convert_to_sp(in_ray[0], normal)
+    cosTheta = dotprod_(normal, in_ray.direction)
+    cosThetaNormal = multvs_(normal, cosTheta)
+    reflected = subvv_(in_ray.direction, multvs_(cosThetaNormal, 2))
+    sp_ray.origin = point
+    sp_ray.normal = normal
+    sp_ray.direction = reflected
+    sp_ray.E1_amp.real = -sp_ray.E1_amp.real
+    sp_ray.E1_amp.imag = -sp_ray.E1_amp.imag
+    #sp_ray.E2_amp.real = -sp_ray.E2_amp.real
+    #sp_ray.E2_amp.imag = -sp_ray.E2_amp.imag
+    sp_ray.parent_idx = idx
+    new_rays.add_ray_c(sp_ray)
+
+
 cdef class PECMaterial(InterfaceMaterial):
     """Simulates a Perfect Electrical Conductor
     """
-    cdef eval_child_ray_c(self,
+    cdef bint inline_children_
+    
+    def __cinit__(self, **kwds):
+        #subclasses may override eval_child_ray_c, so only call pec_child_
+        #directly for PECMaterial itself
+        self.inline_children_ = (type(self) is PECMaterial)
+    
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
-        """
-           ray - the ingoing ray
-           idx - the index of ray in it's RayCollection
-           point - the position of the intersection (in global coords)
-           normal - the outward normal vector for the surface
-        """
-        cdef:
-            vector_t cosThetaNormal, reflected, normal
-            ray_t sp_ray
-            complex_t cpx
-            double cosTheta
-        
-        normal = norm_(orient.normal)
-        sp_ray = convert_to_sp(in_ray[0], normal)
-        cosTheta = dotprod_(normal, in_ray.direction)
-        cosThetaNormal = multvs_(normal, cosTheta)
-        reflected = subvv_(in_ray.direction, multvs_(cosThetaNormal, 2))
-        sp_ray.origin = point
-        sp_ray.normal = normal
-        sp_ray.direction = reflected
-        sp_ray.E1_amp.real = -sp_ray.E1_amp.real
-        sp_ray.E1_amp.imag = -sp_ray.E1_amp.imag
-        #sp_ray.E2_amp.real = -sp_ray.E2_amp.real
-        #sp_ray.E2_amp.imag = -sp_ray.E2_amp.imag
-        sp_ray.parent_idx = idx
-        new_rays.add_ray_c(sp_ray)
+                            RayCollection new_rays) nogil:
+        pec_child_(in_ray, idx, point, orient, new_rays)
+        
+    cdef void eval_children_batch_c(self, ray_t *rays, surface_hit_t *hits,
+                                    size_t n, RayCollection new_rays) nogil:
+        cdef size_t i
+        if not self.inline_children_:
+            InterfaceMaterial.eval_children_batch_c(self, rays, hits, n, new_rays)
+            return
+        for i in range(n):
+            pec_child_(rays + hits[i].ray_idx, hits[i].ray_idx, hits[i].point, 
+                       hits[i].orient, new_rays)
         
         
 cdef class LinearPolarisingMaterial(InterfaceMaterial):
     """Simulates a perfect polarising beam splitter. P-polarisation
     is 100% transmitted while S- is reflected"""
+    max_children = 2
     
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -346,7 +375,7 @@ cdef class WaveplateMaterial(InterfaceMaterial):
         self.fast_axis = kwds.get("fast_axis", (1.0,0,0))
             
             
-    cdef ray_t apply_retardance_c(self, ray_t r):
+    cdef ray_t apply_retardance_c(self, ray_t r) nogil:
         cdef:
             complex_t E1=r.E1_amp, retard=self.retardance_
         r.E1_amp.real = E1.real*retard.real - E1.imag*retard.imag
@@ -361,12 +390,12 @@ cdef class WaveplateMaterial(InterfaceMaterial):
         return out
             
     
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -374,7 +403,7 @@ cdef class WaveplateMaterial(InterfaceMaterial):
            normal - the outward normal vector for the surface
         """
         cdef:
-            vector_t normal
+            vector_t normal, in_direction
             ray_t out_ray
             complex_t E1, retard
             
@@ -423,12 +452,12 @@ cdef class DielectricMaterial(InterfaceMaterial):
             self.n_outside_.real = v.real
             self.n_outside_.imag = v.imag
             
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -516,6 +545,135 @@ cdef class DielectricMaterial(InterfaceMaterial):
         new_rays.add_ray_c(sp_ray)
         
 
+@cython.cdivision(True)
+cdef inline void fresnel_children_(ray_t *in_ray, 
+                            unsigned int idx, 
+                            vector_t point,
+                            orientation_t orient,
+                            RayCollection new_rays,
+                            double complex n_inside,
+                            double complex n_outside,
+                            double reflection_threshold,
+                            double transmission_threshold) nogil:
+    """Fresnel reflection and transmission of a single ray, for 
+    FullDielectricMaterial
+    
+       ray - the ingoing ray
+       idx - the index of ray in it's RayCollection
+       point - the position of the intersection (in global coords)
+       normal - the outward normal vector for the surface
+    """
+    cdef:
+        vector_t cosThetaNormal, reflected, transmitted
+        vector_t tangent, tg2, in_direction, normal
+        ray_t sp_ray
+        complex_t cpx
+        double complex n1, n2, cos2, sin2, R_p, R_s, T_p, T_s, E1_amp, E2_amp
+        double cosTheta, cos1, sin1, P_in
+        double tan_mag_sq, c2
+        double Two_n1_cos1, aspect
+        int flip
+
+    normal = norm_(orient.normal)
+    in_direction = norm_(in_ray.direction)
+    sp_ray = convert_to_sp(in_ray[0], normal)
+    E1_amp = sp_ray.E1_amp.real + 1.0j*sp_ray.E1_amp.imag
+    E2_amp = sp_ray.E2_amp.real + 1.0j*sp_ray.E2_amp.imag
+    cosTheta = dotprod_(normal, in_direction)
+    cos1 = fabs(cosTheta)
+    sin1 = sqrt(1 - cos1*cos1)
+
+    #print "TRACE"
+    #print normal, in_direction
+
+    if cosTheta < 0.0: 
+        #ray incident from outside going inwards
+        n1 = n_outside
+        n2 = n_inside
+        flip = 1
+        #print "out to in", n1, n2
+    else:
+        n1 = n_inside
+        n2 = n_outside
+        flip = -1
+        #print "in to out", n1, n2
+
+    #apply Snell's law. These become complex.
+    sin2 = (n1*sin1/n2)
+    cos2 = csqrt(1 - sin2*sin2)
+    #print "cos1", cos1
+    #print "cos2", cos2
+
+    #print "TIR", N2_sin2, cosTheta, N2, cos1
+    #print (normal.x, normal.y, normal.z), in_direction
+    cosThetaNormal = multvs_(normal, cosTheta)
+
+    #incoming power
+    P_in =  n1.real*(E1_amp.real**2 + E1_amp.imag**2 + \
+                     E2_amp.real**2 + E2_amp.imag**2)
+
+    if P_in==0.0:
+        return
+    #print "P Incoming:", P_in
+    #Fresnel equations for reflection
+    R_p = -(n2*cos1 - n1*cos2)/(n2*cos1 + n1*cos2)
+    R_s = -(n2*cos2 - n1*cos1)/(n2*cos2 + n1*cos1)
+
+    #modify in place to get reflected amplitudes
+    R_s *= E1_amp
+    R_p *= E2_amp
+
+    #print "P_in:", P_in
+    #print "P_R:", (cabs(R_s)**2 + cabs(R_p)**2)
+
+    if ( n1.real*(cabs(R_s)**2 + cabs(R_p)**2)/P_in ) > reflection_threshold:
+        reflected = subvv_(in_direction, multvs_(cosThetaNormal, 2))
+        sp_ray.origin = point
+        sp_ray.normal = normal
+        sp_ray.direction = reflected
+        sp_ray.length = INF
+        sp_ray.E1_amp.real = R_s.real
+        sp_ray.E1_amp.imag = R_s.imag
+        sp_ray.E2_amp.real = -R_p.real
+        sp_ray.E2_amp.imag = -R_p.imag
+        sp_ray.parent_idx = idx
+        sp_ray.refractive_index.real = n1.real
+        sp_ray.refractive_index.imag = n1.imag
+        new_rays.add_ray_c(sp_ray)
+
+    #normal transmission            
+    tangent = subvv_(in_direction, cosThetaNormal)
+    tg2 = multvs_(tangent, n1.real/n2.real) #This is an approximation for complex N
+    tan_mag_sq = mag_sq_(tg2)
+    c2 = sqrt(1-tan_mag_sq)
+    transmitted = subvv_(tg2, multvs_(normal, c2*flip))
+
+    aspect = sqrt(cos2.real/cos1)
+
+    #Fresnel equations for transmission
+    T_p = aspect * (2.0*cos1*n1) / ( n2*cos1 + n1*cos2 )
+    T_s = aspect * (2.0*cos1*n1) / ( n2*cos2 + n1*cos1 )
+    #print "T_s", T_s, "T_p", T_p
+
+    #modify in place to get reflected amplitudes
+    T_s *= E1_amp
+    T_p *= E2_amp
+
+    if ( n2.real*(cabs(T_s)**2 + cabs(T_p)**2)/P_in ) > transmission_threshold:
+        sp_ray.origin = point
+        sp_ray.normal = normal
+        sp_ray.direction = transmitted
+        sp_ray.length = INF
+        sp_ray.E1_amp.real = T_s.real
+        sp_ray.E1_amp.imag = T_s.imag
+        sp_ray.E2_amp.real = T_p.real
+        sp_ray.E2_amp.imag = T_p.imag
+        sp_ray.parent_idx = idx
+        sp_ray.refractive_index.real = n2.real
+        sp_ray.refractive_index.imag = n2.imag
+        new_rays.add_ray_c(sp_ray)
+
+
 cdef class FullDielectricMaterial(DielectricMaterial):
     """Model for dielectric using full Fresnel equations 
     to give true phase and amplitude response
@@ -524,6 +682,9 @@ cdef class FullDielectricMaterial(DielectricMaterial):
         public double reflection_threshold, transmission_threshold
         public double thickness #in microns
         complex_t n_coating_
+        bint inline_children_
+        
+    max_children = 2
         
     property n_coating:
         def __get__(self):
@@ -539,140 +700,49 @@ cdef class FullDielectricMaterial(DielectricMaterial):
         self.thickness = kwds.get("thickness", 0.1)
         self.reflection_threshold = kwds.get('reflection_threshold', 0.1)
         self.transmission_threshold = kwds.get('transmission_threshold', 0.1)
+        #subclasses may override eval_child_ray_c, so only call 
+        #fresnel_children_ directly for FullDielectricMaterial itself
+        self.inline_children_ = (type(self) is FullDielectricMaterial)
     
-    @cython.cdivision(True)
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
-        """
-           ray - the ingoing ray
-           idx - the index of ray in it's RayCollection
-           point - the position of the intersection (in global coords)
-           normal - the outward normal vector for the surface
-        """
+                            RayCollection new_rays) nogil:
+        fresnel_children_(in_ray, idx, point, orient, new_rays,
+                          self.n_inside_.real + 1.0j*self.n_inside_.imag,
+                          self.n_outside_.real + 1.0j*self.n_outside_.imag,
+                          self.reflection_threshold, 
+                          self.transmission_threshold)
+        
+    cdef void eval_children_batch_c(self, ray_t *rays, surface_hit_t *hits,
+                                    size_t n, RayCollection new_rays) nogil:
         cdef:
-            vector_t cosThetaNormal, reflected, transmitted
-            vector_t tangent, tg2, in_direction, normal
-            ray_t sp_ray
-            complex_t cpx
-            double complex n1, n2, cos2, sin2, R_p, R_s, T_p, T_s, E1_amp, E2_amp
-            double cosTheta, cos1, sin1, P_in
-            double tan_mag_sq, c2
-            double Two_n1_cos1, aspect
-            int flip
-            
-        normal = norm_(orient.normal)
-        in_direction = norm_(in_ray.direction)
-        sp_ray = convert_to_sp(in_ray[0], normal)
-        E1_amp = sp_ray.E1_amp.real + 1.0j*sp_ray.E1_amp.imag
-        E2_amp = sp_ray.E2_amp.real + 1.0j*sp_ray.E2_amp.imag
-        cosTheta = dotprod_(normal, in_direction)
-        cos1 = fabs(cosTheta)
-        sin1 = sqrt(1 - cos1*cos1)
-        
-        #print "TRACE"
-        #print normal, in_direction
-        
-        if cosTheta < 0.0: 
-            #ray incident from outside going inwards
-            n1 = self.n_outside_.real + 1.0j*self.n_outside_.imag
-            n2 = self.n_inside_.real + 1.0j*self.n_inside_.imag
-            flip = 1
-            #print "out to in", n1, n2
-        else:
-            n1 = self.n_inside_.real + 1.0j*self.n_inside_.imag
-            n2 = self.n_outside_.real + 1.0j*self.n_outside_.imag
-            flip = -1
-            #print "in to out", n1, n2
-            
-        #apply Snell's law. These become complex.
-        sin2 = (n1*sin1/n2)
-        cos2 = csqrt(1 - sin2*sin2)
-        #print "cos1", cos1
-        #print "cos2", cos2
-        
-        #print "TIR", N2_sin2, cosTheta, N2, cos1
-        #print (normal.x, normal.y, normal.z), in_direction
-        cosThetaNormal = multvs_(normal, cosTheta)
-        
-        #incoming power
-        P_in =  n1.real*(E1_amp.real**2 + E1_amp.imag**2 + \
-                         E2_amp.real**2 + E2_amp.imag**2)
-        
-        if P_in==0.0:
+            size_t i
+            double complex n_inside = self.n_inside_.real + 1.0j*self.n_inside_.imag
+            double complex n_outside = self.n_outside_.real + 1.0j*self.n_outside_.imag
+        if not self.inline_children_:
+            InterfaceMaterial.eval_children_batch_c(self, rays, hits, n, new_rays)
             return
-        #print "P Incoming:", P_in
-        #Fresnel equations for reflection
-        R_p = -(n2*cos1 - n1*cos2)/(n2*cos1 + n1*cos2)
-        R_s = -(n2*cos2 - n1*cos1)/(n2*cos2 + n1*cos1)
-        
-        #modify in place to get reflected amplitudes
-        R_s *= E1_amp
-        R_p *= E2_amp
-        
-        #print "P_in:", P_in
-        #print "P_R:", (cabs(R_s)**2 + cabs(R_p)**2)
-        
-        if ( n1.real*(cabs(R_s)**2 + cabs(R_p)**2)/P_in ) > self.reflection_threshold:
-            reflected = subvv_(in_direction, multvs_(cosThetaNormal, 2))
-            sp_ray.origin = point
-            sp_ray.normal = normal
-            sp_ray.direction = reflected
-            sp_ray.length = INF
-            sp_ray.E1_amp.real = R_s.real
-            sp_ray.E1_amp.imag = R_s.imag
-            sp_ray.E2_amp.real = -R_p.real
-            sp_ray.E2_amp.imag = -R_p.imag
-            sp_ray.parent_idx = idx
-            sp_ray.refractive_index.real = n1.real
-            sp_ray.refractive_index.imag = n1.imag
-            new_rays.add_ray_c(sp_ray)
-            
-        #normal transmission            
-        tangent = subvv_(in_direction, cosThetaNormal)
-        tg2 = multvs_(tangent, n1.real/n2.real) #This is an approximation for complex N
-        tan_mag_sq = mag_sq_(tg2)
-        c2 = sqrt(1-tan_mag_sq)
-        transmitted = subvv_(tg2, multvs_(normal, c2*flip))
-        
-        aspect = sqrt(cos2.real/cos1)
-        
-        #Fresnel equations for transmission
-        T_p = aspect * (2.0*cos1*n1) / ( n2*cos1 + n1*cos2 )
-        T_s = aspect * (2.0*cos1*n1) / ( n2*cos2 + n1*cos1 )
-        #print "T_s", T_s, "T_p", T_p
-        
-        #modify in place to get reflected amplitudes
-        T_s *= E1_amp
-        T_p *= E2_amp
-        
-        if ( n2.real*(cabs(T_s)**2 + cabs(T_p)**2)/P_in ) > self.transmission_threshold:
-            sp_ray.origin = point
-            sp_ray.normal = normal
-            sp_ray.direction = transmitted
-            sp_ray.length = INF
-            sp_ray.E1_amp.real = T_s.real
-            sp_ray.E1_amp.imag = T_s.imag
-            sp_ray.E2_amp.real = T_p.real
-            sp_ray.E2_amp.imag = T_p.imag
-            sp_ray.parent_idx = idx
-            sp_ray.refractive_index.real = n2.real
-            sp_ray.refractive_index.imag = n2.imag
-            new_rays.add_ray_c(sp_ray)
+        for i in range(n):
+            fresnel_children_(rays + hits[i].ray_idx, hits[i].ray_idx, 
+                              hits[i].point, hits[i].orient, new_rays,
+                              n_inside, n_outside, self.reflection_threshold,
+                              self.transmission_threshold)
             
             
 cdef class SingleLayerCoatedMaterial(FullDielectricMaterial):
+    
+    uses_wavelengths = True
             
     @cython.cdivision(True)
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -687,7 +757,7 @@ cdef class SingleLayerCoatedMaterial(FullDielectricMaterial):
             double complex n1, n2, n3, cos2, sin2, cos3, sin3, R_p, R_s, T_p, T_s, E1_amp, E2_amp
             double complex n1cos1, n2cos2, n3cos3, n1cos2, n2cos1, n2cos3, n3cos2, ep1, ep2
             double complex M00, M01, M10, M11, phi
-            double cosTheta, cos1, P_in
+            double cosTheta, cos1, sin1, P_in, dwc
             double tan_mag_sq, c2
             double Two_n1_cos1, aspect
             double wavelength
@@ -825,6 +895,173 @@ cdef class SingleLayerCoatedMaterial(FullDielectricMaterial):
 vacuum = BaseDispersionCurve(0,np.array([1.0,]))
     
             
+cdef struct coating_coefs_t:
+    #Per-wavelength invariants for CoatedDispersiveMaterial. The arrays 
+    #are indexed by direction: 0 for rays going in (from outside), 1 for
+    #rays going out. n1 is the index on the incident side, n2 the coating
+    #and n3 the far side.
+    double complex n1[2]
+    double complex n3[2]
+    double complex n1_n2[2] #n1/n2
+    double complex n1_n3[2] #n1/n3
+    double n1_n3_real[2] #n1.real/n3.real
+    double complex n2
+    double k0 #2*pi/wavelength
+    
+    
+@cython.cdivision(True)
+cdef inline void coated_children_(ray_t *in_ray, 
+                            unsigned int idx, 
+                            vector_t point,
+                            orientation_t orient,
+                            RayCollection new_rays,
+                            coating_coefs_t *coefs,
+                            double coating_thickness,
+                            double reflection_threshold,
+                            double transmission_threshold) nogil:
+    """Reflection and transmission of a single ray, for 
+    CoatedDispersiveMaterial. coefs is the table entry for the ray's 
+    wavelength, so only the angle-dependent terms are evaluated here.
+    
+       ray - the ingoing ray
+       idx - the index of ray in it's RayCollection
+       point - the position of the intersection (in global coords)
+       normal - the outward normal vector for the surface
+    """
+    cdef:
+        vector_t cosThetaNormal, reflected, transmitted
+        vector_t tangent, tg2, in_direction, normal
+        ray_t sp_ray
+        double complex n1, n2, n3, cos2, sin2, cos3, sin3, R_p, R_s, T_p, T_s, E1_amp, E2_amp
+        double complex n1cos1, n2cos2, n3cos3, n1cos2, n2cos1, n2cos3, n3cos2, ep1, ep2
+        double complex M00, M01, M10, M11, phi
+        double cosTheta, cos1, sin1, P_in, dwc
+        double tan_mag_sq, c2
+        double aspect
+        int flip, d
+
+    normal = norm_(orient.normal)
+    in_direction = norm_(in_ray.direction)
+    sp_ray = convert_to_sp(in_ray[0], normal)
+    E1_amp = sp_ray.E1_amp.real + 1.0j*sp_ray.E1_amp.imag
+    E2_amp = sp_ray.E2_amp.real + 1.0j*sp_ray.E2_amp.imag
+    cosTheta = dotprod_(normal, in_direction)
+    cos1 = fabs(cosTheta)
+    sin1 = sqrt(1 - cos1*cos1)
+
+    #d=0 for a ray incident from outside going inwards
+    d = cosTheta >= 0.0
+    flip = 1 - 2*d
+    n1 = coefs.n1[d]
+    n2 = coefs.n2
+    n3 = coefs.n3[d]
+
+    #apply Snell's law. These become complex.
+    sin2 = coefs.n1_n2[d]*sin1
+    cos2 = csqrt(1 - sin2*sin2)
+
+    sin3 = coefs.n1_n3[d]*sin1
+    cos3 = csqrt(1 - sin3*sin3)
+
+    cosThetaNormal = multvs_(normal, cosTheta)
+
+    #incoming power
+    P_in =  n1.real*(E1_amp.real**2 + E1_amp.imag**2 + \
+                     E2_amp.real**2 + E2_amp.imag**2)
+
+    if P_in==0.0:
+        return
+
+    #Fresnel equations for reflection and transmission
+    n1cos1 = n1*cos1
+    n2cos2 = n2*cos2
+    n3cos3 = n3*cos3
+    dwc = coating_thickness*coefs.k0
+    phi = -I*dwc*(n2 - sin2*sin2)/cos2
+    ep1 = cexp(phi)/(4*n2cos2*n3cos3)
+    ep2 = cexp(-2*phi)
+    M00 = -ep1*( (n1cos1-n2cos2)*(n2cos2+n3cos3) + 
+                 (n1cos1+n2cos2)*(n2cos2-n3cos3)*ep2 )
+
+    M01 = -ep1*( (n1cos1-n2cos2)*(n2cos2-n3cos3) + 
+                 (n1cos1+n2cos2)*(n2cos2+n3cos3)*ep2 )
+
+    M10 = -ep1*( (n1cos1-n2cos2)*(n2cos2-n3cos3)*ep2 + 
+                 (n1cos1+n2cos2)*(n2cos2+n3cos3) )
+
+    M11 = -ep1*( (n1cos1-n2cos2)*(n2cos2+n3cos3)*ep2 + 
+                 (n1cos1+n2cos2)*(n2cos2-n3cos3) )
+
+    R_s = -M00/M01
+    T_s = M10 - M11*R_s
+
+    n1cos2 = n1*cos2
+    n2cos1 = n2*cos1
+    n2cos3 = n2*cos3
+    n3cos2 = n3*cos2
+    M00 = -ep1*( (n1cos2-n2cos1)*(n2cos3+n3cos2)*ep2 +
+                  (n1cos2+n2cos1)*(n2cos3-n3cos2) )
+
+    M01 = -ep1*( (n1cos2-n2cos1)*(n2cos3-n3cos2) +
+                  (n1cos2+n2cos1)*(n2cos3+n3cos2)*ep2 )
+
+    M10 = -ep1*( (n1cos2-n2cos1)*(n2cos3-n3cos2)*ep1 +
+                  (n1cos2+n2cos1)*(n2cos3+n3cos2) )
+
+    M11 = -ep1*( (n1cos2-n2cos1)*(n2cos3+n3cos2) +
+                  (n1cos2+n2cos1)*(n2cos3-n3cos2)*ep2 )
+
+    R_p = -M00/M01
+    T_p = M10 - M11*R_p
+
+    #modify in place to get reflected amplitudes
+    R_s *= E1_amp
+    R_p *= E2_amp
+
+
+    if ( n1.real*(cabs(R_s)**2 + cabs(R_p)**2)/P_in ) > reflection_threshold:
+        reflected = subvv_(in_direction, multvs_(cosThetaNormal, 2))
+        sp_ray.origin = point
+        sp_ray.normal = normal
+        sp_ray.direction = reflected
+        sp_ray.length = INF
+        sp_ray.E1_amp.real = R_s.real
+        sp_ray.E1_amp.imag = R_s.imag
+        sp_ray.E2_amp.real = -R_p.real
+        sp_ray.E2_amp.imag = -R_p.imag
+        sp_ray.parent_idx = idx
+        sp_ray.refractive_index.real = n1.real
+        sp_ray.refractive_index.imag = n1.imag
+        new_rays.add_ray_c(sp_ray)
+
+    #normal transmission            
+    tangent = subvv_(in_direction, cosThetaNormal)
+    tg2 = multvs_(tangent, coefs.n1_n3_real[d]) #This is an approximation for complex N
+    tan_mag_sq = mag_sq_(tg2)
+    c2 = sqrt(1-tan_mag_sq)
+    transmitted = subvv_(tg2, multvs_(normal, c2*flip))
+
+    aspect = sqrt(cos3.real/cos1)
+
+    #modify in place to get transmitted amplitudes
+    T_s *= (E1_amp*aspect)
+    T_p *= (E2_amp*aspect)
+
+    if ( n2.real*(cabs(T_s)**2 + cabs(T_p)**2)/P_in ) > transmission_threshold:
+        sp_ray.origin = point
+        sp_ray.normal = normal
+        sp_ray.direction = transmitted
+        sp_ray.length = INF
+        sp_ray.E1_amp.real = T_s.real
+        sp_ray.E1_amp.imag = T_s.imag
+        sp_ray.E2_amp.real = T_p.real
+        sp_ray.E2_amp.imag = T_p.imag
+        sp_ray.parent_idx = idx
+        sp_ray.refractive_index.real = n3.real
+        sp_ray.refractive_index.imag = n3.imag
+        new_rays.add_ray_c(sp_ray)
+
+
 cdef class CoatedDispersiveMaterial(InterfaceMaterial):
     cdef:
         public np_.npy_complex128[:] n_inside, n_outside, n_coating
@@ -833,6 +1070,11 @@ cdef class CoatedDispersiveMaterial(InterfaceMaterial):
         public BaseDispersionCurve dispersion_coating
         public double coating_thickness #in microns
         public double reflection_threshold, transmission_threshold
+        coating_coefs_t *coefs #one for each wavelength
+        readonly size_t n_coefs
+        
+    max_children = 2
+    uses_wavelengths = True
         
     def __cinit__(self, **kwds):
         self.reflection_threshold = kwds.get('reflection_threshold', 0.1)
@@ -842,174 +1084,68 @@ cdef class CoatedDispersiveMaterial(InterfaceMaterial):
         self.dispersion_coating = kwds.get("dispersion_coating",vacuum)
         self.coating_thickness = kwds.get("coating_thickness", 0.1)
         
+    def __dealloc__(self):
+        free(self.coefs)
+        
     cdef on_set_wavelengths(self):
+        """Evaluates the refractive indices for each wavelength, and builds
+        the table of per-wavelength coefficients used when tracing
+        """
         cdef:
             double[:] wavelengths = self._wavelengths
+            size_t i, n=wavelengths.shape[0]
+            double complex n_in, n_out, n_coat
+            coating_coefs_t *c
         self.n_inside = self.dispersion_inside.c_evaluate_n(wavelengths)
         self.n_outside = self.dispersion_outside.c_evaluate_n(wavelengths)
         self.n_coating = self.dispersion_coating.c_evaluate_n(wavelengths)
+        
+        free(self.coefs)
+        self.coefs = <coating_coefs_t*>malloc(max(n,1)*sizeof(coating_coefs_t))
+        if self.coefs is NULL:
+            raise MemoryError()
+        self.n_coefs = n
+        for i in range(n):
+            c = self.coefs + i
+            n_in = self.n_inside[i].real + I*self.n_inside[i].imag
+            n_out = self.n_outside[i].real + I*self.n_outside[i].imag
+            n_coat = self.n_coating[i].real + I*self.n_coating[i].imag
+            c.n1[0], c.n3[0] = n_out, n_in
+            c.n1[1], c.n3[1] = n_in, n_out
+            c.n2 = n_coat
+            c.n1_n2[0], c.n1_n2[1] = n_out/n_coat, n_in/n_coat
+            c.n1_n3[0], c.n1_n3[1] = n_out/n_in, n_in/n_out
+            c.n1_n3_real[0] = n_out.real/n_in.real
+            c.n1_n3_real[1] = n_in.real/n_out.real
+            c.k0 = 2*M_PI/wavelengths[i]
     
-    @cython.cdivision(True)
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
-        """
-           ray - the ingoing ray
-           idx - the index of ray in it's RayCollection
-           point - the position of the intersection (in global coords)
-           normal - the outward normal vector for the surface
-        """
-        cdef:
-            vector_t cosThetaNormal, reflected, transmitted
-            vector_t tangent, tg2, in_direction, normal
-            ray_t sp_ray
-            complex_t cpx
-            double complex n1, n2, n3, cos2, sin2, cos3, sin3, R_p, R_s, T_p, T_s, E1_amp, E2_amp
-            double complex n1cos1, n2cos2, n3cos3, n1cos2, n2cos1, n2cos3, n3cos2, ep1, ep2
-            double complex M00, M01, M10, M11, phi
-            double cosTheta, cos1, P_in
-            double tan_mag_sq, c2
-            double Two_n1_cos1, aspect
-            double wavelength
-            int flip
-            np_.npy_complex128 ctemp
-            
-        wavelength = self._wavelengths[in_ray.wavelength_idx]
-        normal = norm_(orient.normal)
-        in_direction = norm_(in_ray.direction)
-        sp_ray = convert_to_sp(in_ray[0], normal)
-        E1_amp = sp_ray.E1_amp.real + 1.0j*sp_ray.E1_amp.imag
-        E2_amp = sp_ray.E2_amp.real + 1.0j*sp_ray.E2_amp.imag
-        cosTheta = dotprod_(normal, in_direction)
-        cos1 = fabs(cosTheta)
-        sin1 = sqrt(1 - cos1*cos1)
-        
-        ctemp = self.n_coating[in_ray.wavelength_idx]
-        n2 = ctemp.real + I*ctemp.imag#self.n_coating_.real + 1.0j*self.n_coating_.imag
-        
-        if cosTheta < 0.0: 
-            #ray incident from outside going inwards
-            ctemp = self.n_outside[in_ray.wavelength_idx]
-            n1 = ctemp.real + I*ctemp.imag#self.n_outside_.real + 1.0j*self.n_outside_.imag
-            ctemp = self.n_inside[in_ray.wavelength_idx]
-            n3 = ctemp.real + I*ctemp.imag#self.n_inside_.real + 1.0j*self.n_inside_.imag
-            flip = 1
-            #print "out to in", n1, n2
-        else:
-            ctemp = self.n_inside[in_ray.wavelength_idx]
-            n1 = ctemp.real + I*ctemp.imag
-            ctemp = self.n_outside[in_ray.wavelength_idx]
-            n3 = ctemp.real + I*ctemp.imag
-            flip = -1
-            #print "in to out", n1, n2
-            
-        #apply Snell's law. These become complex.
-        sin2 = (n1*sin1/n2)
-        cos2 = csqrt(1 - sin2*sin2)
-        
-        sin3 = (n1*sin1/n3)
-        cos3 = csqrt(1 - sin3*sin3)
-        
-        cosThetaNormal = multvs_(normal, cosTheta)
-        
-        #incoming power
-        P_in =  n1.real*(E1_amp.real**2 + E1_amp.imag**2 + \
-                         E2_amp.real**2 + E2_amp.imag**2)
-        
-        if P_in==0.0:
+                            RayCollection new_rays) nogil:
+        if in_ray.wavelength_idx >= self.n_coefs:
             return
-
-        #Fresnel equations for reflection and transmission
-        n1cos1 = n1*cos1
-        n2cos2 = n2*cos2
-        n3cos3 = n3*cos3
-        dwc = 2*M_PI*self.coating_thickness/wavelength
-        phi = -I*dwc*(n2 - sin2*sin2)/cos2
-        ep1 = cexp(phi)/(4*n2cos2*n3cos3)
-        ep2 = cexp(-2*phi)
-        M00 = -ep1*( (n1cos1-n2cos2)*(n2cos2+n3cos3) + 
-                     (n1cos1+n2cos2)*(n2cos2-n3cos3)*ep2 )
-                     
-        M01 = -ep1*( (n1cos1-n2cos2)*(n2cos2-n3cos3) + 
-                     (n1cos1+n2cos2)*(n2cos2+n3cos3)*ep2 )
-        
-        M10 = -ep1*( (n1cos1-n2cos2)*(n2cos2-n3cos3)*ep2 + 
-                     (n1cos1+n2cos2)*(n2cos2+n3cos3) )
-        
-        M11 = -ep1*( (n1cos1-n2cos2)*(n2cos2+n3cos3)*ep2 + 
-                     (n1cos1+n2cos2)*(n2cos2-n3cos3) )
-        
-        R_s = -M00/M01
-        T_s = M10 - M11*R_s
-        
-        n1cos2 = n1*cos2
-        n2cos1 = n2*cos1
-        n2cos3 = n2*cos3
-        n3cos2 = n3*cos2
-        M00 = -ep1*( (n1cos2-n2cos1)*(n2cos3+n3cos2)*ep2 +
-                      (n1cos2+n2cos1)*(n2cos3-n3cos2) )
-        
-        M01 = -ep1*( (n1cos2-n2cos1)*(n2cos3-n3cos2) +
-                      (n1cos2+n2cos1)*(n2cos3+n3cos2)*ep2 )
-        
-        M10 = -ep1*( (n1cos2-n2cos1)*(n2cos3-n3cos2)*ep1 +
-                      (n1cos2+n2cos1)*(n2cos3+n3cos2) )
-        
-        M11 = -ep1*( (n1cos2-n2cos1)*(n2cos3+n3cos2) +
-                      (n1cos2+n2cos1)*(n2cos3-n3cos2)*ep2 )
-        
-        R_p = -M00/M01
-        T_p = M10 - M11*R_p
-        
-        #modify in place to get reflected amplitudes
-        R_s *= E1_amp
-        R_p *= E2_amp
-        
-        
-        if ( n1.real*(cabs(R_s)**2 + cabs(R_p)**2)/P_in ) > self.reflection_threshold:
-            reflected = subvv_(in_direction, multvs_(cosThetaNormal, 2))
-            sp_ray.origin = point
-            sp_ray.normal = normal
-            sp_ray.direction = reflected
-            sp_ray.length = INF
-            sp_ray.E1_amp.real = R_s.real
-            sp_ray.E1_amp.imag = R_s.imag
-            sp_ray.E2_amp.real = -R_p.real
-            sp_ray.E2_amp.imag = -R_p.imag
-            sp_ray.parent_idx = idx
-            sp_ray.refractive_index.real = n1.real
-            sp_ray.refractive_index.imag = n1.imag
-            new_rays.add_ray_c(sp_ray)
-            
-        #normal transmission            
-        tangent = subvv_(in_direction, cosThetaNormal)
-        tg2 = multvs_(tangent, n1.real/n3.real) #This is an approximation for complex N
-        tan_mag_sq = mag_sq_(tg2)
-        c2 = sqrt(1-tan_mag_sq)
-        transmitted = subvv_(tg2, multvs_(normal, c2*flip))
+        coated_children_(in_ray, idx, point, orient, new_rays,
+                         self.coefs + in_ray.wavelength_idx,
+                         self.coating_thickness, self.reflection_threshold,
+                         self.transmission_threshold)
         
-        aspect = sqrt(cos3.real/cos1)
-        
-        #modify in place to get transmitted amplitudes
-        T_s *= (E1_amp*aspect)
-        T_p *= (E2_amp*aspect)
-        
-        if ( n2.real*(cabs(T_s)**2 + cabs(T_p)**2)/P_in ) > self.transmission_threshold:
-            sp_ray.origin = point
-            sp_ray.normal = normal
-            sp_ray.direction = transmitted
-            sp_ray.length = INF
-            sp_ray.E1_amp.real = T_s.real
-            sp_ray.E1_amp.imag = T_s.imag
-            sp_ray.E2_amp.real = T_p.real
-            sp_ray.E2_amp.imag = T_p.imag
-            sp_ray.parent_idx = idx
-            sp_ray.refractive_index.real = n3.real
-            sp_ray.refractive_index.imag = n3.imag
-            new_rays.add_ray_c(sp_ray)
+    cdef void eval_children_batch_c(self, ray_t *rays, surface_hit_t *hits,
+                                    size_t n, RayCollection new_rays) nogil:
+        cdef:
+            size_t i
+            ray_t *ray
+        for i in range(n):
+            ray = rays + hits[i].ray_idx
+            if ray.wavelength_idx >= self.n_coefs:
+                continue
+            coated_children_(ray, hits[i].ray_idx, hits[i].point, 
+                             hits[i].orient, new_rays,
+                             self.coefs + ray.wavelength_idx,
+                             self.coating_thickness, self.reflection_threshold,
+                             self.transmission_threshold)
             
 
 cdef class DiffractionGratingMaterial(InterfaceMaterial):
@@ -1020,6 +1156,8 @@ cdef class DiffractionGratingMaterial(InterfaceMaterial):
         public double efficiency
         vector_t origin_
         
+    uses_wavelengths = True
+        
     def __cinit__(self, **kwds):
         self.lines_per_mm = kwds.get("lines_per_mm", 1000)
         self.order = kwds.get("order", 1)
@@ -1036,12 +1174,12 @@ cdef class DiffractionGratingMaterial(InterfaceMaterial):
             self.origin_.y = o[1]
             self.origin_.z = o[2]
     
-    cdef eval_child_ray_c(self,
+    cdef void eval_child_ray_c(self,
                             ray_t *in_ray, 
                             unsigned int idx, 
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays):
+                            RayCollection new_rays) nogil:
         """
            ray - the ingoing ray
            idx - the index of ray in it's RayCollection
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double sqrt(double arg)
 
 cdef extern from "float.h":
@@ -36,8 +36,10 @@ cdef packed struct ray_t:
     complex_t refractive_index, E1_amp, E2_amp
     #simple attribs
     double length, phase
+    double optical_path #sum of length*n.real over the ancestors of the ray
     #reference ids to related objects
     unsigned int wavelength_idx, parent_idx, end_face_idx
+    unsigned int root_idx #index of the input ray the ray descends from
     ##objects
     #object face, end_face, child_refl, child_trans
 
@@ -48,26 +50,72 @@ cdef struct transform_t:
 cdef struct ray_pair_t:
     ray_t trans, refln
 
+cdef struct aabb_t:
+    vector_t lower, upper
+
+cdef struct bvh_node_t:
+    aabb_t bounds
+    int left, right #child node indices, or -1 for a leaf
+    int start, stop #range of primitives held by a leaf
+
+cdef enum:
+    #type tags for the faces the SceneBVH can intersect without calling
+    #Face.intersect_c (see Face.face_params_c)
+    FACE_GENERIC = 0
+    FACE_DISC = 1 #disc in a z-plane. params: z, x-offset, radius**2
+    FACE_RECT = 2 #rectangle in a z-plane. params: z, x-offset, (length/2)**2, (width/2)**2
+
+cdef struct bvh_prim_t:
+    aabb_t bounds #in global coords
+    int set_idx #index of the owning FaceList
+    void *face #borrowed reference; SceneBVH.faces keeps it alive
+    #copies of the face attributes used in the intersection loop
+    double tolerance
+    int face_idx
+    short int planar
+    int kind #one of the FACE_* tags
+    double params[4] #the face's parameters, for the tagged kinds
+
+cdef struct hit_t:
+    double dist #distance along the ray to the intersection
+    vector_t point #the intersection point, in the FaceList's local coords
+    vector_t param #face-specific data kept for compute_normal_hit_c
+
+cdef struct surface_hit_t:
+    #a ray's intersection, recorded for evaluation of its material
+    vector_t point #in global coords
+    orientation_t orient
+    unsigned int ray_idx
+    int face_idx
+
+cdef struct ray_soa_t:
+    #structure-of-arrays ray segments, for the batch intersection kernels
+    double *ox, *oy, *oz #segment start points
+    double *dx, *dy, *dz #segment vectors (p2-p1) or unit directions
+    size_t n
+
 ##############################
 ### Vector maths functions ###
 ##############################
 
-cdef  vector_t transform_c(transform_t t, vector_t p)
-cdef  vector_t rotate_c(transform_t t, vector_t p)
+cdef  vector_t transform_c(transform_t t, vector_t p) nogil
+cdef  vector_t rotate_c(transform_t t, vector_t p) nogil
 cdef  vector_t set_v(object O)
-cdef  double sep_(vector_t p1, vector_t p2)
-cdef  vector_t multvv_(vector_t a, vector_t b)
-cdef  vector_t multvs_(vector_t a, double b)
-cdef  vector_t addvv_(vector_t a, vector_t b)
-cdef  vector_t addvs_(vector_t a, double b)
-cdef  vector_t subvv_(vector_t a, vector_t b)
-cdef  vector_t subvs_(vector_t a, double b)
-cdef  double dotprod_(vector_t a, vector_t b)
-cdef  vector_t cross_(vector_t a, vector_t b)
-cdef  vector_t norm_(vector_t a)
-cdef  double mag_(vector_t a)
-cdef  double mag_sq_(vector_t a)
-cdef  vector_t invert_(vector_t v)
+cdef object transform_stamp_(object vtk_trans)
+cdef tuple vtk_transforms_(object vtk_trans)
+cdef  double sep_(vector_t p1, vector_t p2) nogil
+cdef  vector_t multvv_(vector_t a, vector_t b) nogil
+cdef  vector_t multvs_(vector_t a, double b) nogil
+cdef  vector_t addvv_(vector_t a, vector_t b) nogil
+cdef  vector_t addvs_(vector_t a, double b) nogil
+cdef  vector_t subvv_(vector_t a, vector_t b) nogil
+cdef  vector_t subvs_(vector_t a, double b) nogil
+cdef  double dotprod_(vector_t a, vector_t b) nogil
+cdef  vector_t cross_(vector_t a, vector_t b) nogil
+cdef  vector_t norm_(vector_t a) nogil
+cdef  double mag_(vector_t a) nogil
+cdef  double mag_sq_(vector_t a) nogil
+cdef  vector_t invert_(vector_t v) nogil
 
 
 ##################################
@@ -80,12 +128,70 @@ cdef class Transform:
 cdef class Ray:
     cdef ray_t ray
 
+cdef class RayBlock:
+    """A block of ray memory, owned by a RayArena"""
+    cdef ray_t *rays
+    cdef readonly size_t size, used
+    cdef readonly int n_users #number of RayCollections using the block
+
 cdef class RayCollection:
     cdef ray_t *rays
     cdef readonly unsigned long n_rays, max_size
     cdef public RayCollection parent
+    cdef int n_exports #number of buffer views currently held
+    cdef readonly RayBlock block #arena block holding the rays, or None
+
+    cdef void add_ray_c(self, ray_t r) nogil
+    cdef int resize_c(self, size_t max_size) nogil
+    cdef check_resizable(self)
+
+cdef class RayArena:
+    cdef readonly list blocks
+    cdef RayBlock current
+    cdef list scratch
+    cdef public size_t block_size
+
+    cdef RayCollection allocate_c(self, size_t n_rays, size_t reserve)
+    cdef list scratch_c(self, size_t n, size_t capacity)
+
+cdef class RayCollectionSoA:
+    cdef readonly object origin, direction #(3,N) arrays; one row per axis
+    cdef readonly object length, end_face_idx
+    cdef readonly size_t n_rays
+
+    cdef ray_soa_t soa_c(self)
+
+cdef class RaySink:
+    pass
 
-    cdef add_ray_c(self, ray_t r)
+cdef class KeepAllSink(RaySink):
+    cdef readonly list traced_rays
+
+cdef class TerminalRaySink(RaySink):
+    cdef readonly list terminal #structured arrays of the terminal rays
+
+cdef class GenerationFileSink(RaySink):
+    cdef readonly object directory
+    cdef readonly list filenames
+
+cdef class CompactRaySink(RaySink):
+    cdef readonly object profile
+    cdef readonly list generations
+
+cdef class LastGenerationSink(RaySink):
+    cdef RayCollection rays #the latest generation, until finish
+    cdef readonly object last #ray_dtype array of the last generation, or None
+
+cdef class FaceTally(RaySink):
+    cdef readonly object counts, power #per face idx
+    cdef readonly double input_power
+    cdef readonly int n_generations
+
+cdef class HitCacheSink(RaySink):
+    cdef readonly list parent_idx, end_face_idx #per generation
+
+cdef class SinkGroup(RaySink):
+    cdef readonly list sinks
 
 cdef class RayCollectionIterator:
     cdef:
@@ -99,11 +205,13 @@ cdef class InterfaceMaterial(object):
     """
     cdef double[:] _wavelengths
 
-    cdef eval_child_ray_c(self, ray_t *old_ray,
+    cdef void eval_child_ray_c(self, ray_t *old_ray,
                             unsigned int ray_idx,
                             vector_t point,
                             orientation_t orient,
-                            RayCollection new_rays)
+                            RayCollection new_rays) nogil
+    cdef void eval_children_batch_c(self, ray_t *rays, surface_hit_t *hits,
+                                    size_t n, RayCollection new_rays) nogil
 
     cdef on_set_wavelengths(self)
 
@@ -116,23 +224,57 @@ cdef class Face(object):
     cdef public double max_length
     cdef public InterfaceMaterial material
     cdef public short int invert_normal
+    cdef public short int planar #if true, rays leaving the face can't hit it again
     cdef public unsigned int count
 
-    cdef double intersect_c(self, vector_t p1, vector_t p2)
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil
+    cdef void intersect_batch_c(self, ray_soa_t segs, double *dist) nogil
+    cdef aabb_t bounds_c(self)
+    cdef int face_params_c(self, double *params)
+    cdef int hit_idx_c(self, hit_t *hit) nogil
 
-    cdef vector_t compute_normal_c(self, vector_t p)
-    cdef vector_t compute_tangent_c(self, vector_t p)
+    cdef vector_t compute_normal_c(self, vector_t p) nogil
+    cdef vector_t compute_normal_hit_c(self, hit_t *hit) nogil
+    cdef vector_t compute_tangent_c(self, vector_t p) nogil
 
 
 cdef class FaceList(object):
     """A group of faces which share a transform"""
     cdef transform_t trans
     cdef transform_t inv_trans
+    cdef object transform_stamp #identifies the VTK transform last synced
     cdef public list faces
     cdef public object owner
 
     cdef int intersect_c(self, ray_t *ray, vector_t end_point, double max_length)
-    cdef orientation_t compute_orientation_c(self, Face face, vector_t point)
+    cdef intersect_batch_c(self, RayCollectionSoA rays)
+    cdef orientation_t compute_orientation_c(self, Face face, vector_t point) nogil
+    cdef orientation_t compute_hit_orientation_c(self, Face face, hit_t *hit) nogil
+
+
+cdef class SceneBVH(object):
+    """A bounding volume hierarchy over the faces of a list of FaceLists"""
+    cdef bvh_node_t *nodes
+    cdef bvh_prim_t *prims
+    cdef void **sets #borrowed FaceList references
+    cdef int *prim_of_face #prim index for each face idx, or -1
+    cdef readonly int n_nodes, n_prims, n_unbounded, n_face_idx
+    cdef readonly list face_sets
+    cdef list faces
+
+    cdef int intersect_range_c(self, int start, int stop, ray_t *ray, 
+                                vector_t ray_end, int *set_idx, hit_t *hit,
+                                int origin_idx) nogil
+    cdef int traverse_c(self, int root, double t_root, ray_t *ray, 
+                        vector_t ray_end, vector_t inv_d, double seg_len, 
+                        int *set_idx, hit_t *hit, int origin_idx) nogil
+    cdef int intersect_c(self, ray_t *ray, vector_t ray_end, int *set_idx, 
+                         hit_t *hit, int origin_idx) nogil
+    cdef int intersect_face_c(self, int face_idx, ray_t *ray, vector_t ray_end,
+                              int *set_idx, hit_t *hit, int origin_idx) nogil
+    cdef void intersect_packet_c(self, ray_t *rays, int n, double max_length,
+                                 int *set_idx, hit_t *hits, int *origin_idx,
+                                 int *face_idx) nogil
 
 
 ##################################
@@ -142,6 +284,33 @@ cdef class FaceList(object):
 cdef RayCollection trace_segment_c(RayCollection rays,
                                     list face_sets,
                                     list all_faces,
-                                    float max_length)
-
-cdef double ray_power_(ray_t ray)
+                                    float max_length,
+                                    SceneBVH bvh=*,
+                                    int num_threads=*,
+                                    RayArena arena=*,
+                                    double min_power=*,
+                                    int roulette=*)
+
+cdef object trace_rays_c(RayCollection rays,
+                        list face_sets,
+                        list all_faces,
+                        float max_length,
+                        int recursion_limit,
+                        SceneBVH bvh=*,
+                        int num_threads=*,
+                        RayArena arena=*,
+                        double min_power=*,
+                        int roulette=*,
+                        HitCacheSink hint=*,
+                        RaySink sink=*)
+
+cdef list trace_sequence_c(RayCollection rays,
+                          list sequence,
+                          list all_faces,
+                          float max_length,
+                          int num_threads=*,
+                          RayArena arena=*,
+                          double min_power=*,
+                          int roulette=*)
+
+cdef double ray_power_(ray_t ray) nogil
@@ -4,7 +4,7 @@
 #cython: nonecheck=False
 #cython: cdivision=True
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     double sqrt(double arg)
     double fabs(double arg)
     double atan2(double y, double x)
@@ -21,10 +21,15 @@ cdef:
     double root2 = sqrt(2.0)
     
 from libc.stdlib cimport malloc, free, realloc
+from cython.parallel cimport prange
+from cpython.buffer cimport PyBUF_WRITABLE, PyBUF_FORMAT, PyBUF_ND, \
+            PyBUF_STRIDES
 
 cdef extern from "stdlib.h" nogil:
     void *memcpy(void *str1, void *str2, size_t n)
+    void *memset(void *str, int c, size_t n)
 
+import os
 import numpy as np
 cimport numpy as np_
 
@@ -37,10 +42,33 @@ ray_dtype = np.dtype([('origin', np.double, (3,)),
                         ('E2_amp', np.complex128),
                         ('length', np.double),
                         ('phase', np.double),
+                        ('optical_path', np.double),
                         ('wavelength_idx', np.uint32),
                         ('parent_idx', np.uint32),
-                        ('end_face_idx', np.uint32)
+                        ('end_face_idx', np.uint32),
+                        ('root_idx', np.uint32)
                         ])
+
+#Smaller record types for keeping traced rays, by retention profile 
+#(see compact_rays). 'full' keeps the ray_dtype records.
+compact_dtypes = {
+    'geometry': np.dtype([('origin', np.float32, (3,)),
+                          ('termination', np.float32, (3,)),
+                          ('parent_idx', np.uint32),
+                          ('end_face_idx', np.uint32)
+                          ]),
+    'power': np.dtype([('origin', np.float32, (3,)),
+                       ('termination', np.float32, (3,)),
+                       ('parent_idx', np.uint32),
+                       ('end_face_idx', np.uint32),
+                       ('power', np.float32),
+                       ('wavelength_idx', np.uint32)
+                       ])
+    }
+
+#PEP-3118 format string for ray_dtype, used by the RayCollection buffer.
+#ray_t is packed, so the fields are unaligned ('^')
+cdef bytes ray_format = b'^' + memoryview(np.zeros(1, dtype=ray_dtype)).format.encode('ascii')
                         
 
 ############################################
@@ -81,14 +109,14 @@ cdef struct transform_t:
 ### Vector maths functions ###
 ##############################
 
-cdef inline vector_t transform_c(transform_t t, vector_t p):
+cdef inline vector_t transform_c(transform_t t, vector_t p) nogil:
     cdef vector_t out
     out.x = p.x*t.m00 + p.y*t.m01 + p.z*t.m02 + t.tx
     out.y = p.x*t.m10 + p.y*t.m11 + p.z*t.m12 + t.ty
     out.z = p.x*t.m20 + p.y*t.m21 + p.z*t.m22 + t.tz
     return out
 
-cdef inline vector_t rotate_c(transform_t t, vector_t p):
+cdef inline vector_t rotate_c(transform_t t, vector_t p) nogil:
     cdef vector_t out
     out.x = p.x*t.m00 + p.y*t.m01 + p.z*t.m02
     out.y = p.x*t.m10 + p.y*t.m11 + p.z*t.m12
@@ -107,7 +135,7 @@ def py_set_v(O):
     v_ = set_v(O)
     return (v_.x, v_.y, v_.z)
 
-cdef inline double sep_(vector_t p1, vector_t p2):
+cdef inline double sep_(vector_t p1, vector_t p2) nogil:
     cdef double a,b
     a = (p2.x-p1.x)
     b = (p2.y-p1.y)
@@ -118,7 +146,7 @@ def sep(a, b):
     cdef vector_t a_ = set_v(a), b_ = set_v(b)
     return sep_(a_, b_)
 
-cdef inline vector_t invert_(vector_t v):
+cdef inline vector_t invert_(vector_t v) nogil:
     v.x = -v.x
     v.y = -v.y
     v.z = -v.z
@@ -129,7 +157,7 @@ def invert(v):
     v_ = invert_(v_)
     return (v_.x, v_.y, v_.z)
 
-cdef inline vector_t multvv_(vector_t a, vector_t b):
+cdef inline vector_t multvv_(vector_t a, vector_t b) nogil:
     cdef vector_t out
     out.x = a.x*b.x
     out.y = a.y*b.y
@@ -143,7 +171,7 @@ def multvv(a, b):
     c_ = multvv_(a_, b_)
     return (c_.x, c_.y, c_.z)
 
-cdef inline vector_t multvs_(vector_t a, double b):
+cdef inline vector_t multvs_(vector_t a, double b) nogil:
     cdef vector_t out
     out.x = a.x*b
     out.y = a.y*b
@@ -156,7 +184,7 @@ def multvs(a, b):
     c_ = multvs_(a_, b)
     return (c_.x, c_.y, c_.z)
 
-cdef inline vector_t addvv_(vector_t a, vector_t b):
+cdef inline vector_t addvv_(vector_t a, vector_t b) nogil:
     cdef vector_t out
     out.x = a.x+b.x
     out.y = a.y+b.y
@@ -170,7 +198,7 @@ def addvv(a, b):
     c_ = addvv_(a_, b_)
     return (c_.x, c_.y, c_.z)
     
-cdef inline vector_t addvs_(vector_t a, double b):
+cdef inline vector_t addvs_(vector_t a, double b) nogil:
     cdef vector_t out
     out.x = a.x+b
     out.y = a.y+b
@@ -183,7 +211,7 @@ def addvs(a, b):
     c_ = addvs_(a_, b)
     return (c_.x, c_.y, c_.z)
 
-cdef inline vector_t subvv_(vector_t a, vector_t b):
+cdef inline vector_t subvv_(vector_t a, vector_t b) nogil:
     cdef vector_t out
     out.x = a.x-b.x
     out.y = a.y-b.y
@@ -197,7 +225,7 @@ def subvv(a, b):
     c_ = subvv_(a_, b_)
     return (c_.x, c_.y, c_.z)
 
-cdef inline vector_t subvs_(vector_t a, double b):
+cdef inline vector_t subvs_(vector_t a, double b) nogil:
     cdef vector_t out
     out.x = a.x-b
     out.y = a.y-b
@@ -210,7 +238,7 @@ def subvs(a, b):
     c_ = subvs_(a_, b)
     return (c_.x, c_.y, c_.z)
 
-cdef inline double mag_(vector_t a):
+cdef inline double mag_(vector_t a) nogil:
     return sqrt(a.x*a.x + a.y*a.y + a.z*a.z)
 
 def mag(a):
@@ -218,7 +246,7 @@ def mag(a):
     a_ = set_v(a)
     return mag_(a_)
 
-cdef inline double mag_sq_(vector_t a):
+cdef inline double mag_sq_(vector_t a) nogil:
     return a.x*a.x + a.y*a.y + a.z*a.z
 
 def mag_sq(a):
@@ -226,7 +254,7 @@ def mag_sq(a):
     a_ = set_v(a)
     return mag_sq_(a_)
 
-cdef inline double dotprod_(vector_t a, vector_t b):
+cdef inline double dotprod_(vector_t a, vector_t b) nogil:
     return a.x*b.x + a.y*b.y + a.z*b.z
 
 def dotprod(a, b):
@@ -235,7 +263,7 @@ def dotprod(a, b):
     b_ = set_v(b)
     return dotprod_(a_,b_)
 
-cdef inline vector_t cross_(vector_t a, vector_t b):
+cdef inline vector_t cross_(vector_t a, vector_t b) nogil:
     cdef vector_t c
     c.x = a.y*b.z - a.z*b.y
     c.y = a.z*b.x - a.x*b.z
@@ -249,7 +277,7 @@ def cross(a, b):
     c_ = cross_(a_, b_)
     return (c_.x, c_.y, c_.z)
 
-cdef vector_t norm_(vector_t a):
+cdef vector_t norm_(vector_t a) nogil:
     cdef double mag=sqrt(a.x*a.x + a.y*a.y + a.z*a.z)
     a.x /= mag
     a.y /= mag
@@ -296,6 +324,26 @@ cdef class Transform:
             return (self.trans.tx, self.trans.ty, self.trans.tz)
 
 
+cdef object transform_stamp_(object vtk_trans):
+    """Returns a value which changes whenever the given VTK transform
+    is modified or replaced, or None if this can't be determined
+    """
+    try:
+        return (vtk_trans, vtk_trans.m_time)
+    except AttributeError:
+        return None
+    
+    
+cdef tuple vtk_transforms_(object vtk_trans):
+    """Converts a VTK linear transform to a (transform, inverse_transform)
+    pair of Transform objects
+    """
+    m = np.asarray(vtk_trans.matrix.to_array(), dtype=np.double)
+    inv = np.linalg.inv(m)
+    return (Transform(rotation=m[:3,:3], translation=m[:3,3]),
+            Transform(rotation=inv[:3,:3], translation=inv[:3,3]))
+
+
 cdef class RayCollectionIterator:        
     def __cinit__(self, RayCollection rays):
         self.rays = rays
@@ -453,6 +501,27 @@ cdef class Ray:
         def __set__(self, int v):
             self.ray.end_face_idx = v
             
+    property root_idx:
+        """Index of the input ray this ray descends from, set by
+        the tracer
+        """
+        def __get__(self):
+            return self.ray.root_idx
+        
+        def __set__(self, int v):
+            self.ray.root_idx = v
+            
+    property optical_path:
+        """The optical path length (sum of length*n.real) from the
+        origin of the input ray to the origin of this ray, set by 
+        the tracer
+        """
+        def __get__(self):
+            return self.ray.optical_path
+        
+        def __set__(self, double v):
+            self.ray.optical_path = v
+            
     property power:
         """Optical power for the ray"""
         def __get__(self):
@@ -564,6 +633,14 @@ cdef class Ray:
         
 
 cdef class RayCollection:
+    """A growable array of rays. 
+    
+    numpy.asarray(rays) gives a writable ray_dtype view of the ray memory,
+    and the field properties (origin, direction, length etc.) are writable
+    views into it rather than copies: assigning to their elements changes 
+    the rays. Use copy_as_array() for a snapshot. While any view exists, 
+    the collection can't grow, since that could move the memory.
+    """
     
     def __cinit__(self, size_t max_size):
         self.rays = <ray_t*>malloc(max_size*sizeof(ray_t))
@@ -571,21 +648,49 @@ cdef class RayCollection:
         self.max_size = max_size
         
     def __dealloc__(self):
-        free(self.rays)
+        if self.block is None:
+            free(self.rays)
+        else:
+            self.block.n_users -= 1
         
     def __len__(self):
         return self.n_rays
         
-    cdef add_ray_c(self, ray_t r):
+    cdef void add_ray_c(self, ray_t r) nogil:
         if self.n_rays == self.max_size:
-            if self.max_size == 0:
-                self.max_size = 1
-            else:
-                self.max_size *= 2
-            self.rays = <ray_t*>realloc(self.rays, self.max_size*sizeof(ray_t))
+            if not self.resize_c(max(2*self.max_size, 1)):
+                return
         self.rays[self.n_rays] = r
         self.n_rays += 1
         
+    cdef int resize_c(self, size_t max_size) nogil:
+        """Changes the capacity of the collection. If the rays are held in 
+        a RayArena block, they're moved out into memory owned by the collection.
+        
+        Moving the rays would leave any exported array views dangling, so 
+        callers must call check_resizable() with the GIL held before adding
+        rays: the Python entry points do, and the tracer checks its 
+        collections before releasing the GIL. Should views exist anyway, 
+        the collection is left unchanged, a BufferError is reported as 
+        unraisable and 0 is returned.
+        """
+        cdef ray_t *rays
+        if self.n_exports > 0:
+            with gil:
+                raise BufferError("Can't resize a RayCollection while array views of it exist")
+        if self.block is None:
+            self.rays = <ray_t*>realloc(self.rays, max_size*sizeof(ray_t))
+        else:
+            rays = <ray_t*>malloc(max_size*sizeof(ray_t))
+            memcpy(rays, self.rays, min(self.n_rays, max_size)*sizeof(ray_t))
+            self.rays = rays
+            with gil:
+                self.block.n_users -= 1
+                self.block = None
+        self.max_size = max_size
+        self.n_rays = min(self.n_rays, max_size)
+        return 1
+        
     def reset_length(self):
         """Sets the length of all rays in this RayCollection to Infinity
         """
@@ -593,15 +698,21 @@ cdef class RayCollection:
         for i in xrange(self.n_rays):
             self.rays[i].length = INF
         
+    cdef check_resizable(self):
+        if self.n_exports > 0:
+            raise BufferError("Can't add rays to a RayCollection while array views of it exist")
+        
     def add_ray(self, Ray r):
         """Adds the given Ray instance to this collection
         """
+        self.check_resizable()
         self.add_ray_c(r.ray)
         
     def add_ray_list(self, list rays):
         """Adds the given list of Rays to this collection
         """
         cdef int i
+        self.check_resizable()
         for i in xrange(len(rays)):
             if not isinstance(rays[i], Ray):
                 raise TypeError("ray list contains non-Ray instance at index %d"%i)
@@ -643,178 +754,109 @@ cdef class RayCollection:
     
     def copy_as_array(self):
         """Returns the contents of this RayCollection as a numpy array
-        (the data is always copied).
+        (the data is always copied). Use numpy.asarray(rays) to get a view 
+        of the rays without copying.
         """
         cdef np_.ndarray out = np.empty(self.n_rays, dtype=ray_dtype)
         memcpy(<np_.float64_t *>out.data, self.rays, self.n_rays*sizeof(ray_t))
         return out
     
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        """Exposes the rays as a 1D buffer of ray_dtype records, writable
+        only if a writable buffer is requested. Rays can't be added while 
+        the buffer is in use, since this may move the data.
+        """
+        cdef Py_ssize_t *shape = <Py_ssize_t*>malloc(2*sizeof(Py_ssize_t))
+        if shape is NULL:
+            raise MemoryError()
+        shape[0] = self.n_rays
+        shape[1] = sizeof(ray_t)
+        buffer.buf = <void*>self.rays
+        buffer.obj = self
+        buffer.len = self.n_rays*sizeof(ray_t)
+        buffer.readonly = 0 if (flags & PyBUF_WRITABLE) == PyBUF_WRITABLE else 1
+        buffer.itemsize = sizeof(ray_t)
+        buffer.format = NULL
+        if (flags & PyBUF_FORMAT) == PyBUF_FORMAT:
+            buffer.format = ray_format
+        buffer.ndim = 1
+        buffer.shape = shape if (flags & PyBUF_ND) == PyBUF_ND else NULL
+        buffer.strides = shape + 1 if (flags & PyBUF_STRIDES) == PyBUF_STRIDES else NULL
+        buffer.suboffsets = NULL
+        buffer.internal = <void*>shape
+        self.n_exports += 1
+        
+    def __releasebuffer__(self, Py_buffer *buffer):
+        free(buffer.internal)
+        self.n_exports -= 1
+    
     property origin:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,3), dtype='d')
-                int i
-                vector_t v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].origin
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return np.asarray(self)['origin']
         
     property direction:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,3), dtype='d')
-                int i
-                vector_t v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].direction
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return np.asarray(self)['direction']
         
     property normal:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,3), dtype='d')
-                int i
-                vector_t v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].normal
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return np.asarray(self)['normal']
         
     property E_vector:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,3), dtype='d')
-                int i
-                vector_t v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].E_vector
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            return np.asarray(self)['E_vector']
         
     property refractive_index:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype=np.complex128)
-                np_.ndarray rr,ii
-                int i
-                complex_t n
-            rr = out.real
-            ii = out.imag
-            for i in xrange(self.n_rays):
-                n = self.rays[i].refractive_index
-                rr[i] = n.real
-                ii[i] = n.imag
-            return out
+            return np.asarray(self)['refractive_index']
         
     property E1_amp:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype=np.complex128)
-                np_.ndarray rr,ii
-                int i
-                complex_t n
-            rr = out.real
-            ii = out.imag
-            for i in xrange(self.n_rays):
-                n = self.rays[i].E1_amp
-                rr[i] = n.real
-                ii[i] = n.imag
-            return out
+            return np.asarray(self)['E1_amp']
         
     property E2_amp:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype=np.complex128)
-                np_.ndarray rr,ii
-                int i
-                complex_t n
-            rr = out.real
-            ii = out.imag
-            for i in xrange(self.n_rays):
-                n = self.rays[i].E2_amp
-                rr[i] = n.real
-                ii[i] = n.imag
-            return out
+            return np.asarray(self)['E2_amp']
         
     property length:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype='d')
-                int i
-                double v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].length
-                out[i] = v
-            return out
+            return np.asarray(self)['length']
         
     property phase:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype='d')
-                int i
-                double v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].phase
-                out[i] = v
-            return out
+            return np.asarray(self)['phase']
         
     property wavelength_idx:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype=np.uint32)
-                int i
-                double v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].wavelength_idx
-                out[i] = v
-            return out
+            return np.asarray(self)['wavelength_idx']
         
     property parent_idx:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype=np.uint32)
-                int i
-                unsigned int v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].parent_idx
-                out[i] = v
-            return out
+            return np.asarray(self)['parent_idx']
         
     property end_face_idx:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty(self.n_rays, dtype=np.uint32)
-                int i
-                unsigned int v
-            for i in xrange(self.n_rays):
-                v = self.rays[i].end_face_idx
-                out[i] = v
-            return out
+            return np.asarray(self)['end_face_idx']
+        
+    property root_idx:
+        def __get__(self):
+            return np.asarray(self)['root_idx']
+        
+    property optical_path:
+        def __get__(self):
+            return np.asarray(self)['optical_path']
+            
+    property total_optical_path:
+        """The optical path from the origin of each ray's input ray to
+        the end of the ray"""
+        def __get__(self):
+            cdef np_.ndarray data = np.asarray(self)
+            return data['optical_path'] + data['length']*data['refractive_index'].real
         
     property termination:
         def __get__(self):
-            cdef:
-                np_.ndarray out = np.empty((self.n_rays,3), dtype='d')
-                int i
-                vector_t v
-            for i in xrange(self.n_rays):
-                v = addvv_(self.rays[i].origin, 
-                           multvs_(self.rays[i].direction, 
-                                    self.rays[i].length))
-                out[i,0] = v.x
-                out[i,1] = v.y
-                out[i,2] = v.z
-            return out
+            cdef np_.ndarray data = np.asarray(self)
+            return data['origin'] + data['direction']*data['length'][:,None]
     
     @classmethod
     def from_array(cls, np_.ndarray data):
@@ -829,22 +871,510 @@ cdef class RayCollection:
         rc.n_rays = size
         return rc
         
+
+cdef class RayBlock:
+    def __cinit__(self, size_t size):
+        self.rays = <ray_t*>malloc(max(size,1)*sizeof(ray_t))
+        if self.rays is NULL:
+            raise MemoryError()
+        self.size = size
+        
+    def __dealloc__(self):
+        free(self.rays)
+        
+        
+cdef class RayArena:
+    """Provides the memory for the RayCollections produced by tracing. 
+    Successive generations are allocated as slices of large blocks, and a 
+    block is reused once all the RayCollections using it have been 
+    released, so an arena kept across traces avoids most of the 
+    malloc/realloc traffic. The per-chunk scratch collections used by the 
+    tracer are also kept for reuse. An arena must not be shared between 
+    concurrent traces.
+    """
+    def __cinit__(self, size_t block_size=16384):
+        self.blocks = []
+        self.scratch = []
+        self.block_size = block_size
+        
+    cdef RayCollection allocate_c(self, size_t n_rays, size_t reserve):
+        """Returns an empty RayCollection with space for n_rays, held in an
+        arena block. If a new block is needed, it has space for at least 
+        reserve rays.
+        """
+        cdef:
+            RayBlock blk=self.current, b
+            RayCollection rc
+            
+        if blk is not None and blk.n_users == 0:
+            blk.used = 0
+        if blk is None or blk.size - blk.used < n_rays:
+            blk = None
+            for b in self.blocks:
+                if b.n_users == 0 and b.size >= n_rays:
+                    blk = b
+                    blk.used = 0
+                    break
+            if blk is None:
+                blk = RayBlock(max(n_rays, reserve, self.block_size))
+                self.blocks.append(blk)
+            self.current = blk
+            
+        rc = RayCollection(0)
+        free(rc.rays)
+        rc.rays = blk.rays + blk.used
+        rc.max_size = n_rays
+        rc.block = blk
+        blk.n_users += 1
+        blk.used += n_rays
+        return rc
+    
+    def allocate(self, size_t n_rays):
+        """Returns an empty RayCollection with space for n_rays, held in the
+        arena's memory
+        """
+        return self.allocate_c(n_rays, 0)
+    
+    cdef list scratch_c(self, size_t n, size_t capacity):
+        """Returns a list of n empty RayCollections, each with space for at 
+        least capacity rays. The collections are reused by later calls.
+        """
+        cdef RayCollection rc
+        while len(self.scratch) < n:
+            self.scratch.append(RayCollection(capacity))
+        for rc in self.scratch[:n]:
+            rc.n_rays = 0
+            if rc.max_size < capacity:
+                rc.resize_c(capacity)
+        return self.scratch[:n]
+    
+    def clear(self):
+        """Releases the arena's blocks and scratch memory. Blocks still used
+        by a RayCollection are freed along with the last such collection.
+        """
+        self.blocks = []
+        self.scratch = []
+        self.current = None
+        
+    property capacity:
+        """The total number of rays held by the arena's blocks"""
+        def __get__(self):
+            cdef RayBlock b
+            return sum([b.size for b in self.blocks])
+    
+    
+cdef class RayCollectionSoA:
+    """A structure-of-arrays copy of the geometry of a RayCollection. The
+    origin and direction are held as (3,N) arrays, so each coordinate is 
+    contiguous in memory. The batch intersection methods of FaceList and 
+    Face operate on this layout. The tracer doesn't use it: trace_rays 
+    intersects each ray through the SceneBVH.
+    """
+    def __cinit__(self, size_t n_rays):
+        self.n_rays = n_rays
+        self.origin = np.zeros((3,n_rays), dtype=np.float64)
+        self.direction = np.zeros((3,n_rays), dtype=np.float64)
+        self.length = np.empty(n_rays, dtype=np.float64)
+        self.length.fill(INF)
+        self.end_face_idx = np.empty(n_rays, dtype=np.intc)
+        self.end_face_idx.fill(-1)
+        
+    def __len__(self):
+        return self.n_rays
+        
+    cdef ray_soa_t soa_c(self):
+        cdef ray_soa_t soa
+        cdef double *o = <double *>(<np_.ndarray>self.origin).data
+        cdef double *d = <double *>(<np_.ndarray>self.direction).data
+        soa.ox, soa.oy, soa.oz = o, o + self.n_rays, o + 2*self.n_rays
+        soa.dx, soa.dy, soa.dz = d, d + self.n_rays, d + 2*self.n_rays
+        soa.n = self.n_rays
+        return soa
+        
+    @classmethod
+    def from_collection(cls, RayCollection rays):
+        """Creates a RayCollectionSoA from the origin, direction, length
+        and end_face_idx of the given RayCollection
+        """
+        cdef:
+            size_t i, n=rays.n_rays
+            RayCollectionSoA out = cls(n)
+            ray_soa_t soa = out.soa_c()
+            double[:] length = out.length
+            int[:] end_face_idx = out.end_face_idx
+            ray_t *ray
+        for i in range(n):
+            ray = rays.rays + i
+            soa.ox[i], soa.oy[i], soa.oz[i] = ray.origin.x, ray.origin.y, ray.origin.z
+            soa.dx[i], soa.dy[i], soa.dz[i] = ray.direction.x, ray.direction.y, ray.direction.z
+            length[i] = ray.length
+            end_face_idx[i] = <int>ray.end_face_idx
+        return out
+    
+    def to_collection(self, RayCollection rays=None):
+        """Writes the ray geometry back to a RayCollection. If rays is 
+        given, it must hold the same number of rays and only the origin, 
+        direction, length and end_face_idx of each ray are updated. 
+        Otherwise a new RayCollection is returned, with the remaining 
+        fields zeroed.
+        """
+        cdef:
+            size_t i, n=self.n_rays
+            ray_soa_t soa = self.soa_c()
+            double[:] length = self.length
+            int[:] end_face_idx = self.end_face_idx
+            ray_t *ray
+        if rays is None:
+            rays = RayCollection(n)
+            memset(rays.rays, 0, n*sizeof(ray_t))
+            rays.n_rays = n
+        elif rays.n_rays != n:
+            raise ValueError("RayCollection holds %d rays, expected %d"%(rays.n_rays, n))
+        for i in range(n):
+            ray = rays.rays + i
+            ray.origin.x, ray.origin.y, ray.origin.z = soa.ox[i], soa.oy[i], soa.oz[i]
+            ray.direction.x, ray.direction.y, ray.direction.z = soa.dx[i], soa.dy[i], soa.dz[i]
+            ray.length = length[i]
+            ray.end_face_idx = <unsigned int>end_face_idx[i]
+        return rays
+    
+    
+def ray_power(rays):
+    """The power of each ray in a RayCollection or ray_dtype array"""
+    rays = np.asarray(rays)
+    n = rays['refractive_index'].real
+    return n*(abs(rays['E1_amp'])**2 + abs(rays['E2_amp'])**2)
+    
+    
+cdef class RaySink:
+    """Receives the rays of a trace one generation at a time, so results 
+    can be accumulated without keeping every generation in memory. Pass a
+    sink to trace_rays and override add_generation and finish.
+    """
+    def add_generation(self, RayCollection rays, RayCollection children):
+        """Called as each generation is traced. The rays have their length
+        and end_face_idx set. children are the rays they create, which 
+        are traced next; their parent_idx index rays. children is None 
+        when a list of traced rays is replayed into the sink.
+        """
+        pass
+    
+    def finish(self):
+        """Called at the end of the trace.
+        
+        returns - the result of the trace
+        """
+        return None
+    
+    def replay(self, list traced_rays):
+        """Passes the generations of a completed trace to the sink
+        
+        returns - the result of finish()
+        """
+        for rays in traced_rays:
+            self.add_generation(rays, None)
+        return self.finish()
+    
+    
+cdef class KeepAllSink(RaySink):
+    """Keeps every generation, so the result is the list of traced 
+    RayCollections, as returned by trace_rays without a sink
+    """
+    def __cinit__(self):
+        self.traced_rays = []
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        self.traced_rays.append(rays)
+        
+    def finish(self):
+        cdef int i
+        for i in xrange(1, len(self.traced_rays)):
+            self.traced_rays[i].parent = self.traced_rays[i-1]
+        return list(self.traced_rays)
+    
+    
+cdef class TerminalRaySink(RaySink):
+    """Keeps only the terminal rays, those which create no child rays. The
+    result is a RayCollection of these rays, in order of generation. 
+    Their parent_idx no longer refers to anything, but root_idx still 
+    gives the input ray each came from.
+    """
+    def __cinit__(self):
+        self.terminal = []
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        arr = np.asarray(rays)
+        mask = np.ones(len(arr), dtype=bool)
+        if children is not None and children.n_rays:
+            mask[np.asarray(children)['parent_idx']] = False
+        self.terminal.append(arr[mask])
+        
+    def finish(self):
+        out = np.empty(sum([len(a) for a in self.terminal]), dtype=ray_dtype)
+        if self.terminal:
+            out[:] = np.concatenate(self.terminal)
+        return RayCollection.from_array(out)
+    
+    
+cdef class GenerationFileSink(RaySink):
+    """Writes each generation to a .npy file in the given directory, which
+    is created if needed. The result is the list of file names. Use 
+    load() to read a generation back, as a memory-mapped array.
+    """
+    def __cinit__(self, directory):
+        self.directory = directory
+        self.filenames = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        name = os.path.join(self.directory, 
+                            "generation_%04d.npy"%len(self.filenames))
+        np.save(name, np.asarray(rays))
+        self.filenames.append(name)
+        
+    def finish(self):
+        return list(self.filenames)
+    
+    def load(self, int generation, mmap_mode='r'):
+        """Reads back the given generation, as a ray_dtype array"""
+        return np.load(self.filenames[generation], mmap_mode=mmap_mode)
+    
+    
+def compact_rays(rays, profile):
+    """Copies a RayCollection (or ray_dtype array) into the smaller record
+    type compact_dtypes[profile]. The 'geometry' profile keeps the single
+    precision end points of each ray with its parent_idx and end_face_idx; 
+    'power' also keeps its power and wavelength_idx.
+    
+    returns - a structured array of the compacted rays
+    """
+    arr = np.asarray(rays)
+    out = np.empty(len(arr), dtype=compact_dtypes[profile])
+    out['origin'] = arr['origin']
+    out['termination'] = arr['origin'] + arr['direction']*arr['length'][:,None]
+    out['parent_idx'] = arr['parent_idx']
+    out['end_face_idx'] = arr['end_face_idx']
+    if profile == 'power':
+        out['power'] = ray_power(arr)
+        out['wavelength_idx'] = arr['wavelength_idx']
+    return out
+    
+    
+cdef class CompactRaySink(RaySink):
+    """Keeps every generation, compacted into the record type for the 
+    given profile (see compact_rays). The result is the list of compacted
+    arrays. For big traces, this needs a fraction of the memory of 
+    KeepAllSink.
+    """
+    def __cinit__(self, profile='geometry'):
+        if profile not in compact_dtypes:
+            raise ValueError("Unknown retention profile %r"%(profile,))
+        self.profile = profile
+        self.generations = []
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        self.generations.append(compact_rays(rays, self.profile))
+        
+    def finish(self):
+        return list(self.generations)
+    
+    
+cdef class LastGenerationSink(RaySink):
+    """Keeps a copy of the last generation traced, for results which only
+    look at the final rays. Only the latest generation is referenced while
+    tracing; it is copied once, by finish. The result is a RayCollection, 
+    or None if no rays were traced.
+    """
+    def add_generation(self, RayCollection rays, RayCollection children):
+        self.rays = rays
+        
+    def finish(self):
+        if self.rays is not None:
+            #copy, so the arena block holding the rays can be reused
+            self.last = self.rays.copy_as_array()
+            self.rays = None
+        if self.last is None:
+            return None
+        return RayCollection.from_array(self.last)
+    
+    
+cdef class FaceTally(RaySink):
+    """Accumulates the number of rays ending on each face, and their total
+    power, indexed by face idx. The power of the input rays (the first 
+    generation) is also kept.
+    """
+    def __cinit__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.power = np.zeros(0, dtype=np.float64)
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        arr = np.asarray(rays)
+        P = ray_power(arr)
+        if self.n_generations == 0:
+            self.input_power = P.sum()
+        self.n_generations += 1
+        idx = arr['end_face_idx']
+        hit = idx < 0xFFFFFFFF
+        counts = np.bincount(idx[hit])
+        power = np.bincount(idx[hit], weights=P[hit])
+        n = max(len(counts), len(self.counts))
+        self.counts = np.pad(self.counts, (0, n - len(self.counts)), 'constant')
+        self.counts[:len(counts)] += counts
+        self.power = np.pad(self.power, (0, n - len(self.power)), 'constant')
+        self.power[:len(power)] += power
+        
+    def finish(self):
+        return self
+    
+    def face_count(self, int idx, int n_idx=1):
+        """The number of rays which ended on the face with the given idx.
+        For a face with several idx values, give its n_idx to count the 
+        rays ending on any of them.
+        """
+        if idx < 0:
+            return 0
+        return int(self.counts[idx:idx+n_idx].sum())
+    
+    def face_power(self, int idx, int n_idx=1):
+        """The total power of the rays which ended on the face with the 
+        given idx, or on any of its n_idx values
+        """
+        if idx < 0:
+            return 0.0
+        return float(self.power[idx:idx+n_idx].sum())
+    
+    
+cdef class HitCacheSink(RaySink):
+    """Records the face each ray ended on, with its parent_idx, so a later 
+    trace of the same source can test these faces first (see trace_rays).
+    Only two integers are kept per ray, whatever else the trace keeps.
+    
+    Rays are matched to their counterpart in the recorded trace by 
+    ancestry rather than position: an input ray by its index, and a child 
+    by the counterpart of its parent and its place among its siblings. 
+    Materials create the children of each hit together, so this survives
+    changes in the order of the hits.
+    """
+    def __cinit__(self):
+        self.parent_idx = []
+        self.end_face_idx = []
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        arr = np.asarray(rays)
+        self.parent_idx.append(arr['parent_idx'].astype(np.intp))
+        self.end_face_idx.append(arr['end_face_idx'].astype(np.intc))
+        
+    def finish(self):
+        return self
+    
+    property n_generations:
+        def __get__(self):
+            return len(self.end_face_idx)
+    
+    def match(self, int generation, RayCollection rays, parent_match=None):
+        """Finds the counterparts of the given generation of rays, whose 
+        parents' counterparts are parent_match (ignored for the input rays). 
+        
+        returns - (faces, match): the face to test first for each ray, or
+                  -1, and the index of its counterpart in the recorded 
+                  generation, or -1. Both are None if the generation wasn't
+                  recorded.
+        """
+        if generation >= len(self.end_face_idx):
+            return None, None
+        ends = self.end_face_idx[generation]
+        n = rays.n_rays
+        if generation == 0:
+            match = np.arange(n)
+        elif parent_match is None:
+            return None, None
+        else:
+            pidx = np.asarray(rays)['parent_idx'].astype(np.intp)
+            ordinal = sibling_ordinal_(pidx)
+            cached = self.parent_idx[generation]
+            n_parents = len(self.end_face_idx[generation-1])
+            first = np.full(n_parents, -1, np.intp)
+            counts = np.zeros(n_parents, np.intp)
+            cached_ordinal = sibling_ordinal_(cached)
+            heads = cached_ordinal == 0
+            first[cached[heads]] = np.flatnonzero(heads)
+            np.add.at(counts, cached, 1)
+            cp = np.asarray(parent_match)[pidx]
+            ok = cp >= 0
+            ok[ok] = ordinal[ok] < counts[cp[ok]]
+            match = np.full(n, -1, np.intp)
+            match[ok] = first[cp[ok]] + ordinal[ok]
+        match[match >= len(ends)] = -1
+        faces = np.full(n, -1, np.intc)
+        faces[match >= 0] = ends[match[match >= 0]]
+        return faces, match
+    
+    
+def sibling_ordinal_(parent_idx):
+    """The place of each ray among the consecutive rays with the same 
+    parent_idx
+    """
+    n = len(parent_idx)
+    if n == 0:
+        return np.zeros(0, np.intp)
+    pos = np.arange(n)
+    head = np.ones(n, bool)
+    head[1:] = parent_idx[1:] != parent_idx[:-1]
+    return pos - np.maximum.accumulate(np.where(head, pos, 0))
+    
+    
+cdef class SinkGroup(RaySink):
+    """Passes the rays on to several sinks. The result is that of the 
+    first sink.
+    """
+    def __cinit__(self, sinks):
+        self.sinks = list(sinks)
+        
+    def add_generation(self, RayCollection rays, RayCollection children):
+        for sink in self.sinks:
+            sink.add_generation(rays, children)
+            
+    def finish(self):
+        results = [sink.finish() for sink in self.sinks]
+        return results[0] if results else None
+    
     
 cdef class InterfaceMaterial(object):
     """Abstract base class for objects describing
     the materials characterics of a Face
     """
     
+    #the most child rays eval_child_ray_c creates for one hit. Used to 
+    #size the tracer's ray buffers
+    max_children = 1
+    
+    #true if eval_child_ray_c looks up the wavelength of each ray, so the 
+    #wavelengths must be set before tracing
+    uses_wavelengths = False
+    
     def __cinit__(self):
         self.wavelengths = np.array([], dtype=np.double)
     
-    cdef eval_child_ray_c(self, ray_t *old_ray, 
+    cdef void eval_child_ray_c(self, ray_t *old_ray, 
                                 unsigned int ray_idx, 
                                 vector_t p, 
                                 orientation_t orient,
-                                RayCollection new_rays):
+                                RayCollection new_rays) nogil:
         pass
     
+    cdef void eval_children_batch_c(self, ray_t *rays, surface_hit_t *hits,
+                                    size_t n, RayCollection new_rays) nogil:
+        """Evaluates the child rays for n hits on faces of this material,
+        as eval_child_ray_c does for each hit, in order. The hit ray_idx
+        index rays. Materials can override this to set up the calculation
+        once for the whole batch.
+        """
+        cdef size_t i
+        for i in range(n):
+            self.eval_child_ray_c(rays + hits[i].ray_idx, hits[i].ray_idx,
+                                  hits[i].point, hits[i].orient, new_rays)
+    
     def eval_child_ray(self, Ray old_ray, ray_idx, point, 
                         normal, tangent, RayCollection new_rays):
         cdef:
@@ -853,12 +1383,37 @@ cdef class InterfaceMaterial(object):
             Ray out=Ray()
             unsigned int idx
         
+        new_rays.check_resizable()
         p = set_v(point)
         n.normal = set_v(normal)
         n.tangent = set_v(tangent)
         self.eval_child_ray_c(&old_ray.ray, ray_idx, 
                                         p, n, new_rays)
         
+    def eval_children_batch(self, RayCollection rays, ray_idx, points, 
+                            normals, tangents, RayCollection new_rays):
+        """Evaluates the children for a batch of hits. ray_idx gives the 
+        index in rays of the ray for each hit; points, normals and tangents
+        are (N,3) arrays.
+        """
+        cdef:
+            size_t i, n=len(ray_idx)
+            surface_hit_t *hits
+        new_rays.check_resizable()
+        hits = <surface_hit_t*>malloc(max(n,1)*sizeof(surface_hit_t))
+        try:
+            for i in range(n):
+                if not 0 <= ray_idx[i] < rays.n_rays:
+                    raise IndexError("ray index %d out of range"%ray_idx[i])
+                hits[i].ray_idx = ray_idx[i]
+                hits[i].face_idx = -1
+                hits[i].point = set_v(points[i])
+                hits[i].orient.normal = set_v(normals[i])
+                hits[i].orient.tangent = set_v(tangents[i])
+            self.eval_children_batch_c(rays.rays, hits, n, new_rays)
+        finally:
+            free(hits)
+        
     property wavelengths:
         def __set__(self, double[:] wavelengths):
             self._wavelengths = wavelengths
@@ -875,6 +1430,10 @@ cdef class Face(object):
     
     params = []
     
+    #the number of consecutive idx values, from idx, which the face uses
+    #for end_face_idx. See hit_idx_c.
+    n_idx = 1
+    
     def __cinit__(self, owner=None, tolerance=0.0001, 
                         max_length=100, material=None, **kwds):
         self.name = "base Face class"
@@ -887,14 +1446,80 @@ cdef class Face(object):
             from raytrace.cmaterials import PECMaterial
             self.material = PECMaterial()
         self.invert_normal = int(kwds.get('invert_normal', 0))
+        self.planar = 0
         
     
-    cdef double intersect_c(self, vector_t p1, vector_t p2):
+    cdef double intersect_c(self, vector_t p1, vector_t p2, hit_t *hit) nogil:
         """returns the distance of the nearest valid intersection between 
-        p1 and p2. p1 and p2 are in the local coordinate system
+        p1 and p2. p1 and p2 are in the local coordinate system. Faces can
+        store anything their normal calculation will need in hit.param; the
+        caller fills in hit.dist and hit.point for the nearest intersection.
         """
         return 0
     
+    cdef void intersect_batch_c(self, ray_soa_t segs, double *dist) nogil:
+        """Intersects a batch of ray segments with the face, writing the 
+        distance to each intersection (or 0 for a miss) into dist. The 
+        segments run from (ox,oy,oz) to (ox+dx,oy+dy,oz+dz) in the local 
+        coordinate system. Faces can override this with a loop over the
+        coordinate arrays.
+        """
+        cdef:
+            size_t i
+            vector_t p1, p2
+            hit_t hit
+        for i in range(segs.n):
+            p1.x, p1.y, p1.z = segs.ox[i], segs.oy[i], segs.oz[i]
+            p2.x, p2.y, p2.z = p1.x+segs.dx[i], p1.y+segs.dy[i], p1.z+segs.dz[i]
+            dist[i] = self.intersect_c(p1, p2, &hit)
+    
+    cdef aabb_t bounds_c(self):
+        """returns the axis-aligned bounding box of the face, in the local
+        coordinate system. The default is an unbounded box, which faces can 
+        override to make use of the SceneBVH
+        """
+        cdef aabb_t b
+        b.lower.x = b.lower.y = b.lower.z = -INF
+        b.upper.x = b.upper.y = b.upper.z = INF
+        return b
+    
+    cdef int face_params_c(self, double *params):
+        """Returns the FACE_* tag under which the SceneBVH can intersect this
+        face directly, filling in params (up to 4 values) for it. The 
+        default, FACE_GENERIC, means intersect_c is called. The parameters 
+        are copied when the SceneBVH is built.
+        """
+        return FACE_GENERIC
+    
+    cdef int hit_idx_c(self, hit_t *hit) nogil:
+        """Returns the idx to record in end_face_idx for an intersection
+        found by intersect_c. Faces made of several parts (with n_idx > 1)
+        return idx plus the part which was hit, so the global face list 
+        must hold the face at each of these positions.
+        """
+        return self.idx
+    
+    def idx_range(self):
+        """Returns the range of end_face_idx values which refer to this 
+        face, idx to idx+n_idx-1
+        """
+        return range(self.idx, self.idx + self.n_idx)
+    
+    def owns_idx(self, end_face_idx):
+        """True where the given end_face_idx (a value or an array) refers
+        to this face, i.e. idx <= end_face_idx < idx+n_idx
+        """
+        end_face_idx = np.asarray(end_face_idx)
+        return (end_face_idx >= self.idx) & (end_face_idx < self.idx + self.n_idx)
+    
+    def bounds(self):
+        """Returns the bounding box of the face as a pair of (lower, upper)
+        corner points, in local coordinates
+        """
+        cdef aabb_t b = self.bounds_c()
+        return ((b.lower.x, b.lower.y, b.lower.z), 
+                (b.upper.x, b.upper.y, b.upper.z))
+    
     def update(self):
         """Called to update the parameters from the owner
         to the Face
@@ -907,16 +1532,41 @@ cdef class Face(object):
         cdef:
             vector_t p1_, p2_
             double dist
+            hit_t hit
         
         p1_ = set_v(p1)
         p2_ = set_v(p2)
-        dist = self.intersect_c(p1_, p2_)
+        dist = self.intersect_c(p1_, p2_, &hit)
+        return dist
+    
+    def intersect_batch(self, p1, p2):
+        """Intersects the segments between each pair of points in the (N,3)
+        arrays p1 and p2 (in local coordinates). Returns an array of the 
+        distances to the intersections, with 0 for a miss.
+        """
+        cdef:
+            RayCollectionSoA segs
+            np_.ndarray dist
+        p1 = np.asarray(p1, dtype=np.float64).reshape(-1,3)
+        p2 = np.asarray(p2, dtype=np.float64).reshape(-1,3)
+        segs = RayCollectionSoA(p1.shape[0])
+        segs.origin[...] = p1.T
+        segs.direction[...] = (p2 - p1).T
+        dist = np.zeros(p1.shape[0], dtype=np.float64)
+        self.intersect_batch_c(segs.soa_c(), <double *>dist.data)
         return dist
 
-    cdef vector_t compute_normal_c(self, vector_t p):
+    cdef vector_t compute_normal_c(self, vector_t p) nogil:
         return p
     
-    cdef vector_t compute_tangent_c(self, vector_t p):
+    cdef vector_t compute_normal_hit_c(self, hit_t *hit) nogil:
+        """Computes the normal at an intersection found by intersect_c. 
+        Faces which store data in hit.param override this to avoid 
+        recomputing it from the point.
+        """
+        return self.compute_normal_c(hit.point)
+    
+    cdef vector_t compute_tangent_c(self, vector_t p) nogil:
         cdef vector_t tangent
         tangent.x = 1.0
         tangent.y = 0.0
@@ -951,27 +1601,24 @@ cdef class FaceList(object):
         self.owner = owner
         
     def sync_transforms(self):
-        """sets the transforms from the owner's VTKTransform
+        """sets the transforms from the owner's VTKTransform. The transforms
+        are only rebuilt if the VTKTransform has changed since the last call
         """
         try:
             trans = self.owner.transform
         except AttributeError:
             print("NO OWNER", self.owner)
             return
-        m = trans.matrix
-        rot = [[m.get_element(i,j) for j in xrange(3)] for i in xrange(3)]
-        dt = [m.get_element(i,3) for i in xrange(3)]
-        #print "TRANS", rot, dt
-        self.transform = Transform(rotation=rot, translation=dt)
-        inv_trans = trans.linear_inverse
-        m = inv_trans.matrix
-        rot = [[m.get_element(i,j) for j in xrange(3)] for i in xrange(3)]
-        dt = [m.get_element(i,3) for i in xrange(3)]
-        self.inverse_transform = Transform(rotation=rot, translation=dt)
+        stamp = transform_stamp_(trans)
+        if stamp is not None and stamp == self.transform_stamp:
+            return
+        self.transform, self.inverse_transform = vtk_transforms_(trans)
+        self.transform_stamp = stamp
         
     property transform:
         def __set__(self, Transform t):
             self.trans = t.trans
+            self.transform_stamp = None
            
         def __get__(self):
             cdef Transform t=Transform()
@@ -981,6 +1628,7 @@ cdef class FaceList(object):
     property inverse_transform:
         def __set__(self, Transform t):
             self.inv_trans = t.trans
+            self.transform_stamp = None
            
         def __get__(self):
             cdef Transform t=Transform()
@@ -1004,13 +1652,14 @@ cdef class FaceList(object):
             int all_idx=-1
             double dist
             Face face
+            hit_t hit
         
         for i in xrange(len(faces)):
             face = faces[i]
-            dist = face.intersect_c(p1, p2)
+            dist = face.intersect_c(p1, p2, &hit)
             if face.tolerance < dist < ray.length:
                 ray.length = dist
-                all_idx = face.idx
+                all_idx = face.hit_idx_c(&hit)
                 ray.end_face_idx = all_idx
         return all_idx
     
@@ -1022,7 +1671,72 @@ cdef class FaceList(object):
         idx = self.intersect_c(&r.ray, P1_, max_length)
         return idx
     
-    cdef orientation_t compute_orientation_c(self, Face face, vector_t point):
+    cdef intersect_batch_c(self, RayCollectionSoA rays):
+        """Finds the nearest intersection with the faces in this list for
+        each ray of the batch. Each ray runs from its origin to 
+        origin + direction*length. Where a nearer intersection is found, 
+        the length and end_face_idx of the ray are updated.
+        """
+        cdef:
+            size_t i, n=rays.n_rays
+            ray_soa_t world = rays.soa_c(), segs
+            double *local = <double *>malloc(6*n*sizeof(double))
+            double *dist = <double *>malloc(n*sizeof(double))
+            double *length = <double *>(<np_.ndarray>rays.length).data
+            int *end_face_idx = <int *>(<np_.ndarray>rays.end_face_idx).data
+            vector_t p1, p2
+            list faces=self.faces
+            Face face
+            hit_t hit
+            
+        if local is NULL or dist is NULL:
+            free(local)
+            free(dist)
+            raise MemoryError()
+        segs.ox, segs.oy, segs.oz = local, local+n, local+2*n
+        segs.dx, segs.dy, segs.dz = local+3*n, local+4*n, local+5*n
+        segs.n = n
+        try:
+            for i in range(n):
+                p1.x, p1.y, p1.z = world.ox[i], world.oy[i], world.oz[i]
+                p2.x = p1.x + world.dx[i]*length[i]
+                p2.y = p1.y + world.dy[i]*length[i]
+                p2.z = p1.z + world.dz[i]*length[i]
+                p1 = transform_c(self.inv_trans, p1)
+                p2 = transform_c(self.inv_trans, p2)
+                segs.ox[i], segs.oy[i], segs.oz[i] = p1.x, p1.y, p1.z
+                segs.dx[i], segs.dy[i], segs.dz[i] = p2.x-p1.x, p2.y-p1.y, p2.z-p1.z
+                
+            for face in faces:
+                if face.n_idx > 1:
+                    #the idx depends on the part of the face which is hit
+                    for i in range(n):
+                        p1.x, p1.y, p1.z = segs.ox[i], segs.oy[i], segs.oz[i]
+                        p2.x = p1.x + segs.dx[i]
+                        p2.y = p1.y + segs.dy[i]
+                        p2.z = p1.z + segs.dz[i]
+                        dist[i] = face.intersect_c(p1, p2, &hit)
+                        if face.tolerance < dist[i] < length[i]:
+                            length[i] = dist[i]
+                            end_face_idx[i] = face.hit_idx_c(&hit)
+                    continue
+                face.intersect_batch_c(segs, dist)
+                for i in range(n):
+                    if face.tolerance < dist[i] < length[i]:
+                        length[i] = dist[i]
+                        end_face_idx[i] = face.idx
+        finally:
+            free(local)
+            free(dist)
+            
+    def intersect_batch(self, RayCollectionSoA rays):
+        """Intersects a batch of rays with this list of faces, updating
+        rays.length and rays.end_face_idx in place. The ray lengths must 
+        be finite on input.
+        """
+        self.intersect_batch_c(rays)
+    
+    cdef orientation_t compute_orientation_c(self, Face face, vector_t point) nogil:
         cdef orientation_t out
         
         point = transform_c(self.inv_trans, point)
@@ -1035,6 +1749,21 @@ cdef class FaceList(object):
         out.tangent = rotate_c(self.trans, out.tangent)
         return out
     
+    cdef orientation_t compute_hit_orientation_c(self, Face face, hit_t *hit) nogil:
+        """As compute_orientation_c, for an intersection found by the 
+        face's intersect_c. The local point is taken from the hit record.
+        """
+        cdef orientation_t out
+        
+        out.normal = face.compute_normal_hit_c(hit)
+        out.tangent = face.compute_tangent_c(hit.point)
+        if face.invert_normal:
+            out.normal = invert_(out.normal)
+            out.tangent = invert_(out.tangent)
+        out.normal = rotate_c(self.trans, out.normal)
+        out.tangent = rotate_c(self.trans, out.tangent)
+        return out
+    
     def compute_orientation(self, Face face, point):
         cdef:
             vector_t p
@@ -1044,11 +1773,550 @@ cdef class FaceList(object):
         return (o.normal.x, o.normal.y, o.normal.z), (o.tangent.x, o.tangent.y, o.tangent.z)
     
 
+cdef enum:
+    BVH_STACK_SIZE = 64
+    BVH_LEAF_SIZE = 2
+    PACKET_SIZE = 8 #rays traced together by SceneBVH.intersect_packet_c
+    PACKET_SPLIT = 2 #packets this small are split into single rays
+
+
+cdef inline int bounds_finite_(aabb_t b) nogil:
+    return (fabs(b.lower.x) < DBL_MAX and fabs(b.lower.y) < DBL_MAX and 
+            fabs(b.lower.z) < DBL_MAX and fabs(b.upper.x) < DBL_MAX and 
+            fabs(b.upper.y) < DBL_MAX and fabs(b.upper.z) < DBL_MAX and
+            b.lower.x <= b.upper.x and b.lower.y <= b.upper.y and 
+            b.lower.z <= b.upper.z)
+    
+    
+cdef aabb_t transform_bounds_(transform_t t, aabb_t b, double pad):
+    """Finds the axis-aligned box, in the output coordinate system, which
+    encloses the transformed input box, padded by the given amount."""
+    cdef:
+        vector_t c, h
+        aabb_t out
+        
+    c = multvs_(addvv_(b.lower, b.upper), 0.5)
+    h = multvs_(subvv_(b.upper, b.lower), 0.5)
+    c = transform_c(t, c)
+    pad += 1e-9*(1.0 + fabs(c.x) + fabs(c.y) + fabs(c.z))
+    out.lower.x = fabs(t.m00)*h.x + fabs(t.m01)*h.y + fabs(t.m02)*h.z + pad
+    out.lower.y = fabs(t.m10)*h.x + fabs(t.m11)*h.y + fabs(t.m12)*h.z + pad
+    out.lower.z = fabs(t.m20)*h.x + fabs(t.m21)*h.y + fabs(t.m22)*h.z + pad
+    out.upper = addvv_(c, out.lower)
+    out.lower = subvv_(c, out.lower)
+    return out
+    
+    
+cdef inline double aabb_entry_(aabb_t *b, vector_t o, vector_t inv_d) nogil:
+    """Returns the fractional distance along the segment from o to 
+    o + 1/inv_d at which the segment enters the box, or -1 if it misses.
+    """
+    cdef double t0=0.0, t1=1.0, ta, tb
+    
+    ta = (b.lower.x - o.x)*inv_d.x
+    tb = (b.upper.x - o.x)*inv_d.x
+    if ta > tb: ta, tb = tb, ta
+    if ta > t0: t0 = ta
+    if tb < t1: t1 = tb
+    
+    ta = (b.lower.y - o.y)*inv_d.y
+    tb = (b.upper.y - o.y)*inv_d.y
+    if ta > tb: ta, tb = tb, ta
+    if ta > t0: t0 = ta
+    if tb < t1: t1 = tb
+    
+    ta = (b.lower.z - o.z)*inv_d.z
+    tb = (b.upper.z - o.z)*inv_d.z
+    if ta > tb: ta, tb = tb, ta
+    if ta > t0: t0 = ta
+    if tb < t1: t1 = tb
+    
+    if t0 > t1:
+        return -1
+    return t0
+    
+    
+cdef inline int aabb_overlap_(aabb_t *a, aabb_t *b) nogil:
+    return (a.lower.x <= b.upper.x and b.lower.x <= a.upper.x and
+            a.lower.y <= b.upper.y and b.lower.y <= a.upper.y and
+            a.lower.z <= b.upper.z and b.lower.z <= a.upper.z)
+    
+    
+cdef void packet_bounds_(ray_t *rays, int n, unsigned int live, 
+                         aabb_t *b) nogil:
+    """Sets b to the bounding box of the segments from each ray's origin
+    to origin + direction*length, for the rays whose bit is set in live
+    (which mustn't be zero)
+    """
+    cdef:
+        int k
+        vector_t end
+    for k in range(n):
+        if live & (1u << k):
+            b.lower = b.upper = rays[k].origin
+            break
+    for k in range(n):
+        if not (live & (1u << k)):
+            continue
+        end = addvv_(rays[k].origin, multvs_(rays[k].direction, rays[k].length))
+        b.lower.x = min(b.lower.x, rays[k].origin.x, end.x)
+        b.lower.y = min(b.lower.y, rays[k].origin.y, end.y)
+        b.lower.z = min(b.lower.z, rays[k].origin.z, end.z)
+        b.upper.x = max(b.upper.x, rays[k].origin.x, end.x)
+        b.upper.y = max(b.upper.y, rays[k].origin.y, end.y)
+        b.upper.z = max(b.upper.z, rays[k].origin.z, end.z)
+    
+    
+def _bvh_partition(lower, upper):
+    """Recursively splits a set of boxes at the median of their centres
+    along the longest axis.
+    
+    lower, upper - (N,3) arrays giving the corners of each box
+    
+    returns - a list of nodes as (lower, upper, left, right, start, stop) 
+            tuples, with the root first, and the order in which the boxes 
+            are held by the leaves. start:stop is the range of that order 
+            under each node, for leaves and branches alike.
+    """
+    centres = (lower + upper)/2.
+    nodes = []
+    order = []
+    
+    def build(idx):
+        node_id = len(nodes)
+        nodes.append(None)
+        lo = lower[idx].min(axis=0)
+        hi = upper[idx].max(axis=0)
+        if len(idx) <= BVH_LEAF_SIZE:
+            start = len(order)
+            order.extend(idx)
+            nodes[node_id] = (lo, hi, -1, -1, start, len(order))
+        else:
+            c = centres[idx]
+            axis = np.argmax(c.max(axis=0) - c.min(axis=0))
+            idx = idx[np.argsort(c[:,axis], kind='mergesort')]
+            mid = len(idx)//2
+            start = len(order)
+            left = build(idx[:mid])
+            right = build(idx[mid:])
+            nodes[node_id] = (lo, hi, left, right, start, len(order))
+        return node_id
+    
+    if len(lower):
+        build(np.arange(len(lower)))
+    return nodes, order
+    
+
+cdef inline double intersect_tagged_(bvh_prim_t *prim, vector_t p1, 
+                                     vector_t p2, double seg_len) nogil:
+    """Intersection with the faces given a type tag, matching their 
+    intersect_c. p1 and p2 are in the face's local coords.
+    """
+    cdef:
+        double *P = prim.params
+        double h = (P[0]-p1.z)/(p2.z-p1.z)
+        double X, Y
+    if (h<prim.tolerance) or (h>1.0):
+        return 0
+    X = p1.x + h*(p2.x-p1.x) - P[1]
+    Y = p1.y + h*(p2.y-p1.y)
+    if prim.kind == FACE_DISC:
+        if (X*X + Y*Y) > P[2]:
+            return 0
+    elif prim.kind == FACE_RECT:
+        if X*X > P[2] or Y*Y > P[3]:
+            return 0
+    else:
+        return 0
+    return h * seg_len
+
+
+cdef class SceneBVH(object):
+    """A bounding volume hierarchy over all the faces of a list of FaceLists.
+    
+    Face bounds are taken to global coordinates using the FaceList transforms
+    at the time of construction, so a new SceneBVH must be created whenever 
+    the optics move. Faces with unbounded extent are held outside the tree 
+    and tested against every ray. 
+    
+    The primitives form a contiguous array of face records, holding the 
+    face's idx, tolerance and planar flag as well as its bounds, so the 
+    intersection loop only touches the Face object to call intersect_c. 
+    Changes to these attributes of a face also need a new SceneBVH. The 
+    primitive for each face idx can also be looked up directly, to test a
+    single face (see intersect_face_c).
+    """
+    def __cinit__(self, list face_sets):
+        cdef:
+            FaceList fs
+            Face face
+            aabb_t b
+            bvh_prim_t *prim
+            bvh_node_t *node
+            int i, j
+            list bounded=[], unbounded=[], lower=[], upper=[]
+            
+        self.face_sets = face_sets
+        self.faces = []
+        self.sets = <void**>malloc(max(len(face_sets),1)*sizeof(void*))
+        for j in xrange(len(face_sets)):
+            fs = face_sets[j]
+            self.sets[j] = <void*>fs
+            for face in fs.faces:
+                b = face.bounds_c()
+                if bounds_finite_(b):
+                    b = transform_bounds_(fs.trans, b, face.tolerance)
+                    bounded.append((j, face))
+                    lower.append((b.lower.x, b.lower.y, b.lower.z))
+                    upper.append((b.upper.x, b.upper.y, b.upper.z))
+                else:
+                    unbounded.append((j, face))
+                    
+        nodes, order = _bvh_partition(np.array(lower, 'd').reshape(-1,3),
+                                      np.array(upper, 'd').reshape(-1,3))
+        
+        self.n_unbounded = len(unbounded)
+        self.n_prims = len(unbounded) + len(bounded)
+        self.prims = <bvh_prim_t*>malloc(max(self.n_prims,1)*sizeof(bvh_prim_t))
+        for i, (j, face) in enumerate(unbounded + [bounded[k] for k in order]):
+            prim = self.prims + i
+            prim.set_idx = j
+            prim.face = <void*>face
+            prim.tolerance = face.tolerance
+            prim.face_idx = face.idx
+            prim.planar = face.planar
+            prim.kind = face.face_params_c(prim.params)
+            self.faces.append(face)
+            if i >= self.n_unbounded:
+                prim.bounds.lower = set_v(lower[order[i-self.n_unbounded]])
+                prim.bounds.upper = set_v(upper[order[i-self.n_unbounded]])
+            else:
+                prim.bounds = face.bounds_c()
+            
+        self.n_nodes = len(nodes)
+        self.nodes = <bvh_node_t*>malloc(max(self.n_nodes,1)*sizeof(bvh_node_t))
+        for i, (lo, hi, left, right, start, stop) in enumerate(nodes):
+            node = self.nodes + i
+            node.bounds.lower = set_v(lo)
+            node.bounds.upper = set_v(hi)
+            node.left = left
+            node.right = right
+            node.start = start + self.n_unbounded
+            node.stop = stop + self.n_unbounded
+            
+        self.n_face_idx = max([0] + [face.idx + face.n_idx for face in self.faces])
+        self.prim_of_face = <int*>malloc(max(self.n_face_idx,1)*sizeof(int))
+        for i in xrange(self.n_face_idx):
+            self.prim_of_face[i] = -1
+        for i in xrange(self.n_prims):
+            face = self.faces[i]
+            if face.idx >= 0:
+                for j in xrange(face.idx, face.idx + face.n_idx):
+                    self.prim_of_face[j] = i
+            
+    def __dealloc__(self):
+        free(self.nodes)
+        free(self.prims)
+        free(self.sets)
+        free(self.prim_of_face)
+        
+    cdef int intersect_range_c(self, int start, int stop, ray_t *ray, 
+                                vector_t ray_end, int *set_idx, hit_t *hit,
+                                int origin_idx) nogil:
+        """Intersects the ray with the primitives start to stop-1, updating 
+        the ray length, end_face_idx and hit record for the nearest 
+        intersection. A planar face with idx origin_idx is skipped.
+        """
+        cdef:
+            vector_t p1, p2
+            int i, current_set=-1, all_idx=-1
+            double dist, seg_len=1.0
+            bvh_prim_t *prim
+            transform_t *inv_trans
+            hit_t this_hit
+            
+        for i in xrange(start, stop):
+            prim = self.prims + i
+            if prim.planar and prim.face_idx == origin_idx:
+                continue
+            if prim.set_idx != current_set:
+                current_set = prim.set_idx
+                inv_trans = &(<FaceList>self.sets[current_set]).inv_trans
+                p1 = transform_c(inv_trans[0], ray.origin)
+                p2 = transform_c(inv_trans[0], ray_end)
+                seg_len = sep_(p1, p2)
+            if prim.kind == FACE_GENERIC:
+                dist = (<Face>prim.face).intersect_c(p1, p2, &this_hit)
+            else:
+                dist = intersect_tagged_(prim, p1, p2, seg_len)
+            if prim.tolerance < dist < ray.length:
+                ray.length = dist
+                if prim.kind == FACE_GENERIC:
+                    all_idx = (<Face>prim.face).hit_idx_c(&this_hit)
+                else:
+                    all_idx = prim.face_idx
+                ray.end_face_idx = all_idx
+                set_idx[0] = current_set
+                hit[0] = this_hit
+                hit.dist = dist
+                hit.point = addvv_(p1, multvs_(subvv_(p2, p1), dist/seg_len))
+        return all_idx
+        
+    cdef int traverse_c(self, int root, double t_root, ray_t *ray, 
+                        vector_t ray_end, vector_t inv_d, double seg_len, 
+                        int *set_idx, hit_t *hit, int origin_idx) nogil:
+        """Intersects the ray with the faces below node root, which the ray
+        enters at fraction t_root along its segment. Nodes are visited 
+        front-to-back and any node starting beyond the current ray.length
+        is skipped.
+        """
+        cdef:
+            double t_left, t_right
+            int stack[BVH_STACK_SIZE]
+            double stack_t[BVH_STACK_SIZE]
+            int top=0, idx, all_idx=-1
+            bvh_node_t *node
+            
+        stack[0] = root
+        stack_t[0] = t_root
+        top = 1
+        
+        while top > 0:
+            top -= 1
+            if stack_t[top]*seg_len >= ray.length:
+                continue
+            node = self.nodes + stack[top]
+            if node.left < 0:
+                idx = self.intersect_range_c(node.start, node.stop, 
+                                             ray, ray_end, set_idx, hit,
+                                             origin_idx)
+                if idx >= 0:
+                    all_idx = idx
+                continue
+            
+            t_left = aabb_entry_(&self.nodes[node.left].bounds, ray.origin, inv_d)
+            t_right = aabb_entry_(&self.nodes[node.right].bounds, ray.origin, inv_d)
+            #push the far child first, so the near one is visited first
+            if t_left >= 0 and t_right >= 0:
+                if t_left < t_right:
+                    stack[top], stack_t[top] = node.right, t_right
+                    stack[top+1], stack_t[top+1] = node.left, t_left
+                else:
+                    stack[top], stack_t[top] = node.left, t_left
+                    stack[top+1], stack_t[top+1] = node.right, t_right
+                top += 2
+            elif t_left >= 0:
+                stack[top], stack_t[top] = node.left, t_left
+                top += 1
+            elif t_right >= 0:
+                stack[top], stack_t[top] = node.right, t_right
+                top += 1
+        return all_idx
+    
+    cdef int intersect_c(self, ray_t *ray, vector_t ray_end, int *set_idx, 
+                         hit_t *hit, int origin_idx) nogil:
+        """Finds the face with the nearest intersection for the ray running
+        from ray.origin to ray_end (in global coords). origin_idx is the idx 
+        of the face the ray starts from, or -1; if this face is planar, it 
+        isn't tested.
+        
+        returns - the idx of the intersected face, or -1 for no intersection.
+                set_idx gives the index of the FaceList containing the face
+                and hit is filled with the face's hit record
+        """
+        cdef:
+            vector_t d = subvv_(ray_end, ray.origin), inv_d
+            double t
+            int idx, all_idx=-1
+            
+        all_idx = self.intersect_range_c(0, self.n_unbounded, ray, ray_end, 
+                                         set_idx, hit, origin_idx)
+        if self.n_nodes == 0:
+            return all_idx
+        
+        inv_d.x = 1.0/d.x
+        inv_d.y = 1.0/d.y
+        inv_d.z = 1.0/d.z
+        
+        t = aabb_entry_(&self.nodes[0].bounds, ray.origin, inv_d)
+        if t < 0:
+            return all_idx
+        idx = self.traverse_c(0, t, ray, ray_end, inv_d, mag_(d), set_idx, 
+                              hit, origin_idx)
+        if idx >= 0:
+            all_idx = idx
+        return all_idx
+    
+    cdef int intersect_face_c(self, int face_idx, ray_t *ray, vector_t ray_end,
+                              int *set_idx, hit_t *hit, int origin_idx) nogil:
+        """Intersects the ray with the single face with the given idx, as
+        for intersect_range_c. Face idx's not in the scene give no 
+        intersection.
+        """
+        cdef int i
+        if face_idx < 0 or face_idx >= self.n_face_idx:
+            return -1
+        i = self.prim_of_face[face_idx]
+        if i < 0:
+            return -1
+        return self.intersect_range_c(i, i+1, ray, ray_end, set_idx, hit, 
+                                      origin_idx)
+    
+    cdef void intersect_packet_c(self, ray_t *rays, int n, double max_length,
+                                 int *set_idx, hit_t *hits, int *origin_idx,
+                                 int *face_idx) nogil:
+        """Intersects a packet of up to PACKET_SIZE rays with the scene. The
+        rays run from their origin for max_length, and should have their 
+        length set to max_length. The packet is traversed together, while 
+        its rays' segments overlap a node. Each node's box is tested first 
+        against the bounding box of all the segments, and then against each
+        ray. When no more than PACKET_SPLIT rays enter a node, they continue 
+        through it individually.
+        
+        On entry, face_idx[k] may give a face for ray k to test first 
+        (usually the face it hit in a previous trace), or -1. A hit on this
+        face shortens the ray before the search, so more of the tree is 
+        culled. The search still finds any nearer face, so the results are
+        the same either way.
+        
+        The root node's box bounds all the bounded faces. Rays which miss 
+        it are only tested against the unbounded faces, and skip the tree;
+        when there are none, they skip the search altogether.
+        
+        The results for ray k are returned in face_idx[k], set_idx[k] and 
+        hits[k], as for intersect_c.
+        """
+        cdef:
+            vector_t ends[PACKET_SIZE]
+            vector_t inv_d[PACKET_SIZE]
+            vector_t d
+            double seg_len[PACKET_SIZE]
+            double t_entry[PACKET_SIZE]
+            double t
+            aabb_t pbox
+            int stack[BVH_STACK_SIZE]
+            int top, k, idx, n_active, first, node_idx, in_tree
+            unsigned int mask, live=0
+            bvh_node_t *node
+            
+        for k in range(n):
+            d = multvs_(rays[k].direction, max_length)
+            ends[k] = addvv_(rays[k].origin, d)
+            inv_d[k].x = 1.0/d.x
+            inv_d[k].y = 1.0/d.y
+            inv_d[k].z = 1.0/d.z
+            seg_len[k] = mag_(d)
+            if self.n_nodes > 0:
+                t = aabb_entry_(&self.nodes[0].bounds, rays[k].origin, inv_d[k])
+            else:
+                t = -1
+            in_tree = t >= 0 and t*seg_len[k] < rays[k].length
+            if not in_tree and self.n_unbounded == 0:
+                #the ray leaves the scene
+                face_idx[k] = -1
+                continue
+            idx = -1
+            if face_idx[k] >= 0:
+                idx = self.intersect_face_c(face_idx[k], rays+k, ends[k], 
+                                            set_idx+k, hits+k, origin_idx[k])
+            face_idx[k] = self.intersect_range_c(0, self.n_unbounded, rays+k, 
+                                                 ends[k], set_idx+k, hits+k, 
+                                                 origin_idx[k])
+            if face_idx[k] < 0:
+                face_idx[k] = idx
+            #a hit may have cut the ray short of the tree
+            if in_tree and t*seg_len[k] < rays[k].length:
+                live |= (1u << k)
+        if self.n_nodes == 0 or live == 0:
+            return
+        
+        packet_bounds_(rays, n, live, &pbox)
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node_idx = stack[top]
+            node = self.nodes + node_idx
+            if not aabb_overlap_(&node.bounds, &pbox):
+                continue
+            mask = 0
+            n_active = 0
+            first = -1
+            for k in range(n):
+                if not (live & (1u << k)):
+                    continue
+                t = aabb_entry_(&node.bounds, rays[k].origin, inv_d[k])
+                t_entry[k] = t
+                if t >= 0 and t*seg_len[k] < rays[k].length:
+                    mask |= (1u << k)
+                    n_active += 1
+                    if first < 0:
+                        first = k
+            if n_active == 0:
+                continue
+            
+            if n_active <= PACKET_SPLIT or node.left < 0:
+                for k in range(n):
+                    if not (mask & (1u << k)):
+                        continue
+                    if node.left < 0:
+                        idx = self.intersect_range_c(node.start, node.stop, 
+                                                     rays+k, ends[k], 
+                                                     set_idx+k, hits+k,
+                                                     origin_idx[k])
+                    else:
+                        idx = self.traverse_c(node_idx, t_entry[k], rays+k, 
+                                              ends[k], inv_d[k], seg_len[k],
+                                              set_idx+k, hits+k, origin_idx[k])
+                    if idx >= 0:
+                        face_idx[k] = idx
+                packet_bounds_(rays, n, live, &pbox)
+                continue
+            
+            #push the far child first, judged by the first active ray
+            if aabb_entry_(&self.nodes[node.left].bounds, rays[first].origin, inv_d[first]) \
+                    < aabb_entry_(&self.nodes[node.right].bounds, rays[first].origin, inv_d[first]):
+                stack[top], stack[top+1] = node.right, node.left
+            else:
+                stack[top], stack[top+1] = node.left, node.right
+            top += 2
+    
+    def intersect(self, Ray r, double max_length, int origin_idx=-1):
+        """Intersects the given ray with the scene. If origin_idx is the idx
+        of a planar face, that face is skipped.
+        
+        returns - a (face idx, face set idx) tuple for the nearest 
+                intersection, or (-1, -1) if there is none
+        """
+        cdef:
+            vector_t P1_
+            int idx, set_idx=-1
+            hit_t hit
+        
+        P1_ = addvv_(r.ray.origin, multvs_(r.ray.direction, max_length))
+        idx = self.intersect_c(&r.ray, P1_, &set_idx, &hit, origin_idx)
+        return idx, set_idx
+    
+    property bounds:
+        """The (lower, upper) corners of the world bounding box of the 
+        scene, in global coords. This is infinite if any face is unbounded,
+        and None for an empty scene.
+        """
+        def __get__(self):
+            cdef aabb_t b
+            if self.n_unbounded > 0:
+                return (-INF,)*3, (INF,)*3
+            if self.n_nodes == 0:
+                return None
+            b = self.nodes[0].bounds
+            return (b.lower.x, b.lower.y, b.lower.z), (b.upper.x, b.upper.y, b.upper.z)
+    
+
 ##################################
 ### Python module functions
 ##################################
 
-cdef double ray_power_(ray_t ray):
+cdef double ray_power_(ray_t ray) nogil:
     cdef double P1, P2
     
     P1 = (ray.E1_amp.real**2 + ray.E1_amp.imag**2)*ray.refractive_index.real
@@ -1058,62 +2326,611 @@ cdef double ray_power_(ray_t ray):
     return (P1+P2) 
 
 
+cdef enum:
+    TRACE_CHUNK_SIZE = 256
+
+
+cdef inline unsigned long long mix64_(unsigned long long z) nogil:
+    """The splitmix64 finaliser"""
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL
+    return z ^ (z >> 31)
+
+
+cdef double ray_random_(ray_t *ray, unsigned int sibling) nogil:
+    """A uniform random number in [0,1) derived from the ray's origin and 
+    parent. The same ray always gets the same number, so traces are 
+    repeatable and independent of the number of threads.
+    """
+    cdef unsigned long long x, y, z
+    memcpy(&x, &ray.origin.x, sizeof(double))
+    memcpy(&y, &ray.origin.y, sizeof(double))
+    memcpy(&z, &ray.origin.z, sizeof(double))
+    z = mix64_(z ^ mix64_(y ^ mix64_(x ^ mix64_(
+                    (<unsigned long long>ray.parent_idx << 16) ^ sibling))))
+    return (z >> 11) * (1.0/9007199254740992.0)
+
+
+cdef void cull_rays_c(RayCollection rays, unsigned long start, 
+                      double min_power, int roulette) nogil:
+    """Removes the rays from index start onwards whose power is below 
+    min_power. With roulette, each such ray instead survives with a 
+    probability of power/min_power, and its amplitudes are scaled up so its 
+    power becomes min_power; this removes the weak rays without biasing 
+    the expected power.
+    """
+    cdef:
+        unsigned long i, j=start
+        unsigned int sibling=0
+        double P, scale
+        ray_t *ray
+        
+    for i in range(start, rays.n_rays):
+        ray = rays.rays + i
+        if i > start and ray.parent_idx == rays.rays[i-1].parent_idx:
+            sibling += 1
+        else:
+            sibling = 0
+        P = ray_power_(ray[0])
+        if P < min_power:
+            if not roulette or P <= 0 or ray_random_(ray, sibling)*min_power >= P:
+                continue
+            scale = sqrt(min_power/P)
+            ray.E1_amp.real *= scale
+            ray.E1_amp.imag *= scale
+            ray.E2_amp.real *= scale
+            ray.E2_amp.imag *= scale
+        if j != i:
+            rays.rays[j] = ray[0]
+        j += 1
+    rays.n_rays = j
+
+
+cdef void trace_chunk_c(ray_t *rays, unsigned long start, unsigned long stop,
+                        double max_length, SceneBVH bvh, void **faces,
+                        void **materials, RayCollection new_rays,
+                        double min_power, int roulette, ray_t *parents,
+                        unsigned long n_parents, int *hint) nogil:
+    """Traces rays start to stop-1, appending their children to new_rays.
+    If min_power is positive, children with less power are culled.
+    
+    hint may give a face idx (or -1) for each ray, which the ray tests 
+    first (see SceneBVH.intersect_packet_c), or be NULL.
+    
+    If the rays are children, parents holds the n_parents rays of their 
+    parent generation. The face each ray came from is the end face of its 
+    parent, and is excluded when it is planar. Otherwise parents is NULL: 
+    the rays are input rays, and are given their own index as root_idx and
+    zero optical_path. Children inherit the root_idx of their parent, and 
+    add the parent's optical path length to its optical_path. Their 
+    end_face_idx is left as "no hit" until they are traced.
+    
+    The trace has two phases. First, consecutive rays are intersected in 
+    packets of PACKET_SIZE, since sources generally emit neighbouring rays 
+    along similar paths, and the hits are recorded. The hits are then 
+    sorted by material, keeping their order otherwise, and each material 
+    evaluates the children for its hits in one batch. stop - start must 
+    be no more than TRACE_CHUNK_SIZE.
+    """
+    cdef:
+        unsigned long j, p, n_hits=0, a, b, n_before=new_rays.n_rays
+        int k, n, idx
+        int set_idx[PACKET_SIZE]
+        int origin_idx[PACKET_SIZE]
+        int face_idx[PACKET_SIZE]
+        hit_t hits[PACKET_SIZE]
+        surface_hit_t shits[TRACE_CHUNK_SIZE]
+        surface_hit_t tmp
+        void *material
+        ray_t *ray
+        ray_t *child
+        
+    p = start
+    while p < stop:
+        n = min(<unsigned long>PACKET_SIZE, stop - p)
+        for k in range(n):
+            ray = rays + p + k
+            if hint is not NULL:
+                face_idx[k] = hint[p+k]
+            else:
+                face_idx[k] = -1
+            if parents is not NULL:
+                if ray.parent_idx < n_parents:
+                    origin_idx[k] = <int>parents[ray.parent_idx].end_face_idx
+                else:
+                    origin_idx[k] = -1
+            else:
+                origin_idx[k] = -1
+                ray.root_idx = p + k
+                ray.optical_path = 0.0
+            ray.length = max_length
+            ray.end_face_idx = -1
+        bvh.intersect_packet_c(rays + p, n, max_length, set_idx, hits, 
+                               origin_idx, face_idx)
+        for k in range(n):
+            idx = face_idx[k]
+            if idx < 0:
+                continue
+            ray = rays + p + k
+            shits[n_hits].ray_idx = p + k
+            shits[n_hits].face_idx = idx
+            shits[n_hits].point = addvv_(ray.origin, 
+                                         multvs_(ray.direction, ray.length))
+            shits[n_hits].orient = (<FaceList>bvh.sets[set_idx[k]]).compute_hit_orientation_c(
+                                                    <Face>faces[idx], hits + k)
+            n_hits += 1
+        p += PACKET_SIZE
+        
+    #stable insertion sort by material
+    for a in range(1, n_hits):
+        tmp = shits[a]
+        material = materials[tmp.face_idx]
+        b = a
+        while b > 0 and <size_t>materials[shits[b-1].face_idx] > <size_t>material:
+            shits[b] = shits[b-1]
+            b -= 1
+        shits[b] = tmp
+        
+    a = 0
+    while a < n_hits:
+        material = materials[shits[a].face_idx]
+        b = a + 1
+        while b < n_hits and materials[shits[b].face_idx] == material:
+            b += 1
+        (<InterfaceMaterial>material).eval_children_batch_c(rays, shits + a, 
+                                                            b - a, new_rays)
+        a = b
+        
+    for j in range(n_before, new_rays.n_rays):
+        child = new_rays.rays + j
+        ray = rays + child.parent_idx
+        child.end_face_idx = -1
+        child.root_idx = ray.root_idx
+        child.optical_path = ray.optical_path + \
+                             ray.length*ray.refractive_index.real
+    if min_power > 0:
+        cull_rays_c(new_rays, 0, min_power, roulette)
+
+
+cdef fill_face_arrays_(list all_faces, void **faces, void **materials):
+    """Fills the given arrays with borrowed references to each face and 
+    its material, so they can be looked up by face idx without the GIL.
+    Raises a ValueError if a face with several idx values isn't listed at 
+    each of them.
+    """
+    cdef:
+        unsigned int i
+        int n
+        Face face
+    for i in xrange(len(all_faces)):
+        face = all_faces[i]
+        faces[i] = <void*>face
+        materials[i] = <void*>face.material
+        n = face.n_idx
+        if n > 1 and all_faces[face.idx:face.idx+n] != [face]*n:
+            raise ValueError("Face %r has idx %d to %d, but isn't at each of these positions in the face list"%(
+                                    face, face.idx, face.idx+n-1))
+        
+        
+cdef check_wavelengths_(list all_faces, RayCollection rays):
+    """Raises a ValueError if a face's material uses the wavelengths but 
+    doesn't have one for each wavelength_idx of the rays. The materials 
+    index their wavelengths without the GIL, where this can't be reported.
+    """
+    cdef:
+        Face face
+        unsigned long i
+        unsigned int n=0
+    for i in xrange(rays.n_rays):
+        n = max(n, rays.rays[i].wavelength_idx+1)
+    for face in all_faces:
+        if face.material.uses_wavelengths and \
+                    len(face.material.wavelengths) < n:
+            raise ValueError("The material of face %r has %d wavelengths set, but the rays need %d"%(
+                                    face, len(face.material.wavelengths), n))
+        
+        
+cdef size_t max_children_(list all_faces):
+    """The largest number of child rays any face's material can create
+    from a single hit
+    """
+    cdef Face face
+    return max([1] + [face.material.max_children for face in all_faces])
+        
+        
+cdef RayCollection trace_generation_c(RayCollection rays, SceneBVH bvh,
+                                      void **faces, void **materials,
+                                      unsigned int n_faces,
+                                      double max_length, int num_threads,
+                                      RayArena arena, size_t max_children,
+                                      double min_power, int roulette,
+                                      np_.ndarray hint=None):
+    """Traces one generation of rays. The rays are split into chunks which 
+    are traced in parallel, without the GIL, each into its own scratch 
+    RayCollection. The chunks are then joined in order, so the output is the 
+    same as for a serial trace. num_threads=0 uses the OpenMP default.
+    
+    The scratch collections and the output come from the arena. The scratch
+    collections are sized for max_children rays per hit, so they don't 
+    need to grow while tracing. New rays with less than min_power are 
+    culled (see cull_rays_c). If rays has a parent generation, rays are 
+    not tested against the planar face they start from. If given, hint is 
+    an array of a face idx (or -1) for each ray, to be tested first (see 
+    HitCacheSink).
+    """
+    cdef:
+        ray_t *parents=NULL
+        int *hint_faces=NULL
+        unsigned long n_parents=0
+        unsigned long n_rays=rays.n_rays, n_chunks, c, start
+        unsigned long i, total=0
+        int idx
+        void **chunks
+        list chunk_list
+        RayCollection new_rays, chunk
+    
+    n_chunks = (n_rays + TRACE_CHUNK_SIZE - 1) // TRACE_CHUNK_SIZE
+    chunk_list = arena.scratch_c(n_chunks, TRACE_CHUNK_SIZE*max_children)
+    #the chunks may grow while tracing, which can't be refused without the GIL
+    for chunk in chunk_list:
+        chunk.check_resizable()
+    
+    if rays.parent is not None:
+        parents = rays.parent.rays
+        n_parents = rays.parent.n_rays
+    if hint is not None:
+        if len(hint) != n_rays or hint.dtype != np.intc:
+            raise ValueError("hint must have a np.intc face idx for each ray")
+        hint = np.ascontiguousarray(hint)
+        hint_faces = <int *>hint.data
+    
+    chunks = <void**>malloc(max(n_chunks,1)*sizeof(void*))
+    try:
+        for c in xrange(n_chunks):
+            chunks[c] = <void*>chunk_list[c]
+            
+        if num_threads > 0:
+            for c in prange(n_chunks, nogil=True, schedule='dynamic', 
+                            num_threads=num_threads):
+                start = c*TRACE_CHUNK_SIZE
+                trace_chunk_c(rays.rays, start, min(start+TRACE_CHUNK_SIZE, n_rays),
+                              max_length, bvh, faces, materials, 
+                              <RayCollection>chunks[c], min_power, roulette,
+                              parents, n_parents, hint_faces)
+        else:
+            for c in prange(n_chunks, nogil=True, schedule='dynamic'):
+                start = c*TRACE_CHUNK_SIZE
+                trace_chunk_c(rays.rays, start, min(start+TRACE_CHUNK_SIZE, n_rays),
+                              max_length, bvh, faces, materials, 
+                              <RayCollection>chunks[c], min_power, roulette,
+                              parents, n_parents, hint_faces)
+    finally:
+        free(chunks)
+                
+    for i in xrange(n_rays):
+        idx = <int>rays.rays[i].end_face_idx
+        if 0 <= idx < n_faces:
+            (<Face>faces[idx]).count += 1
+    
+    for chunk in chunk_list:
+        total += chunk.n_rays
+    #reserve enough for the following generation to share the block
+    new_rays = arena.allocate_c(total, total*(1 + max_children))
+    for chunk in chunk_list:
+        memcpy(new_rays.rays + new_rays.n_rays, chunk.rays, 
+               chunk.n_rays*sizeof(ray_t))
+        new_rays.n_rays += chunk.n_rays
+    return new_rays
+
+
 cdef RayCollection trace_segment_c(RayCollection rays, 
                                     list face_sets, 
                                     list all_faces,
-                                    float max_length):
+                                    float max_length,
+                                    SceneBVH bvh=None,
+                                    int num_threads=0,
+                                    RayArena arena=None,
+                                    double min_power=0.0,
+                                    int roulette=0):
+    """Traces the rays by one step. If no SceneBVH is given, one is built 
+    from face_sets. If no RayArena is given, the new rays use a new arena.
+    New rays with less power than min_power are terminated, or with 
+    roulette, randomly terminated or reweighted. The new rays have their 
+    parent attribute set to rays.
+    """
     cdef:
-        FaceList face_set #a FaceList
-        unsigned int size, i, j
-        vector_t P1, point
-        orientation_t orient
-        int idx, nearest_set=-1, nearest_idx=-1, n_sets=len(face_sets)
-        ray_t new_ray
-        ray_t *ray
+        unsigned int n_faces=len(all_faces)
+        void **faces
+        void **materials
         RayCollection new_rays
-   
-    #need to allocate the output rays here 
-    new_rays = RayCollection(rays.n_rays)
+        
+    if bvh is None:
+        bvh = SceneBVH(face_sets)
+    if arena is None:
+        arena = RayArena()
     
-    for i in range(rays.n_rays):
-        ray = rays.rays + i
-        ray.length = max_length
-        ray.end_face_idx = -1
-        nearest_idx=-1
-        point = addvv_(ray.origin, 
-                            multvs_(ray.direction, 
-                                    max_length))
-        #print "points", P1, P2
-        for j in xrange(n_sets):
-            face_set = face_sets[j]
-            #intersect_c returns the face idx of the intersection, or -1 otherwise
-            idx = (<FaceList>face_set).intersect_c(ray, point, max_length)
-            if idx >= 0:
-                nearest_set = j
-                nearest_idx = idx
-        if nearest_idx >= 0:
-            #print "GET FACE", nearest.face_idx, len(all_faces)
-            face = all_faces[nearest_idx]
-            face.count += 1
-            #print "ray length", ray.length
-            point = addvv_(ray.origin, multvs_(ray.direction, ray.length))
-            orient = (<FaceList>(face_sets[nearest_set])).compute_orientation_c(face, point)
-            #print "s normal", normal
-            (<InterfaceMaterial>(face.material)).eval_child_ray_c(ray, i, 
-                                                    point,
-                                                    orient,
-                                                    new_rays
-                                                    )
-    return new_rays
+    faces = <void**>malloc(max(n_faces,1)*sizeof(void*))
+    materials = <void**>malloc(max(n_faces,1)*sizeof(void*))
+    try:
+        fill_face_arrays_(all_faces, faces, materials)
+        new_rays = trace_generation_c(rays, bvh, faces, materials, n_faces,
+                                      max_length, num_threads, arena, 
+                                      max_children_(all_faces), min_power, 
+                                      roulette)
+        new_rays.parent = rays
+        return new_rays
+    finally:
+        free(faces)
+        free(materials)
+        
+        
+cdef object trace_rays_c(RayCollection rays, 
+                        list face_sets, 
+                        list all_faces,
+                        float max_length,
+                        int recursion_limit,
+                        SceneBVH bvh=None,
+                        int num_threads=0,
+                        RayArena arena=None,
+                        double min_power=0.0,
+                        int roulette=0,
+                        HitCacheSink hint=None,
+                        RaySink sink=None):
+    """Traces the rays through successive generations, until no rays remain
+    or recursion_limit generations have been traced. Each new generation
+    has its parent attribute set to the generation it came from. The new
+    generations are allocated from the given RayArena, or a new one. Rays
+    with less power than min_power are culled, as for trace_segment_c.
+    
+    hint may give a HitCacheSink which recorded a previous trace of 
+    similar rays. Each ray first tests the face hit by its counterpart in
+    the previous trace, which speeds up retracing after small changes to 
+    the model. The results don't depend on the hint.
+    
+    If a RaySink is given, each generation is passed to it once traced, 
+    instead of being kept. The link from each generation to its parent is
+    then dropped once it has been traced, so a generation can be freed 
+    as soon as the sink is done with it.
+    
+    returns - the list of traced RayCollections, starting with the input 
+              rays, or the result of sink.finish()
+    """
+    cdef:
+        unsigned int n_faces=len(all_faces)
+        int count=0
+        void **faces
+        void **materials
+        list traced_rays=[]
+        RayCollection new_rays
+        size_t max_children=max_children_(all_faces)
+        object hint_faces=None, match=None
+        
+    if bvh is None:
+        bvh = SceneBVH(face_sets)
+    if arena is None:
+        arena = RayArena()
+    
+    faces = <void**>malloc(max(n_faces,1)*sizeof(void*))
+    materials = <void**>malloc(max(n_faces,1)*sizeof(void*))
+    try:
+        fill_face_arrays_(all_faces, faces, materials)
+        while rays.n_rays > 0 and count < recursion_limit:
+            if sink is None:
+                traced_rays.append(rays)
+            if hint is not None:
+                hint_faces, match = hint.match(count, rays, match)
+            new_rays = trace_generation_c(rays, bvh, faces, materials, n_faces,
+                                          max_length, num_threads, arena,
+                                          max_children, min_power, roulette,
+                                          hint_faces)
+            new_rays.parent = rays
+            if sink is not None:
+                sink.add_generation(rays, new_rays)
+                rays.parent = None
+            rays = new_rays
+            count += 1
+    finally:
+        free(faces)
+        free(materials)
+    if sink is not None:
+        return sink.finish()
+    return traced_rays
+
+
+cdef list trace_sequence_c(RayCollection rays,
+                          list sequence,
+                          list all_faces,
+                          float max_length,
+                          int num_threads=0,
+                          RayArena arena=None,
+                          double min_power=0.0,
+                          int roulette=0):
+    """Traces the rays sequentially. sequence is a list of SceneBVHs; the
+    n'th generation of rays is only intersected with the faces of the n'th 
+    SceneBVH. Rays which miss are terminated.
+    
+    returns - the list of traced RayCollections, starting with the input 
+              rays. As for trace_rays_c, this holds only generations which
+              were traced: the rays leaving the last step are the children
+              of the last item, and aren't included.
+    """
+    cdef:
+        unsigned int n_faces=len(all_faces)
+        void **faces
+        void **materials
+        list traced_rays=[]
+        RayCollection new_rays
+        SceneBVH bvh
+        size_t max_children=max_children_(all_faces)
+        
+    if arena is None:
+        arena = RayArena()
+    
+    faces = <void**>malloc(max(n_faces,1)*sizeof(void*))
+    materials = <void**>malloc(max(n_faces,1)*sizeof(void*))
+    try:
+        fill_face_arrays_(all_faces, faces, materials)
+        for bvh in sequence:
+            if rays.n_rays == 0:
+                break
+            traced_rays.append(rays)
+            new_rays = trace_generation_c(rays, bvh, faces, materials, n_faces,
+                                          max_length, num_threads, arena,
+                                          max_children, min_power, roulette)
+            new_rays.parent = rays
+            rays = new_rays
+    finally:
+        free(faces)
+        free(materials)
+    return traced_rays
+
+
+def sequence_bvhs(list sequence, list face_sets):
+    """Builds the list of SceneBVHs for a sequential trace. 
+    
+    sequence - a list where each item is a Face, or a list of Faces, to be 
+               intersected by successive generations of rays
+    face_sets - the FaceLists which hold the faces, giving their transforms
+    
+    returns - a list of SceneBVH, one for each step of the sequence
+    """
+    cdef:
+        dict face_lists = {}
+        FaceList fl, sub
+        list out=[], sub_sets
+        dict subs
+    for fl in face_sets:
+        for face in fl.faces:
+            face_lists[id(face)] = fl
+    for group in sequence:
+        if isinstance(group, Face):
+            group = [group]
+        subs = {}
+        sub_sets = []
+        for face in group:
+            try:
+                fl = face_lists[id(face)]
+            except KeyError:
+                raise ValueError("%r is not in any of the given FaceLists"%(face,))
+            if id(fl) not in subs:
+                sub = FaceList(owner=fl.owner)
+                sub.trans = fl.trans
+                sub.inv_trans = fl.inv_trans
+                sub.faces = []
+                subs[id(fl)] = sub
+                sub_sets.append(sub)
+            (<FaceList>subs[id(fl)]).faces.append(face)
+        out.append(SceneBVH(sub_sets))
+    return out
+
+
+def trace_sequence(RayCollection rays,
+                   list sequence,
+                   list face_sets,
+                   list all_faces,
+                   max_length=100,
+                   int num_threads=0,
+                   RayArena arena=None,
+                   double power_cutoff=0.0,
+                   double relative_power_cutoff=0.0,
+                   bint russian_roulette=False,
+                   list bvhs=None):
+    """Performs a sequential trace, where each generation of rays is only
+    intersected with the next Face (or list of Faces) in sequence. Rays 
+    which miss are terminated. Faces should carry the idx of their position
+    in all_faces. The power cutoffs are applied as for trace_rays.
+    
+    bvhs may give the list made by sequence_bvhs for this sequence, to 
+    save rebuilding it when the same sequence is traced repeatedly.
+    
+    returns - the list of traced RayCollections, starting with the input rays
+    """
+    for fs in face_sets:
+        fs.sync_transforms()
+    check_wavelengths_(all_faces, rays)
+    if bvhs is None:
+        bvhs = sequence_bvhs(sequence, face_sets)
+    return trace_sequence_c(rays, bvhs, all_faces, max_length, num_threads, 
+                            arena, min_power_(rays, power_cutoff, 
+                                              relative_power_cutoff), 
+                            russian_roulette)
 
 
 def trace_segment(RayCollection rays, 
                     list face_sets, 
                     list all_faces,
-                    max_length=100):
+                    max_length=100,
+                    SceneBVH bvh=None,
+                    int num_threads=0,
+                    RayArena arena=None,
+                    double power_cutoff=0.0,
+                    bint russian_roulette=False):
     for fs in face_sets:
         fs.sync_transforms()
-    return trace_segment_c(rays, face_sets, all_faces, max_length)
+    check_wavelengths_(all_faces, rays)
+    return trace_segment_c(rays, face_sets, all_faces, max_length, bvh, 
+                           num_threads, arena, power_cutoff, russian_roulette)
+
+
+def trace_rays(RayCollection rays, 
+                list face_sets, 
+                list all_faces,
+                max_length=100,
+                recursion_limit=200,
+                SceneBVH bvh=None,
+                int num_threads=0,
+                RayArena arena=None,
+                double power_cutoff=0.0,
+                double relative_power_cutoff=0.0,
+                bint russian_roulette=False,
+                HitCacheSink hint=None,
+                RaySink sink=None):
+    """Traces all generations of the given rays in a single call. The 
+    FaceList transforms are synchronised once, at the start. Passing the
+    same RayArena to successive traces lets them reuse the ray memory.
+    
+    Rays are terminated when their power falls below the larger of 
+    power_cutoff and relative_power_cutoff times the power of the 
+    strongest input ray. With russian_roulette, such rays are instead 
+    terminated at random and the survivors reweighted, which keeps the 
+    expected power unbiased.
+    
+    hint may be a HitCacheSink which was passed (alone or in a SinkGroup)
+    to a previous trace of the same source. Each ray then tests the face 
+    its counterpart hit in that trace first, which makes retracing quicker
+    after small changes to the model. The result is the same as without 
+    the hint.
+    
+    If a RaySink is given, the generations are passed to it as they are 
+    traced rather than kept, so the memory needed scales with one 
+    generation rather than the whole ray tree (see KeepAllSink, 
+    TerminalRaySink, GenerationFileSink and FaceTally).
+    
+    returns - the list of traced RayCollections, starting with the input 
+              rays, or the result of sink.finish()
+    """
+    for fs in face_sets:
+        fs.sync_transforms()
+    check_wavelengths_(all_faces, rays)
+    return trace_rays_c(rays, face_sets, all_faces, max_length, 
+                        recursion_limit, bvh, num_threads, arena, 
+                        min_power_(rays, power_cutoff, relative_power_cutoff),
+                        russian_roulette, hint, sink)
+
+
+cdef double min_power_(RayCollection rays, double power_cutoff, 
+                       double relative_power_cutoff):
+    """The power below which rays are terminated: the larger of power_cutoff
+    and relative_power_cutoff times the power of the strongest input ray
+    """
+    cdef:
+        unsigned long i
+        double P_max=0.0
+    if relative_power_cutoff <= 0:
+        return power_cutoff
+    for i in xrange(rays.n_rays):
+        P_max = max(P_max, ray_power_(rays.rays[i]))
+    return max(power_cutoff, relative_power_cutoff*P_max)
 
 
 def transform(Transform t, p):
@@ -31,7 +31,8 @@ from itertools import chain, islice, tee
 #             Traceable, NumEditor, dotprod, transformPoints, transformNormals
 
 from raytrace.bases import Optic, Traceable
-from raytrace.cfaces import PolygonFace, ExtrudedPlanarFace
+from raytrace.cfaces import PolygonFace, ExtrudedPlanarFace, \
+            ExtrudedPolygonFace
 from raytrace.ctracer import FaceList
 
 
@@ -51,6 +52,8 @@ class Extrusion(Optic):
     
     trace_ends = Bool(True, desc="include the end-faces in tracing")
     
+    separate_sides = Bool(False, desc="make a face for each side, rather than one face for all of them")
+    
     data_source = Instance(tvtk.ProgrammableSource, (), transient=True)
     
     extrude = Instance(tvtk.LinearExtrusionFilter, (), 
@@ -73,6 +76,9 @@ class Extrusion(Optic):
         if profile.shape == (2,2):
             sides = [ExtrudedPlanarFace(owner=self, z1=z1, z2=z2, x1=profile[0,0], y1=profile[0,1], 
                         x2=profile[1,0], y2=profile[1,1], material=m)]
+        elif not self.separate_sides:
+            sides = [ExtrudedPolygonFace(owner=self, z1=z1, z2=z2, 
+                        xy_points=profile, material=m)]
         else:
             sides = [ExtrudedPlanarFace(owner=self, z1=z1, z2=z2, x1=x1, y1=y1, 
                         x2=x2, y2=y2, material=m) for ((x2,y2),(x1,y1)) 
@@ -95,6 +101,10 @@ class Extrusion(Optic):
         self.faces.faces = self.make_faces()
         self.update=True
         
+    def _separate_sides_changed(self):
+        self.faces.faces = self.make_faces()
+        self.update=True
+        
     def _profile_changed(self):
         self.data_source.modified()
         self.faces.faces = self.make_faces()
@@ -4,14 +4,14 @@ A module for Results subclasses
 
 
 from traits.api import Instance, Float, on_trait_change,\
-            Button, DictStrFloat, Str
+            Button, DictStrFloat, Str, Dict, Bool
 
 from traitsui.api import View, Item, DropEditor
 
 from raytrace.bases import Result, Traceable
 from raytrace.sources import BaseRaySource
 #from raytrace.tracer import RayTraceModel
-from raytrace.ctracer import Face
+from raytrace.ctracer import Face, FaceTally, LastGenerationSink
 from raytrace.dispersion import FusedSilica
 
 from traitsui.editors.drop_editor import DropEditor
@@ -29,6 +29,14 @@ class TargetResult(Result):
     name = Str("TargetResult")
     result = Float(label="Result", transient=True)
     
+    #the last generation traced from the source, which is kept whatever
+    #the ray retention
+    _last = Instance(LastGenerationSink, transient=True)
+    
+    #true if the tracer keeps every generation of full rays, for sources
+    #with full retention
+    _keeps_all = Bool(False, transient=True)
+    
     traits_view = View(Item("name", style="readonly", editor=TitleEditor()), 
                        Item('result', style="readonly"),
                        Item('source', editor=DropEditor()),
@@ -46,13 +54,43 @@ class TargetResult(Result):
     def _calc_result(self):
         raise NotImplementedError()
         
+    def prepare_to_trace(self, tracer):
+        self._keeps_all = (tracer.ray_retention == "all")
+        
+    def get_sink(self, source):
+        if source is not self.source:
+            return None
+        if self._keeps_all and source.retention == "full":
+            #the last generation will be in TracedRays
+            self._last = None
+            return None
+        self._last = LastGenerationSink()
+        return self._last
+    
+    def has_rays(self):
+        """True if there are traced rays from the source to evaluate"""
+        return bool(self.source.TracedRays) or \
+                (self._last is not None and self._last.last is not None)
+    
+    def last_rays(self):
+        """The last generation of rays traced from the source. If the 
+        source was traced before this result was added, the rays are taken
+        from its TracedRays, which are only kept with full ray retention.
+        """
+        if self.source.TracedRays:
+            return self.source.TracedRays[-1]
+        if self._last is not None and self._last.last is not None:
+            return self._last.finish()
+        raise ValueError("No traced rays from %s. Trace the model again "
+                         "with this result, or with full ray retention."%(self.source,))
+        
     @on_trait_change("source, target")
     def update(self):
         if self.target is None:
             return
         if self.source is None:
             return
-        if self.source.TracedRays:
+        if self.has_rays():
             try:
                 self._calc_result()
             except:
@@ -78,20 +116,13 @@ class MeanOpticalPathLength(TargetResult):
             return
         if self.source is None:
             return
-        if self.source.TracedRays:
+        if self.has_rays():
             self._calc_result()
     
     def _calc_result(self):
-        all_rays = [r.copy_as_array() for r in reversed(self.source.TracedRays)]
-        idx = self.target.idx
-        last = all_rays[0]
-        selected_idx = numpy.argwhere(last['end_face_idx']==idx).ravel()
-        total = numpy.zeros(len(selected_idx), 'd')
-        for ray in all_rays:
-            selected = ray[selected_idx]
-            total += selected['length'] * selected['refractive_index'].real
-            selected_idx = selected['parent_idx']
-        self.result = total.mean()
+        last = self.last_rays()
+        selected = self.target.owns_idx(last.end_face_idx)
+        self.result = last.total_optical_path[selected].mean()
         
         
 def evaluate_phase(all_wavelengths, traced_rays, target_face,
@@ -99,7 +130,8 @@ def evaluate_phase(all_wavelengths, traced_rays, target_face,
     """
     
     all_wavelengths - a numpy array giving the wavelengths, in microns
-    traced_rays - the list of RayCollections from the source object after tracing
+    traced_rays - the list of RayCollections from the source object after 
+                  tracing; only the last is used
     target_face - the Face object at which we terminate the tracing
     glass_length - an additional length of glass added to the computation
     glass_dispersion - the DispersionCurve for the extra glass (default Fused Silica)
@@ -107,23 +139,16 @@ def evaluate_phase(all_wavelengths, traced_rays, target_face,
     returns - (freq, phase) #freq in THz
     """
     c = 2.99792458e8 * 1e-9 #convert to mm/ps
-    all_rays = [r.copy_as_array() for r in reversed(traced_rays)]
-    idx = target_face.idx
-    last = all_rays[0]
-    selected_idx = numpy.argwhere(last['end_face_idx']==idx).ravel()
-    wavelengths = all_wavelengths[last['wavelength_idx'][selected_idx]]
+    last = traced_rays[-1]
+    selected_idx = numpy.argwhere(target_face.owns_idx(last.end_face_idx)).ravel()
+    wavelengths = all_wavelengths[last.wavelength_idx[selected_idx]]
     sort_idx = numpy.argsort(wavelengths)[::-1]
     wavelengths = wavelengths[sort_idx]
     selected_idx = selected_idx[sort_idx]
     
-    idx = len(selected_idx)//2
-    phase = last['phase'][selected_idx].copy()
+    phase = last.phase[selected_idx]
     phase -= phase.mean()
-    total = numpy.zeros(len(selected_idx), 'd')
-    for ray in all_rays:
-        selected = ray[selected_idx]
-        total += selected['length'] * selected['refractive_index'].real
-        selected_idx = selected['parent_idx']
+    total = last.total_optical_path[selected_idx]
         
     #print "Phase:", phase
     if len(total) < 6:
@@ -167,7 +192,7 @@ class GroupVelocityDispersion(MeanOpticalPathLength):
     
     def _calc_result(self):
         all_wavelengths = numpy.asarray(self.source.wavelength_list)
-        traced_rays = self.source.TracedRays
+        traced_rays = [self.last_rays()]
         target_face = self.target
         glass_length = self.glass_path
         glass_dispersion = self._fs
@@ -186,10 +211,10 @@ class GroupVelocityDispersion(MeanOpticalPathLength):
         
         c = 2.99792458e8 * 1e-9 #convert to mm/ps
         
-        idx = target_face.idx
-        self.result = second_deriv[idx]
+        #evaluate at the middle of the spectrum, as for the wavelength
+        self.result = second_deriv[len(second_deriv)//2]
         self.wavelength = c*1000.0/numpy.median(f) #convert to nm
-        self.tod = third_deriv[idx]
+        self.tod = third_deriv[len(third_deriv)//2]
         
         
 class FocalPoint(TargetResult):
@@ -208,10 +233,8 @@ class Divergence(TargetResult):
                        )
     
     def _calc_result(self):
-        all_rays = [r.copy_as_array() for r in reversed(self.source.TracedRays)]
-        idx = self.target.idx
-        last = all_rays[0]
-        selected_idx = numpy.argwhere(last['end_face_idx']==idx).ravel()
+        last = self.last_rays().copy_as_array()
+        selected_idx = numpy.argwhere(self.target.owns_idx(last['end_face_idx'])).ravel()
         selected_rays = last[selected_idx]
         directions = selected_rays['direction']
         ave_direction = directions.mean(axis=0,keepdims=True)
@@ -226,14 +249,12 @@ def get_total_intersections(raysList, face):
     print face.idx, " all_rays: "
     for ray in all_rays:
     print ray.end_face_idx  #'''
-    idx = face.idx
-    return sum(1 for ray in all_rays if ray.end_face_idx==idx)
+    return sum(1 for ray in all_rays if face.owns_idx(ray.end_face_idx))
 
 
 def get_total_power(raysList, face):
     all_rays = itertools.chain(*raysList)
-    idx = face.idx
-    return sum(ray.power for ray in all_rays if ray.end_face_idx==idx)
+    return sum(ray.power for ray in all_rays if face.owns_idx(ray.end_face_idx))
 
 
 class RayPaths(Result):
@@ -302,6 +323,10 @@ class Ratio(Result):
     
     _tracer = Instance("raytrace.tracer.RayTraceModel") #to cache the tracer instance
     
+    #FaceTally for each source, accumulated during the last trace. Cleared
+    #at the start of each trace, so removed sources aren't kept
+    _tallies = Dict(transient=True)
+    
     traits_view = View(Item('result', style="readonly"),
                        Item('nominator', editor=DropEditor()),
                        Item('denominator', editor=DropEditor()),
@@ -323,6 +348,26 @@ class Ratio(Result):
     def calc_result(self, tracer):
         self._tracer = tracer
         self._calc_result()
+        
+    def prepare_to_trace(self, tracer):
+        self._tallies = {}
+        
+    def get_sink(self, source):
+        tally = FaceTally()
+        self._tallies[source] = tally
+        return tally
+    
+    def get_tally(self, source):
+        """The FaceTally for the given source, from the last trace. If the
+        source was traced before this result was added, the tally is made 
+        from the rays it kept, which must be full rays (see 
+        BaseRaySource.get_traced_rays).
+        """
+        tally = self._tallies.get(source)
+        if tally is None or tally.n_generations == 0:
+            tally = FaceTally()
+            tally.replay(source.get_traced_rays())
+        return tally
     
     def _calc_result(self):
         nom = self.nominator
@@ -335,11 +380,9 @@ class Ratio(Result):
         #just sum result from multiple sources?
         #maybe a dictionary or something would be better?
         for source in self._tracer.sources:
-            #a list of RayCollection instances
-            raysList = source.TracedRays
-        
-            nom_count = nom_count + get_total_intersections(raysList, nom)
-            denom_count = denom_count + get_total_intersections(raysList, denom)
+            tally = self.get_tally(source)
+            nom_count = nom_count + tally.face_count(nom.idx, nom.n_idx)
+            denom_count = denom_count + tally.face_count(denom.idx, denom.n_idx)
 	#print "nom and denom counts", nom_count, denom_count
         try:
             self.result = float(nom_count)/float(denom_count)
@@ -368,23 +411,10 @@ class IncidentPower(Ratio):
         #just sum result from multiple sources?
         #maybe a dictionary or something would be better?
         for source in self._tracer.sources:
-            #a list of RayCollection instances
-            raysList = source.TracedRays
-            input = source.TracedRays[0]
-            E1_amp = input.E1_amp
-            E2_amp = input.E2_amp
-            n = input.refractive_index.real
-            power_in += (n*E1_amp*E1_amp.conjugate()).real.sum() + (n*E2_amp*E2_amp.conjugate()).real.sum()
-            
+            tally = self.get_tally(source)
+            power_in += tally.input_power
             for f in nom.faces.faces:
-                for rc in raysList:
-                    rca = rc.copy_as_array()
-                    selected = rca[rca['end_face_idx']==f.idx]
-                    E1_amp = selected['E1_amp']
-                    E2_amp = selected['E2_amp']
-                    n = selected['refractive_index'].real
-                    nom_count += (n*E1_amp*E1_amp.conjugate()).real.sum() +\
-                                (n*E2_amp*E2_amp.conjugate()).real.sum()
+                nom_count += tally.face_power(f.idx, f.n_idx)
             
     #print "nom and denom counts", nom_count, denom_count
         try:
@@ -18,6 +18,7 @@
 
 import numpy
 import itertools
+import collections
 
 from traits.api import HasTraits, Int, Float, \
      Bool, Property, Array, Event, List, cached_property, Str,\
@@ -28,7 +29,9 @@ from traitsui.api import View, Item, Tabbed, VGroup, Include, \
 
 from tvtk.api import tvtk
 
-from raytrace.ctracer import RayCollection, Ray, ray_dtype
+from raytrace.ctracer import RayCollection, Ray, RaySink, \
+            CompactRaySink, HitCacheSink, KeepAllSink, TerminalRaySink, \
+            GenerationFileSink, ray_dtype
 from raytrace.utils import normaliseVector, Range, TupleVector, Tuple, \
             UnitTupleVector, UnitVectorTrait
 from raytrace.bases import Renderable, RaytraceObject, NumEditor
@@ -52,7 +55,18 @@ class BaseRaySource(BaseBase):
     wavelength_list = List() #List of wavelengths (floats) given in microns
     
     InputRays = Property(Instance(RayCollection), depends_on="max_ray_len")
+    #every generation of full rays, when the model keeps them. Otherwise 
+    #empty; use get_traced_rays or get_generations to get what was kept
     TracedRays = List(RayCollection, transient=True)
+    ray_sink = Instance(RaySink, transient=True) #holds the rays from the last trace
+    hit_cache = Instance(HitCacheSink, transient=True) #the faces hit in the last trace
+    
+    #the record type for the traced rays which are kept. Anything other 
+    #than 'full' keeps compact arrays (see ctracer.compact_rays) on ray_sink,
+    #instead of TracedRays
+    retention = Enum("full", "power", "geometry", desc="the ray data kept "
+                     "after tracing: full records, end points and power, "
+                     "or end points only")
     
     InputDetailRays = Property(Instance(RayCollection), depends_on="InputRays")
     TracedDetailRays = List(RayCollection, transient=True)
@@ -104,32 +118,50 @@ class BaseRaySource(BaseBase):
     def __repr__(self):
         return self.name
     
-    def get_sequence_to_face(self, face):
+    def get_traced_rays(self):
+        """returns the list of traced RayCollections. These are kept in 
+        TracedRays with full ray retention, or read back from disk when 
+        the rays were written there. With the other retention settings 
+        the full ray records are not kept, and a ValueError is raised."""
+        sink = self.ray_sink
+        if self.TracedRays or sink is None or isinstance(sink, KeepAllSink):
+            return list(self.TracedRays)
+        if isinstance(sink, GenerationFileSink):
+            return [RayCollection.from_array(numpy.array(sink.load(i), dtype=ray_dtype))
+                    for i in range(len(sink.filenames))]
+        raise ValueError("%s kept only %s rays. This needs every generation "
+                         "of full rays: set the model's ray_retention to 'all' "
+                         "or 'disk' and the source's retention to 'full'."%(
+                                self.name, "terminal" if isinstance(sink, TerminalRaySink) 
+                                                      else "compact"))
+    
+    def get_sequence_to_face(self, face, all_faces=None):
         """returns a list of list of Face objects, those encountered
-        on the route to the target face"""
+        on the route to the target face. If all_faces (the tracer's
+        idx_faces, which gives the face for each idx) isn't given, the 
+        faces are given by their idx"""
+        traced_rays = self.get_traced_rays()
         #find the first RayCollection which contains the target face
-        for rays in self.TracedRays[1:]:
-            faces = list(rays.face)
-            if face in faces:
+        for gen, rays in enumerate(traced_rays):
+            ids = numpy.flatnonzero(face.owns_idx(rays.end_face_idx))
+            if len(ids):
                 break
         else:
             raise ValueError("no rays trace to this face")
         
-        seq = []
-        
         #now iterate back up the ray-tree collecting only the faces
         #on the path to the target face
-        parent = rays.parent
-        ids = rays.parent_ids[face==rays.face]
-        while True:
-            if parent == self.TracedRays[0]:
-                break
-            faces = list(numpy.unique1d(parent.face[ids]))
-            seq.append(faces)
-            ids = parent.parent_ids[ids]
+        seq = []
+        for parent in reversed(traced_rays[:gen]):
+            ids = rays.parent_idx[ids]
+            seq.append(list(numpy.unique(parent.end_face_idx[ids])))
             rays = parent
-            parent = rays.parent
         seq.reverse()
+        if all_faces is not None:
+            #a face with several idx values is listed once
+            seq = [list(collections.OrderedDict((all_faces[i], None) 
+                                                for i in faces)) 
+                   for faces in seq]
         return seq
 
 
@@ -138,51 +170,58 @@ class BaseRaySource(BaseBase):
         , and the inner index is the recursion # backwards (0 being the ray that dies, 1 is its parent, and so on) 
         and the dictionary keys are the attributes of the ray object"""
         result = []
-        #keys is copy and pasted from the dtype of a ray object
-        keys = ['origin','direction','normal','E_vector','refractive_index','E1_amp','E2_amp','length','wavelength','parent_idx','end_face_idx']
-        #start at the last ray collection and work backwards
-        temp = list(self.TracedRays)    #otherwise its a TraitListObject
-        raycollections = []             #make data a list of lists of lists
-        for raycollection in temp:
-            tmp = []
-            for x in raycollection.copy_as_array():
-                tmp.append(list(x))
-            raycollections.append(tmp)
-
-        length = len(raycollections)-1
-
-        for i,collection in enumerate(reversed(raycollections)):
-            for ray in collection:
-                if ray:                  #rays already accounted for are set to none
-                    lst = []             #list to contain all relevant dictionaries for each ray
-                    r = {}               #the first dictionary
-                    for x,att in enumerate(ray):
-                        r[keys[x]] = att 
-                    lst.append(r)
-                    cntr = length-i
-                    cntr -= 1
-                    parent_idx = r['parent_idx']
-                    while cntr >= 0:     #iterate back through the ray collections
-                        r = {}          #and repeat what we did for the first ray
-                        arr = raycollections[cntr][parent_idx]
-                        for x,att in enumerate(arr):
-                            r[keys[x]] = att 
-                        lst.append(r.copy())
-                        raycollections[cntr][parent_idx] = None     #mark this ray done
-                        cntr -= 1
-                        parent_idx = r['parent_idx']
-                    result.append(lst)
-
-        
+        keys = ray_dtype.names
+        arrays = [rays.copy_as_array() for rays in self.get_traced_rays()]
+        done = [numpy.zeros(len(a), bool) for a in arrays]
+        #start at the last ray collection and work backwards. The ancestors
+        #of each ray are looked up a generation at a time, for all the rays
+        #of a generation together
+        for gen in reversed(range(len(arrays))):
+            ids = numpy.flatnonzero(~done[gen])
+            chain = [arrays[gen][ids]]
+            for parent in reversed(range(gen)):
+                ids = chain[-1]['parent_idx']
+                done[parent][ids] = True     #mark these rays done
+                chain.append(arrays[parent][ids])
+            for i in range(len(chain[0])):
+                result.append([dict(zip(keys, segment[i])) for segment in chain])
         return result
 
+    def get_generations(self):
+        """returns a list of structured arrays, one for each generation of
+        traced rays, whatever the ray retention. These have ray_dtype, 
+        except with compact retention, where they are the compact arrays 
+        (see ctracer.compact_rays), and with terminal retention, where 
+        each holds only the terminal rays of its generation"""
+        sink = self.ray_sink
+        if isinstance(sink, CompactRaySink):
+            return list(sink.generations)
+        if isinstance(sink, TerminalRaySink):
+            return list(sink.terminal)
+        if isinstance(sink, GenerationFileSink):
+            return [sink.load(i) for i in range(len(sink.filenames))]
+        return [numpy.asarray(rays) for rays in self.TracedRays]
+
+    def get_segments(self):
+        """returns a list of (start, end) arrays giving the end points of
+        the traced rays which were kept, for each generation (see 
+        get_generations)"""
+        segments = []
+        for g in self.get_generations():
+            if 'termination' in g.dtype.names:
+                end = g['termination']
+            else:
+                end = g['origin'] + g['direction']*g['length'][:,None]
+            segments.append((g['origin'], end))
+        return segments
+
     def eval_angular_spread(self, idx):
         """A helper method to evaluate the angular spread of a ray-segment.
         @param idx: the index of the RayCollection in the TracedRay list 
                     to analyse
                     
         @returns: the average angle from the mean ray, in degrees"""
-        rays = self.TracedRays[idx]
+        rays = self.get_traced_rays()[idx]
         ave_dir = normaliseVector(rays.direction.mean(axis=0))
         dotprod = (ave_dir[numpy.newaxis,:] * rays.direction).sum(axis=1)
         angles = numpy.arccos(dotpod)*180 / numpy.pi
@@ -193,7 +232,7 @@ class BaseRaySource(BaseBase):
             from raytrace.step_export import make_rays_both as make_rays
         else:
             from raytrace.step_export import make_rays_wires as make_rays
-        return make_rays(self.TracedRays, self.scale_factor), "red"
+        return make_rays(self.get_traced_rays(), self.scale_factor), "red"
     
     def _TracedRays_changed(self):
         self.data_source.modified()
@@ -217,9 +256,13 @@ class BaseRaySource(BaseBase):
     def _normals_source_default(self):
         source = tvtk.ProgrammableSource()
         def execute():
+            gens = [g for g in self.get_generations() 
+                    if 'normal' in g.dtype.names]
+            if not gens:
+                return
             output = source.poly_data_output
-            points = numpy.vstack([p.origin for p in self.TracedRays])
-            normals = numpy.vstack([p.normal for p in self.TracedRays])
+            points = numpy.vstack([g['origin'] for g in gens])
+            normals = numpy.vstack([g['normal'] for g in gens])
             output.points = points
             output.point_data.normals = normals
             #print("calc normals GLYPH")
@@ -245,18 +288,15 @@ class BaseRaySource(BaseBase):
         def execute():
             output = source.poly_data_output
             pointArrayList = []
-            for rays in self.TracedRays:                
-                start_pos = [r.origin for r in rays]
-                end_pos = [r.termination for r in rays]
-                #print "start", start_pos
-                #print "end", end_pos
-                interleaved = numpy.array([start_pos, end_pos]).swapaxes(0,1).reshape(-1,3)
+            for start_pos, end_pos in self.get_segments():
+                interleaved = numpy.empty((2*len(start_pos),3), 'd')
+                interleaved[0::2] = start_pos
+                interleaved[1::2] = end_pos
                 pointArrayList.append(interleaved)
             if pointArrayList:
                 points = numpy.vstack(pointArrayList)
                 output.points=points
-                lines = list([i,i+1] for i in range(0,points.shape[0],2))
-                output.lines = lines
+                output.lines = numpy.arange(points.shape[0]).reshape(-1,2)
         source.set_execute_method(execute)
         return source
     
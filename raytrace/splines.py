@@ -260,9 +260,7 @@ class Extruded_interpolant(Extruded_bezier):
         self.tck, self.uout = [tck,uout]
         self.control_points = b_spline_to_bezier_series(tck)
         print("splprep used ",len(self.control_points), " faces to make this spline")
-        if len(self.control_points) > 30:
-            print("!!! thats alot of faces.  try adjusting smoothness.")
-            #need imperfection statistics
+        #need imperfection statistics
 
         return super(Extruded_interpolant,Extruded_interpolant).make_faces(self)                                
         
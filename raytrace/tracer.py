@@ -37,6 +37,8 @@ import numpy
 import threading, os, itertools
 import os
 import traceback
+import tempfile
+import shutil
 import yaml
 from contextlib import contextmanager
 from itertools import chain, islice, count
@@ -163,10 +165,17 @@ class RayTraceModel(HasQueue):
     optical_path = Float(0.0, transient=True)
     
     all_faces = List(ctracer.Face, desc="global list of all faces, created automatically "
-                     " when a tracing operation is initiated. Ray end_face_idx "
-                     "can be used to index this list")
+                     " when a tracing operation is initiated. Each face is "
+                     "listed once")
+    idx_faces = List(ctracer.Face, desc="the face for each value of ray end_face_idx. "
+                     "A face with several idx values (see Face.n_idx) is listed "
+                     "at each of them")
     face_sets = List(ctracer.FaceList, desc="list of FaceLists extracted from all "
                      "optics when a tracing operation is initiated")
+    bvh = Instance(ctracer.SceneBVH, desc="bounding volume hierarchy over all faces, "
+                     "rebuilt when a tracing operation is initiated", transient=True)
+    ray_arena = Instance(ctracer.RayArena, (), desc="memory for the traced rays, "
+                     "reused from one tracing operation to the next", transient=True)
     
     update = Event() #triggers a tracing operation
     _updating = Bool(False) #indicating that tracing is in progress
@@ -179,6 +188,21 @@ class RayTraceModel(HasQueue):
     ShellObj = PythonValue({}, transient=True)
         
     recursion_limit = Int(200, desc="maximum number of refractions or reflections")
+    num_threads = Int(0, desc="number of threads used for tracing. Zero uses "
+                      "the OpenMP default (usually one per core)")
+    power_cutoff = Float(0.0, desc="rays with less power than this are terminated")
+    relative_power_cutoff = Float(0.0, desc="rays with less than this fraction of "
+                      "the power of the source's strongest ray are terminated")
+    russian_roulette = Bool(False, desc="terminate rays below the power cutoff at "
+                      "random, reweighting the survivors so the power is unbiased")
+    hit_cache = Bool(False, desc="test the faces hit by the previous trace of each "
+                      "source first, to speed up retracing")
+    ray_retention = Enum("all", "terminal", "disk", desc="which traced rays are "
+                      "kept: every generation, only the terminal rays, or every "
+                      "generation written to disk")
+    ray_directory = Str("", desc="directory for rays written to disk. A temporary "
+                      "directory is used if this is empty")
+    _ray_tempdir = Str("", transient=True) #the temporary directory, once made
     
     save_btn = Button("Save scene")
     
@@ -293,6 +317,8 @@ class RayTraceModel(HasQueue):
             self.prepare_to_trace()
             for o in optics:
                 o.intersections = []
+            for r in self.results:
+                r.prepare_to_trace(self)
             for ray_source in self.sources:
                 self.trace_ray_source(ray_source, optics)
             for o in optics:
@@ -351,16 +377,26 @@ class RayTraceModel(HasQueue):
         """Called before a tracing operation is performed, to do
         all synchronisation between optics and their faces
         """
+        self.sync_faces()
+        self.bvh = ctracer.SceneBVH(self.face_sets)
+        
+    def sync_faces(self):
+        """Numbers the faces of all the optics, and updates their parameters
+        and transforms from the optics
+        """
         face_sets = [o.faces for o in self.optics]
         all_faces = list(itertools.chain(*(fs.faces for fs in face_sets)))
-        for i, f in enumerate(all_faces):
-            f.idx = i
+        idx_faces = []
+        for f in all_faces:
             f.count = 0 #reset intersection count
             f.update()
+            f.idx = len(idx_faces)
+            idx_faces.extend([f]*f.n_idx)
         for fs in face_sets:
             fs.sync_transforms()
             
         self.all_faces = all_faces
+        self.idx_faces = idx_faces
         self.face_sets = face_sets
         
     def trace_ray_source(self, ray_source, optics):
@@ -368,59 +404,108 @@ class RayTraceModel(HasQueue):
         max_length = ray_source.max_ray_len
         rays = ray_source.InputRays #FIXME
         rays.reset_length()
-        traced_rays = []
-        limit = self.recursion_limit
-        count = 0
         face_sets = list(self.face_sets)
-        all_faces = list(self.all_faces)
         wavelengths = numpy.ascontiguousarray(ray_source.wavelength_list, numpy.double)
-        for face in all_faces:
+        for face in self.all_faces:
             face.material.wavelengths = wavelengths
             face.max_length = max_length
+        sinks = [self.make_ray_sink(ray_source)]
+        hint = ray_source.hit_cache if self.hit_cache else None
+        if self.hit_cache:
+            sinks.append(ctracer.HitCacheSink())
+        for r in self.results:
+            sink = r.get_sink(ray_source)
+            if sink is not None:
+                sinks.append(sink)
         try:
-            while rays.n_rays>0 and count<limit:
-                #print "count", count
-                traced_rays.append(rays)
-                rays = ctracer.trace_segment(rays, face_sets, all_faces, 
-                                             max_length=max_length)
-                count += 1
-            ray_source.TracedRays = traced_rays
+            traced_rays = ctracer.trace_rays(rays, face_sets, list(self.idx_faces),
+                                             max_length=max_length,
+                                             recursion_limit=self.recursion_limit,
+                                             bvh=self.bvh,
+                                             num_threads=self.num_threads,
+                                             arena=self.ray_arena,
+                                             power_cutoff=self.power_cutoff,
+                                             relative_power_cutoff=self.relative_power_cutoff,
+                                             russian_roulette=self.russian_roulette,
+                                             hint=hint,
+                                             sink=ctracer.SinkGroup(sinks))
+            ray_source.ray_sink = sinks[0]
+            ray_source.hit_cache = sinks[1] if self.hit_cache else None
+            if self.ray_retention == "all" and ray_source.retention == "full":
+                ray_source.TracedRays = traced_rays
+            else:
+                ray_source.TracedRays = []
         finally:
             ray_source.data_source.modified()
+            
+    def make_ray_sink(self, ray_source):
+        """Creates the RaySink which keeps the rays traced from the given 
+        source, according to ray_retention and the source's retention 
+        profile
+        """
+        if self.ray_retention == "terminal":
+            return ctracer.TerminalRaySink()
+        elif self.ray_retention == "disk":
+            name = "source%d"%self.sources.index(ray_source)
+            if self.ray_directory:
+                directory = os.path.join(self.ray_directory, name)
+            else:
+                #one temporary directory serves every trace of the model;
+                #the previous trace's rays for this source are replaced
+                if not self._ray_tempdir:
+                    self._ray_tempdir = tempfile.mkdtemp(prefix="raytrace")
+                directory = os.path.join(self._ray_tempdir, name)
+                shutil.rmtree(directory, ignore_errors=True)
+            return ctracer.GenerationFileSink(directory)
+        elif ray_source.retention != "full":
+            return ctracer.CompactRaySink(ray_source.retention)
+        return ctracer.KeepAllSink()
+        
+    def dispose(self):
+        """Removes the temporary directory holding the rays written to 
+        disk, if any. The ray sinks of the sources can no longer load them.
+        """
+        if self._ray_tempdir:
+            shutil.rmtree(self._ray_tempdir, ignore_errors=True)
+            self._ray_tempdir = ""
         
-    def trace_sequence(self, input_rays, faces_sequence):
+    def trace_sequence(self, input_rays, faces_sequence, max_length=100.0,
+                       wavelengths=None):
         """
-        Perform a sequential ray-trace.
+        Perform a sequential ray-trace. Each generation of rays is only
+        intersected with the next item of faces_sequence, rather than every
+        face in the model. Rays which miss are terminated. Only the small
+        search structures for the faces of the sequence are built, so 
+        repeated sequential traces (e.g. for tolerancing) stay cheap.
         
         @param input_rays: a RayCollection instance
-        @param optics_sequence: a list of Face instances or lists of Faces
+        @param faces_sequence: a list of Face instances or lists of Faces
+        @param max_length: the maximum length of each ray segment
+        @param wavelengths: the wavelengths (in microns) indexed by the 
+                rays' wavelength_idx. If not given, the face materials keep
+                the wavelengths set by the last full trace; a ValueError is
+                raised if a material which needs them has none.
         
         returns - the traced rays, as a list of RayCollections including
                 the initial input rays
         """
-        traced_rays = [rays]
-        rays = input_rays
-        for faces in faces_sequence:
-            if isinstance(faces, Face):
-                intersections = face.trace_rays(rays)
-                mask = intersections['length']!=numpy.Infinity
-                intersections = intersections[mask]
-                points = intersections['point']
-                children = face.eval_children(rays, points)
-            else:
-                intersections = numpy.column_stack([f.trace_rays(rays) for f in faces])
-                shortest = numpy.argmin(intersections['length'], axis=1)
-                ar = numpy.arange(size)
-                lengths = intersections['length'][ar,shortest]
-                
-                #now remove infinite rays
-                mask = lengths!=numpy.Infinity
-                shortest = shortest[mask]
-                ar = ar[mask]
-                
-            rays = children
-            traces_rays.append(rays)
-        return traced_rays
+        self.sync_faces()
+        if wavelengths is not None:
+            wavelengths = numpy.ascontiguousarray(wavelengths, numpy.double)
+        for face in self.all_faces:
+            if wavelengths is not None:
+                face.material.wavelengths = wavelengths
+            face.max_length = max_length
+        input_rays.reset_length()
+        return ctracer.trace_sequence(input_rays, list(faces_sequence),
+                                      list(self.face_sets), 
+                                      list(self.idx_faces),
+                                      max_length=max_length,
+                                      num_threads=self.num_threads,
+                                      arena=self.ray_arena,
+                                      power_cutoff=self.power_cutoff,
+                                      relative_power_cutoff=self.relative_power_cutoff,
+                                      russian_roulette=self.russian_roulette)
     
     def _save_btn_changed(self):
         dlg = FileDialog(action="save as",
@@ -53,6 +53,20 @@ ext_modules = cythonize("raytrace/*.pyx",
                         language="c++",
                         include_path=[numpy.get_include()])
 
+###The tracer uses OpenMP (via cython.parallel.prange) to trace rays on 
+###multiple cores. Without OpenMP support, the loops simply run serially.
+if sys.platform.startswith('win32'):
+    openmp_compile_args, openmp_link_args = ['/openmp'], []
+elif sys.platform == 'darwin':
+    #Apple's clang ships without OpenMP
+    openmp_compile_args, openmp_link_args = [], []
+else:
+    openmp_compile_args, openmp_link_args = ['-fopenmp'], ['-fopenmp']
+    
+for ext in ext_modules:
+    ext.extra_compile_args += openmp_compile_args
+    ext.extra_link_args += openmp_link_args
+
 setup(
     name="raytrace",
     version="0.1dev",
@@ -56,6 +56,12 @@ class TestCircularFace(unittest.TestCase):
         import numpy
         self.assertEqual(dist, 0.0)
 
+    def test_bounds(self):
+        o = AnOwner(diameter=5.0, offset=1.0)
+        c = cfaces.CircularFace(owner=o, z_plane=2.0)
+        c.update()
+        self.assertEqual(c.bounds(), ((-1.5,-2.5,2.0),(3.5,2.5,2.0)))
+
 
 class TestExtrudedFace(unittest.TestCase):
     def setUp(self):
@@ -79,5 +85,260 @@ class TestExtrudedFace(unittest.TestCase):
         dist = self.f.intersect((-5,2.1,-1),(5,2.1,1))
         self.assertEqual(dist, 0.0)
 
+    def test_bounds(self):
+        self.assertEqual(self.f.bounds(), ((-2.,-2.,-1.),(2.,2.,3.)))
+
+
+class TestExtrudedPolygonFace(unittest.TestCase):
+    def setUp(self):
+        import numpy
+        theta = numpy.linspace(0, 2*numpy.pi, 60, endpoint=False)
+        r = 1.0 + 0.3*numpy.sin(5*theta)
+        self.pts = numpy.column_stack([r*numpy.cos(theta), r*numpy.sin(theta)])
+        self.f = cfaces.ExtrudedPolygonFace(xy_points=self.pts, z1=-1, z2=1)
+        self.sides = [cfaces.ExtrudedPlanarFace(z1=-1, z2=1, x1=x1, y1=y1, 
+                                                x2=x2, y2=y2)
+                      for (x2,y2),(x1,y1) in zip(self.pts, 
+                                                 numpy.roll(self.pts,-1,0))]
+
+    def test_bounds(self):
+        lo, hi = self.f.bounds()
+        self.assertEqual(lo[:2], tuple(self.pts.min(axis=0)))
+        self.assertEqual(hi[:2], tuple(self.pts.max(axis=0)))
+        self.assertEqual((lo[2], hi[2]), (-1, 1))
+
+    def test_matches_planar_faces(self):
+        import numpy
+        rnd = numpy.random.RandomState(4)
+        p1 = rnd.uniform(-2, 2, (500,3))
+        p2 = p1 + rnd.normal(size=(500,3))*2
+        dist = self.f.intersect_batch(p1, p2)
+        lengths = numpy.sqrt(((p2-p1)**2).sum(axis=1))
+        side_dist = numpy.array([s.intersect_batch(p1, p2) for s in self.sides])
+        side_dist[(side_dist <= self.f.tolerance) | (side_dist >= lengths)] = numpy.inf
+        nearest = side_dist.min(axis=0)
+        nearest[numpy.isinf(nearest)] = 0
+        self.assertTrue((dist>0).sum() > 50)
+        self.assertTrue(numpy.allclose(dist, nearest))
+        
+        edge = side_dist.argmin(axis=0)
+        for i in numpy.flatnonzero(dist):
+            p = p1[i] + (p2[i]-p1[i])*dist[i]/lengths[i]
+            self.assertEqual(self.f.edge_index(p), edge[i])
+            self.assertEqual(self.f.compute_normal(p), 
+                             self.sides[edge[i]].compute_normal(p))
+
+    def test_hit_normal(self):
+        fl = ctracer.FaceList()
+        fl.faces = [self.f]
+        rays = ctracer.RayCollection(1)
+        rays.add_ray(ctracer.Ray(origin=(0.1,0.,0.2), direction=(1.,0.,0.),
+                                 E_vector=(0,0,1), E1_amp=1.0))
+        children = ctracer.trace_segment(rays, [fl], [self.f]*self.f.n_idx)
+        self.assertEqual(children.n_rays, 1)
+        point = rays[0].termination
+        self.assertAlmostEqual(point[0], 1.0)
+        n = self.sides[self.f.edge_index(point)].compute_normal(point)
+        for a, b in zip(children[0].normals, n):
+            self.assertAlmostEqual(a, b)
+
+    def test_edge_idx(self):
+        import numpy
+        self.assertEqual(self.f.n_idx, 60)
+        self.f.idx = 3
+        all_faces = [cfaces.CircularFace()]*3 + [self.f]*self.f.n_idx
+        fl = ctracer.FaceList()
+        fl.faces = [self.f]
+        bvh = ctracer.SceneBVH([fl])
+        rnd = numpy.random.RandomState(5)
+        origins = numpy.column_stack([rnd.uniform(-0.45, 0.45, (200,2)), 
+                                      numpy.zeros(200)])
+        theta = rnd.uniform(0, 2*numpy.pi, 200)
+        rays = ctracer.RayCollection(200)
+        for o, t in zip(origins, theta):
+            rays.add_ray(ctracer.Ray(origin=o, direction=(numpy.cos(t), numpy.sin(t), 0),
+                                     E_vector=(0,0,1), E1_amp=1.0))
+        ctracer.trace_segment(rays, [fl], all_faces, bvh=bvh)
+        idx = rays.end_face_idx
+        self.assertTrue(numpy.all((idx >= 3) & (idx < 63)))
+        for i in range(200):
+            edge = self.f.edge_index(rays[i].termination)
+            self.assertEqual(idx[i], 3 + edge)
+            r = ctracer.Ray(origin=origins[i], direction=rays[i].direction,
+                            length=100)
+            self.assertEqual(fl.intersect(r, 100), 3 + edge)
+        with self.assertRaises(ValueError):
+            ctracer.trace_segment(rays, [fl], [self.f])
+        
+        self.assertTrue(self.f.owns_idx(idx).all())
+        self.assertEqual(list(self.f.owns_idx([2, 3, 62, 63])), 
+                         [False, True, True, False])
+        self.assertEqual(list(self.f.idx_range()), list(range(3, 63)))
+        tally = ctracer.FaceTally()
+        tally.add_generation(rays, None)
+        self.assertEqual(tally.face_count(self.f.idx, self.f.n_idx), 200)
+        self.assertTrue(tally.face_count(self.f.idx) < 200)
+
+
+class TestExtrudedBezierFace(unittest.TestCase):
+    def setUp(self):
+        import numpy
+        #the parabola y = x**2/4 as four cubic segments
+        def segment(x0, x1):
+            h = (x1-x0)/3.
+            return [[x0, x0**2/4], [x0+h, x0**2/4 + h*x0/2],
+                    [x1-h, x1**2/4 - h*x1/2], [x1, x1**2/4]]
+        curves = numpy.array([segment(x, x+1.) for x in (-2.,-1.,0.,1.)])
+        self.f = cfaces.ExtrudedBezierFace(beziercurves=curves, 
+                                           z_height_1=-1., z_height_2=1.)
+
+    def test_bounds(self):
+        self.assertEqual(self.f.n_segs, 4)
+        self.assertEqual(self.f.bounds(), ((-2.,0.,-1.),(2.,1.,1.)))
+
+    def test_intersection(self):
+        x = 1.5
+        dist = self.f.intersect((x,-1.,0.5),(x,3.,0.5))
+        self.assertAlmostEqual(dist, 1. + x**2/4)
+        n = self.f.compute_normal((x, x**2/4, 0.5))
+        self.assertAlmostEqual(abs(n[1]/n[0]), 2/x)
+        self.assertEqual(n[2], 0.0)
+
+    def test_hit_normal(self):
+        import numpy
+        fl = ctracer.FaceList()
+        fl.faces = [self.f]
+        for x in (-1.7, -0.3, 0.004, 0.02, 1.5):
+            rays = ctracer.RayCollection(1)
+            rays.add_ray(ctracer.Ray(origin=(x,-1.,0.2), direction=(0.,1.,0.),
+                                     E_vector=(0,0,1), E1_amp=1.0))
+            children = ctracer.trace_segment(rays, [fl], [self.f])
+            self.assertEqual(children.n_rays, 1)
+            self.assertAlmostEqual(rays[0].length, 1 + x**2/4)
+            n = numpy.array([-x/2, 1., 0.])
+            n /= numpy.sqrt((n**2).sum())
+            for a, b in zip(children[0].normals, n):
+                self.assertAlmostEqual(a, b)
+
+    def test_inside_bounds(self):
+        #a ray starting and ending within the x-y bounds of the spline
+        dist = self.f.intersect((0.5,0.5,0.),(0.5,-0.5,0.))
+        self.assertAlmostEqual(dist, 0.5 - 0.5**2/4)
+
+    def test_many_segments(self):
+        import numpy
+        xs = numpy.linspace(-2., 2., 301)
+        h = numpy.diff(xs)/3
+        x0, x1 = xs[:-1], xs[1:]
+        curves = numpy.stack([numpy.column_stack([x0, x0**2/4]),
+                              numpy.column_stack([x0+h, x0**2/4 + h*x0/2]),
+                              numpy.column_stack([x1-h, x1**2/4 - h*x1/2]),
+                              numpy.column_stack([x1, x1**2/4])], axis=1)
+        f = cfaces.ExtrudedBezierFace(beziercurves=curves, 
+                                      z_height_1=-1., z_height_2=1.)
+        self.assertEqual(f.n_segs, 300)
+        self.assertEqual(f.bounds(), self.f.bounds())
+        rnd = numpy.random.RandomState(5)
+        p1 = rnd.uniform(-3, 3, (500,3))
+        p2 = p1 + rnd.normal(size=(500,3))*3
+        d1 = f.intersect_batch(p1, p2)
+        d2 = self.f.intersect_batch(p1, p2)
+        self.assertTrue((d1>0).sum() > 20)
+        self.assertTrue(numpy.allclose(d1, d2))
+
+    def test_miss(self):
+        self.assertEqual(self.f.intersect((1.5,-1.,1.5),(1.5,3.,1.5)), 0.0)
+        
+    def test_no_segments(self):
+        import numpy
+        f = cfaces.ExtrudedBezierFace(beziercurves=numpy.zeros((0,4,2)),
+                                      z_height_1=-1., z_height_2=1.)
+        self.assertEqual(f.n_segs, 0)
+        self.assertEqual(f.bounds(), ((0.,0.,-1.),(0.,0.,1.)))
+        self.assertEqual(f.intersect((0.,-1.,0.),(0.,1.,0.)), 0.0)
+        self.assertEqual(self.f.intersect((2.5,-1.,0.),(2.5,3.,0.)), 0.0)
+        self.assertEqual(self.f.intersect((1.5,-1.,0.),(1.5,0.,0.)), 0.0)
+
+class TestEllipsoidalFace(unittest.TestCase):
+    def test_hit_normal(self):
+        import numpy
+        f = cfaces.EllipsoidalFace()
+        c, s = numpy.cos(0.3), numpy.sin(0.3)
+        f.transform = ctracer.Transform(rotation=[[c,-s,0],[s,c,0],[0,0,1]],
+                                        translation=(0.5,0,0))
+        f.inverse_transform = ctracer.Transform(rotation=[[c,s,0],[-s,c,0],[0,0,1]],
+                                        translation=(-0.5*c,0.5*s,0))
+        f.major, f.minor = 3.0, 2.0
+        f.x1, f.x2, f.y1, f.y2, f.z1, f.z2 = -5, 5, -5, 5, -5, 5
+        fl = ctracer.FaceList()
+        fl.faces = [f]
+        rays = ctracer.RayCollection(1)
+        rays.add_ray(ctracer.Ray(origin=(0.2,0.1,0.3), direction=ctracer.norm((1,0.5,0.2)),
+                                 E_vector=(0,0,1), E1_amp=1.0))
+        children = ctracer.trace_segment(rays, [fl], [f])
+        self.assertEqual(children.n_rays, 1)
+        point = rays[0].termination
+        n = f.compute_normal(point)
+        for a, b in zip(children[0].normals, n):
+            self.assertAlmostEqual(a, b)
+
+
+class TestPolygonFace(unittest.TestCase):
+    def test_matches_point_in_polygon(self):
+        import numpy
+        rnd = numpy.random.RandomState(2)
+        #a star-shaped polygon with many vertices
+        theta = numpy.linspace(0, 2*numpy.pi, 400, endpoint=False)
+        r = 1.0 + 0.5*numpy.sin(7*theta) + 0.1*rnd.uniform(size=400)
+        pts = numpy.column_stack([r*numpy.cos(theta), r*numpy.sin(theta)])
+        f = cfaces.PolygonFace(z_plane=0.5, xy_points=pts)
+        p1 = rnd.uniform(-2,2,(1000,3))
+        p1[:,2] = -1.0
+        p2 = p1.copy()
+        p2[:,2] = 1.0
+        dist = f.intersect_batch(p1, p2)
+        for a, dist_a in zip(p1, dist):
+            inside = cfaces.point_in_polygon(a[0], a[1], pts)
+            self.assertEqual(dist_a, 1.5 if inside else 0.0)
+            self.assertEqual(f.intersect(a, a+(0,0,2)), dist_a)
+        self.assertTrue(200 < (dist>0).sum() < 800)
+        
+    def test_set_points(self):
+        f = cfaces.PolygonFace()
+        self.assertEqual(f.intersect((0.5,0.5,-1),(0.5,0.5,1)), 0.0)
+        f.xy_points = [[0,0],[1,0],[1,1],[0,1]]
+        self.assertEqual(f.intersect((0.5,0.5,-1),(0.5,0.5,1)), 1.0)
+        self.assertEqual(f.intersect((1.5,0.5,-1),(1.5,0.5,1)), 0.0)
+
+
+class TestBatchIntersect(unittest.TestCase):
+    def make_faces(self):
+        faces = [cfaces.CircularFace(owner=AnOwner(diameter=5.0, offset=0.5), 
+                                     z_plane=0.2),
+                 cfaces.RectangularFace(owner=AnOwner(length=4.0, width=3.0, 
+                                                      offset=0.5)),
+                 cfaces.SphericalFace(owner=AnOwner(diameter=5.0), z_height=0.3),
+                 cfaces.SphericalFace(owner=AnOwner(diameter=5.0), z_height=0.3),
+                 cfaces.PolygonFace(z_plane=0.1, 
+                            xy_points=[[-2,-2],[2,-1.5],[1.5,2],[-1,1]])]
+        for f in faces[:4]:
+            f.update()
+        faces[2].curvature = 4.0
+        faces[3].curvature = -4.0
+        return faces
+
+    def test_matches_intersect(self):
+        import numpy
+        rnd = numpy.random.RandomState(3)
+        p1 = rnd.uniform(-3,3,(200,3))
+        p1[:,2] = rnd.uniform(-5,-1,200)
+        p2 = rnd.uniform(-3,3,(200,3))
+        p2[:,2] = rnd.uniform(1,5,200)
+        for f in self.make_faces():
+            dist = f.intersect_batch(p1, p2)
+            expected = [f.intersect(tuple(a), tuple(b)) for a,b in zip(p1,p2)]
+            self.assertTrue(numpy.allclose(dist, expected), f)
+            self.assertTrue((dist>0).any())
+
 if __name__=="__main__":
     unittest.main()
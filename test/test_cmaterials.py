@@ -10,7 +10,7 @@ import sys
 # sys.path.append('..')
 from raytrace.cmaterials import FullDielectricMaterial, Convert_to_SP, \
     TransparentMaterial, WaveplateMaterial, CoatedDispersiveMaterial, \
-    BaseDispersionCurve, SingleLayerCoatedMaterial
+    BaseDispersionCurve, SingleLayerCoatedMaterial, PECMaterial
 from raytrace.ctracer import Ray, RayCollection, norm, dotprod, subvv, cross
 from raytrace.dispersion import NondispersiveCurve
 import unittest
@@ -577,7 +577,88 @@ class TestDispersionMaterial(unittest.TestCase):
         self.assertAlmostEqual(abs(dotprod(out[1].direction,
                                             trans_direction)), 1)
 
-
+    def test_coating_thickness(self):
+        mat = CoatedDispersiveMaterial(dispersion_inside=NondispersiveCurve(1.5),
+                                       dispersion_coating=NondispersiveCurve(1.38),
+                                       coating_thickness=0.0,
+                                       reflection_threshold=0.0,
+                                       transmission_threshold=0.0)
+        mat.wavelengths = numpy.array([0.5, 0.6], 'd')
+        self.assertEqual(mat.n_coefs, 2)
+        
+        def reflected_power(wavelength_idx):
+            ray_in = Ray(origin=(0.0,0.0,-1.0), direction=(0.0,0.0,1.0),
+                         E_vector=(1.0,0.0,0.0), E1_amp=1.0, E2_amp=0.0,
+                         refractive_index=1.0)
+            ray_in.wavelength_idx = wavelength_idx
+            out = RayCollection(4)
+            mat.eval_child_ray(ray_in, 0, (0.0,0.0,0.0), (0.0,0.0,-1.0),
+                               (1.0,0.0,0.0), out)
+            return ray_power(out[0])
+        
+        bare = reflected_power(0)
+        self.assertAlmostEqual(bare, (0.5/2.5)**2)
+        ###quarter-wave coating at the first wavelength, set after the 
+        ###per-wavelength table is built
+        mat.coating_thickness = 0.5/(4*1.38)
+        self.assertLess(reflected_power(0), bare)
+        self.assertNotAlmostEqual(reflected_power(0), reflected_power(1))
+
+
+class TestBatchEval(unittest.TestCase):
+    def make_hits(self, n=50):
+        rnd = numpy.random.RandomState(3)
+        rays = RayCollection(n)
+        for i in range(n):
+            d = rnd.normal(size=3)
+            d[2] = abs(d[2]) + 0.2
+            rays.add_ray(Ray(origin=(0.,0.,-1.), direction=norm(d),
+                             E_vector=(1.,0.,0.), E1_amp=1.0+0.5j,
+                             E2_amp=0.3j, refractive_index=1.0))
+        normals = numpy.zeros((n,3))
+        normals[:,2] = numpy.where(numpy.arange(n)%3, -1.0, 1.0)
+        tangents = numpy.zeros((n,3))
+        tangents[:,0] = 1.0
+        points = rnd.normal(size=(n,3))
+        ray_idx = rnd.permutation(n)
+        return rays, ray_idx, points, normals, tangents
+    
+    def check(self, mat):
+        rays, ray_idx, points, normals, tangents = self.make_hits()
+        single = RayCollection(8)
+        for i, j in enumerate(ray_idx):
+            mat.eval_child_ray(rays[j], j, points[i], normals[i], tangents[i], 
+                               single)
+        batch = RayCollection(8)
+        mat.eval_children_batch(rays, ray_idx, points, normals, tangents, batch)
+        self.assertTrue(len(batch) > 0)
+        self.assertEqual(len(batch), len(single))
+        self.assertTrue((batch.copy_as_array() == single.copy_as_array()).all())
+        
+    def test_full_dielectric(self):
+        self.check(FullDielectricMaterial(n_inside=1.5, n_outside=1.1))
+        
+    def test_single_layer(self):
+        mat = SingleLayerCoatedMaterial(n_inside=1.5, n_coating=1.3)
+        mat.wavelengths = numpy.array([0.78], 'd')
+        self.check(mat)
+        
+    def test_pec(self):
+        self.check(PECMaterial())
+        
+    def test_transparent(self):
+        self.check(TransparentMaterial())
+        
+    def test_coated_dispersive(self):
+        mat = CoatedDispersiveMaterial(dispersion_inside=NondispersiveCurve(1.6),
+                                       dispersion_outside=NondispersiveCurve(1.0),
+                                       dispersion_coating=NondispersiveCurve(1.4),
+                                       reflection_threshold=0.01,
+                                       transmission_threshold=0.01)
+        mat.wavelengths = numpy.array([0.78], 'd')
+        self.check(mat)
+        
+        
 class TestDispersionCurve(unittest.TestCase):
     def test_sellmeier_2(self):
         coefs = numpy.array([0, 1.03961212, 0.00600069867, 0.231792344, 0.0200179144, 1.01046945, 103.560653])
@@ -10,6 +10,8 @@ import unittest
 from math import sqrt
 import random
 import numpy
+import tempfile
+import shutil
 
 
 class TestRayStructure(unittest.TestCase):
@@ -201,7 +203,9 @@ class TestRayCollection(unittest.TestCase):
         self.assertTrue(all(is_same))
 
     def test_from_array(self):
-        a = numpy.empty(5, dtype=ctracer.ray_dtype)
+        a = numpy.zeros(5, dtype=ctracer.ray_dtype)
+        a['origin'] = numpy.random.rand(5,3)
+        a['direction'] = numpy.random.rand(5,3)
         rc = ctracer.RayCollection.from_array(a)
         for i in range(len(a)):
             self.assertEqual(tuple(a[i]['origin']), tuple(rc[i].origin))
@@ -217,6 +221,54 @@ class TestRayCollection(unittest.TestCase):
         self.assertTrue( numpy.alltrue( rc.E2_amp==data['E2_amp'] ) )
         self.assertTrue( numpy.alltrue( rc.refractive_index==data['refractive_index'] ) )
 
+    def test_array_view(self):
+        rc = ctracer.RayCollection(10)
+        for i in range(4):
+            rc.add_ray(self.make_ray())
+        view = numpy.asarray(rc)
+        self.assertEqual(view.dtype, ctracer.ray_dtype)
+        self.assertEqual(view.shape, (4,))
+        self.assertTrue((view == rc.copy_as_array()).all())
+        #views are only writable if a writable buffer is requested
+        self.assertFalse(view.flags.writeable)
+        self.assertFalse(rc.origin.flags.writeable)
+        
+    def test_memoryview(self):
+        rc = ctracer.RayCollection(2)
+        rc.add_ray(self.make_ray())
+        view = memoryview(rc)
+        self.assertTrue(view.readonly)
+        self.assertEqual(view.shape, (1,))
+        self.assertEqual(view.itemsize, ctracer.get_ray_size())
+        self.assertRaises(BufferError, rc.add_ray, self.make_ray())
+        view.release()
+        rc.add_ray(self.make_ray())
+        self.assertEqual(rc.n_rays, 2)
+        
+    def test_no_resize_while_viewed(self):
+        rc = ctracer.RayCollection(2)
+        rc.add_ray(self.make_ray())
+        view = numpy.asarray(rc)
+        self.assertRaises(BufferError, rc.add_ray, self.make_ray())
+        del view
+        rc.add_ray(self.make_ray())
+        self.assertEqual(rc.n_rays, 2)
+        
+    def test_no_child_resize_while_viewed(self):
+        from raytrace.cmaterials import PECMaterial
+        rc = ctracer.RayCollection(1)
+        view = rc.origin
+        ray = self.make_ray()
+        m = PECMaterial()
+        self.assertRaises(BufferError, m.eval_child_ray, ray, 0, (0,0,0),
+                          (0,0,-1), (1,0,0), rc)
+        self.assertRaises(BufferError, m.eval_children_batch, rc, [], 
+                          numpy.zeros((0,3)), numpy.zeros((0,3)), 
+                          numpy.zeros((0,3)), rc)
+        del view
+        m.eval_child_ray(ray, 0, (0,0,0), (0,0,-1), (1,0,0), rc)
+        self.assertEqual(rc.n_rays, 1)
+
 
 class AnOwner(object):
     def __init__(self, **kwds):
@@ -250,6 +302,46 @@ class TestTransform(unittest.TestCase):
         self.assertEquals(sep(pt2,pt3), 0.0)
     """
 
+    class FakeMatrix(object):
+        def __init__(self, a):
+            self.a = a
+            self.reads = 0
+
+        def to_array(self):
+            self.reads += 1
+            return self.a.copy()
+
+    class FakeTransform(object):
+        """Mimics the parts of a tvtk.Transform used by sync_transforms"""
+        def __init__(self):
+            a = numpy.identity(4)
+            a[:3,3] = (1., 2., 3.)
+            self.matrix = TestTransform.FakeMatrix(a)
+            self.m_time = 1
+
+    def test_sync_transforms_cached(self):
+        t = self.FakeTransform()
+        fl = ctracer.FaceList(owner=AnOwner(transform=t))
+        fl.sync_transforms()
+        self.assertEqual(fl.transform.translation, (1., 2., 3.))
+        self.assertEqual(fl.inverse_transform.translation, (-1., -2., -3.))
+        fl.sync_transforms()
+        self.assertEqual(t.matrix.reads, 1)
+
+        t.matrix.a[:3,3] = (4., 5., 6.)
+        t.m_time = 2
+        fl.sync_transforms()
+        self.assertEqual(t.matrix.reads, 2)
+        self.assertEqual(fl.transform.translation, (4., 5., 6.))
+        pt = ctracer.transform(fl.inverse_transform, (4., 5., 6.))
+        self.assertEqual(pt, (0., 0., 0.))
+
+        #setting the transform directly invalidates the cache
+        fl.transform = ctracer.Transform()
+        fl.sync_transforms()
+        self.assertEqual(t.matrix.reads, 3)
+        self.assertEqual(fl.transform.translation, (4., 5., 6.))
+
 
 class TestTraceSegment(unittest.TestCase):
     def test_trace_segment(self):
@@ -277,6 +369,598 @@ class TestTraceSegment(unittest.TestCase):
         self.assertEqual(out_ray.direction, (1,0,-1))
 
 
+def make_scene(material=None):
+    """A set of randomly placed CircularFaces in 6 FaceLists"""
+    from raytrace import cfaces
+    rnd = random.Random(5)
+    face_sets = []
+    all_faces = []
+    for i in range(6):
+        fl = ctracer.FaceList()
+        a = rnd.uniform(0, 3)
+        c, s = numpy.cos(a), numpy.sin(a)
+        t = (rnd.uniform(-20,20), rnd.uniform(-20,20), rnd.uniform(-20,20))
+        fl.transform = ctracer.Transform(rotation=[[c,-s,0],[s,c,0],[0,0,1]],
+                                         translation=t)
+        fl.inverse_transform = ctracer.Transform(rotation=[[c,s,0],[-s,c,0],[0,0,1]],
+                                    translation=(-c*t[0]-s*t[1], s*t[0]-c*t[1], -t[2]))
+        faces = []
+        for j in range(8):
+            o = AnOwner(diameter=rnd.uniform(1,6), offset=rnd.uniform(-5,5))
+            f = cfaces.CircularFace(owner=o, z_plane=rnd.uniform(-5,5),
+                                    material=material)
+            f.update()
+            faces.append(f)
+        fl.faces = faces
+        face_sets.append(fl)
+        all_faces.extend(faces)
+    for i, f in enumerate(all_faces):
+        f.idx = i
+    return face_sets, all_faces
+
+
+def make_random_rays(n, seed=9):
+    rnd = random.Random(seed)
+    rays = ctracer.RayCollection(n)
+    for i in range(n):
+        origin = tuple(rnd.uniform(-30,30) for j in range(3))
+        direction = ctracer.norm([rnd.gauss(0,1) for j in range(3)])
+        rays.add_ray(ctracer.Ray(origin=origin, direction=direction,
+                                 E_vector=(direction[1], -direction[0], 0),
+                                 E1_amp=1.0, E2_amp=0.5, refractive_index=1.0))
+    return rays
+
+
+class TestSceneBVH(unittest.TestCase):
+    def test_intersect(self):
+        face_sets, all_faces = make_scene()
+        bvh = ctracer.SceneBVH(face_sets)
+        self.assertEqual(bvh.n_prims, len(all_faces))
+        self.assertEqual(bvh.n_unbounded, 0)
+        rnd = random.Random(7)
+        hits = 0
+        for i in range(500):
+            origin = tuple(rnd.uniform(-30,30) for j in range(3))
+            direction = tuple(rnd.gauss(0,1) for j in range(3))
+            r1 = ctracer.Ray(origin=origin, direction=direction, length=100)
+            r1.direction = ctracer.norm(direction)
+            r2 = ctracer.Ray(origin=origin, direction=r1.direction, length=100)
+            idx = -1
+            for fl in face_sets:
+                j = fl.intersect(r1, 100)
+                if j >= 0:
+                    idx = j
+            bvh_idx, set_idx = bvh.intersect(r2, 100)
+            self.assertEqual(idx, bvh_idx)
+            self.assertAlmostEqual(r1.length, r2.length)
+            if idx >= 0:
+                hits += 1
+                self.assertTrue(all_faces[idx] in face_sets[set_idx].faces)
+        self.assertTrue(hits > 10)
+
+    def test_tagged_faces(self):
+        """Discs and rectangles are intersected from their type tags, which 
+        must agree with their own intersect_c"""
+        from raytrace import cfaces
+        rnd = random.Random(11)
+        fl = ctracer.FaceList()
+        faces = []
+        for j in range(20):
+            if j%2:
+                o = AnOwner(diameter=rnd.uniform(1,6), offset=rnd.uniform(-5,5))
+                f = cfaces.CircularFace(owner=o, z_plane=rnd.uniform(-5,5))
+            else:
+                o = AnOwner(length=rnd.uniform(1,6), width=rnd.uniform(1,6),
+                            offset=rnd.uniform(-5,5))
+                f = cfaces.RectangularFace(owner=o, z_plane=rnd.uniform(-5,5))
+            f.update()
+            faces.append(f)
+        fl.faces = faces
+        for i, f in enumerate(faces):
+            f.idx = i
+        bvh = ctracer.SceneBVH([fl])
+        hits = 0
+        for i in range(500):
+            origin = (rnd.uniform(-8,8), rnd.uniform(-8,8), -10.0)
+            direction = ctracer.norm((rnd.gauss(0,0.3), rnd.gauss(0,0.3), 1.0))
+            r1 = ctracer.Ray(origin=origin, direction=direction, length=100)
+            r2 = ctracer.Ray(origin=origin, direction=direction, length=100)
+            idx = fl.intersect(r1, 100)
+            bvh_idx, set_idx = bvh.intersect(r2, 100)
+            self.assertEqual(idx, bvh_idx)
+            self.assertAlmostEqual(r1.length, r2.length)
+            if idx >= 0:
+                hits += 1
+        self.assertTrue(hits > 50)
+
+    def test_trace_unbounded(self):
+        """Rays which miss the bounded faces must still find an unbounded one"""
+        from raytrace import cfaces
+        face_sets, all_faces = make_scene()
+        oap = cfaces.OffAxisParabolicFace()
+        oap.EFL, oap.diameter = 20., 200.
+        oap.idx = len(all_faces)
+        fl = ctracer.FaceList()
+        fl.faces = [oap]
+        fl.transform = ctracer.Transform(translation=(0,0,35))
+        fl.inverse_transform = ctracer.Transform(translation=(0,0,-35))
+        face_sets.append(fl)
+        all_faces.append(oap)
+        bvh = ctracer.SceneBVH(face_sets)
+        self.assertEqual(bvh.n_unbounded, 1)
+        rays = make_random_rays(300)
+        ctracer.trace_segment(rays, face_sets, all_faces, bvh=bvh)
+        n_oap = 0
+        for i in range(rays.n_rays):
+            r = ctracer.Ray(origin=rays[i].origin, direction=rays[i].direction,
+                            length=100)
+            idx = -1
+            for fs in face_sets:
+                j = fs.intersect(r, 100)
+                if j >= 0:
+                    idx = j
+            self.assertEqual(rays[i].end_face_idx, idx if idx >= 0 else 2**32-1)
+            n_oap += (idx == oap.idx)
+        self.assertTrue(n_oap > 10)
+
+    def test_partition_ranges(self):
+        rnd = numpy.random.RandomState(3)
+        lower = rnd.uniform(-10,10,size=(100,2))
+        upper = lower + rnd.uniform(0,2,size=(100,2))
+        nodes, order = ctracer._bvh_partition(lower, upper)
+        self.assertEqual(sorted(order), list(range(100)))
+        self.assertEqual(nodes[0][4:], (0, 100))
+        for lo, hi, left, right, start, stop in nodes:
+            if left >= 0:
+                self.assertEqual(nodes[left][4], start)
+                self.assertEqual(nodes[left][5], nodes[right][4])
+                self.assertEqual(nodes[right][5], stop)
+
+    def test_trace_segment(self):
+        face_sets, all_faces = make_scene()
+        bvh = ctracer.SceneBVH(face_sets)
+        rays = make_random_rays(200)
+        out1 = ctracer.trace_segment(rays, face_sets, all_faces)
+        end1 = rays.end_face_idx.copy()
+        out2 = ctracer.trace_segment(rays, face_sets, all_faces, bvh=bvh)
+        self.assertTrue(numpy.all(end1 == rays.end_face_idx))
+        self.assertEqual(out1.n_rays, out2.n_rays)
+        self.assertTrue(numpy.allclose(out1.origin, out2.origin))
+
+
+class TestPacketTrace(unittest.TestCase):
+    def check(self, rays):
+        face_sets, all_faces = make_scene()
+        bvh = ctracer.SceneBVH(face_sets)
+        ctracer.trace_segment(rays, face_sets, all_faces, bvh=bvh)
+        for r in rays:
+            single = ctracer.Ray(origin=r.origin, direction=r.direction, length=100)
+            idx, set_idx = bvh.intersect(single, 100)
+            self.assertEqual(r.end_face_idx, idx % 2**32)
+            self.assertAlmostEqual(r.length, single.length)
+        return rays
+        
+    def test_coherent(self):
+        rays = ctracer.RayCollection(400)
+        d = ctracer.norm((0.2, 0.1, 1))
+        for x in numpy.linspace(-30, 20, 20):
+            for y in numpy.linspace(-30, 20, 20):
+                rays.add_ray(ctracer.Ray(origin=(x,y,-40), direction=d))
+        rays = self.check(rays)
+        self.assertTrue((rays.length < 100).sum() > 20)
+        
+    def test_incoherent(self):
+        rays = self.check(make_random_rays(500))
+        self.assertTrue((rays.length < 100).sum() > 10)
+        
+    def test_scene_exit(self):
+        face_sets, all_faces = make_scene()
+        for fs in face_sets:
+            fs.sync_transforms()
+        lower, upper = ctracer.SceneBVH(face_sets).bounds
+        self.assertTrue(numpy.all(numpy.less(lower, upper)))
+        rays = make_random_rays(500)
+        #send every other ray away from the scene
+        out = ctracer.RayCollection(500)
+        for i, r in enumerate(rays):
+            if i%2:
+                r.origin = numpy.array(upper) + 1
+                r.direction = ctracer.norm(numpy.abs(r.direction) + 0.01)
+            out.add_ray(r)
+        out = self.check(out)
+        self.assertTrue((out.end_face_idx[1::2] == 2**32-1).all())
+        self.assertTrue((out.length[::2] < 100).sum() > 5)
+
+
+class TestRayCollectionSoA(unittest.TestCase):
+    def test_round_trip(self):
+        rays = make_random_rays(20)
+        soa = ctracer.RayCollectionSoA.from_collection(rays)
+        self.assertEqual(soa.origin.shape, (3,20))
+        self.assertTrue(numpy.array_equal(soa.origin.T, rays.origin))
+        self.assertTrue(numpy.array_equal(soa.direction.T, rays.direction))
+        soa.length[:] = 3.0
+        out = soa.to_collection()
+        self.assertTrue(numpy.array_equal(out.direction, rays.direction))
+        self.assertTrue((out.length==3.0).all())
+        soa.to_collection(rays)
+        self.assertTrue((rays.length==3.0).all())
+        
+    def test_face_list_batch(self):
+        face_sets, all_faces = make_scene()
+        arr = make_random_rays(500).copy_as_array()
+        arr['length'] = 100
+        rays = ctracer.RayCollection.from_array(arr)
+        soa = ctracer.RayCollectionSoA.from_collection(rays)
+        for fl in face_sets:
+            fl.intersect_batch(soa)
+        for i, r in enumerate(rays):
+            for fl in face_sets:
+                fl.intersect(r, 100)
+            self.assertEqual(r.end_face_idx, soa.end_face_idx[i])
+            self.assertAlmostEqual(r.length, soa.length[i])
+        self.assertTrue((soa.length < 100).sum() > 10)
+        
+        
+class TestOriginFaceExclusion(unittest.TestCase):
+    def make_plane(self):
+        from raytrace import cfaces
+        f = cfaces.RectangularFace(owner=AnOwner(length=10., width=10., offset=0.))
+        f.update()
+        f.tolerance = 0.0
+        fl = ctracer.FaceList()
+        fl.faces = [f]
+        return f, fl
+    
+    def test_intersect(self):
+        f, fl = self.make_plane()
+        self.assertTrue(f.planar)
+        bvh = ctracer.SceneBVH([fl])
+        r = ctracer.Ray(origin=(0,0,-1e-9), direction=(0,0,1), length=10)
+        self.assertEqual(bvh.intersect(r, 10), (0, 0))
+        r = ctracer.Ray(origin=(0,0,-1e-9), direction=(0,0,1), length=10)
+        self.assertEqual(bvh.intersect(r, 10, 0), (-1, -1))
+        
+    def test_trace(self):
+        f, fl = self.make_plane()
+        rays = ctracer.RayCollection(1)
+        rays.add_ray(ctracer.Ray(origin=(0.1,0.2,-1), direction=ctracer.norm((0.3,0.2,1)),
+                                 E_vector=(1,0,0), E1_amp=1.0))
+        traced = ctracer.trace_rays(rays, [fl], [f], recursion_limit=3)
+        self.assertEqual(len(traced), 2)
+        self.assertEqual(traced[0][0].end_face_idx, 0)
+        self.assertEqual(traced[1][0].end_face_idx, 2**32-1)
+        self.assertTrue(traced[1].parent is traced[0])
+        
+    def test_children_unterminated(self):
+        f, fl = self.make_plane()
+        rays = ctracer.RayCollection(1)
+        rays.add_ray(ctracer.Ray(origin=(0.1,0.2,-1), direction=(0,0,1),
+                                 E_vector=(1,0,0), E1_amp=1.0))
+        children = ctracer.trace_segment(rays, [fl], [f])
+        self.assertEqual(rays[0].end_face_idx, 0)
+        self.assertEqual(children[0].end_face_idx, 2**32-1)
+        self.assertTrue(children.parent is rays)
+        
+        
+class TestParallelTrace(unittest.TestCase):
+    def trace(self, num_threads):
+        m = cmaterials.FullDielectricMaterial(n_inside=1.5, n_outside=1.0,
+                                              reflection_threshold=0.0,
+                                              transmission_threshold=0.0)
+        face_sets, all_faces = make_scene(material=m)
+        rays = make_random_rays(3000)
+        out = ctracer.trace_segment(rays, face_sets, all_faces,
+                                    num_threads=num_threads)
+        return rays, out, [f.count for f in all_faces]
+
+    def test_deterministic(self):
+        rays1, out1, count1 = self.trace(1)
+        rays4, out4, count4 = self.trace(4)
+        self.assertTrue(out1.n_rays > 100)
+        self.assertEqual(count1, count4)
+        a1 = out1.copy_as_array()
+        a4 = out4.copy_as_array()
+        self.assertTrue((a1 == a4).all())
+        #children appear in the order of their parents
+        self.assertTrue(numpy.all(numpy.diff(a1['parent_idx'].astype(int)) >= 0))
+
+
+class TestTraceRays(unittest.TestCase):
+    def test_trace_rays(self):
+        face_sets, all_faces = make_scene()
+        bvh = ctracer.SceneBVH(face_sets)
+        rays = make_random_rays(500)
+        traced = ctracer.trace_rays(rays, face_sets, all_faces, bvh=bvh)
+        self.assertTrue(traced[0] is rays)
+        self.assertTrue(len(traced) > 2)
+        
+        rays = make_random_rays(500)
+        expected = []
+        while rays.n_rays > 0:
+            expected.append(rays)
+            rays = ctracer.trace_segment(rays, face_sets, all_faces, bvh=bvh)
+        self.assertEqual(len(traced), len(expected))
+        for a, b in zip(traced, expected):
+            self.assertTrue((a.copy_as_array() == b.copy_as_array()).all())
+        for parent, child in zip(traced[:-1], traced[1:]):
+            self.assertTrue(child.parent is parent)
+
+    def test_recursion_limit(self):
+        face_sets, all_faces = make_scene()
+        traced = ctracer.trace_rays(make_random_rays(500), face_sets, all_faces,
+                                    recursion_limit=2)
+        self.assertEqual(len(traced), 2)
+
+    def test_power_cutoff(self):
+        face_sets, all_faces = make_scene()
+        rays = make_random_rays(500)
+        traced = ctracer.trace_rays(rays, face_sets, all_faces, power_cutoff=2.0)
+        self.assertEqual(len(traced), 1)
+        traced = ctracer.trace_rays(rays, face_sets, all_faces, 
+                                    relative_power_cutoff=0.5)
+        self.assertTrue(len(traced) > 2)
+        
+    def test_russian_roulette(self):
+        face_sets, all_faces = make_scene()
+        full = ctracer.trace_rays(make_random_rays(2000), face_sets, all_faces,
+                                  recursion_limit=2)
+        traced = ctracer.trace_rays(make_random_rays(2000), face_sets, all_faces,
+                                    recursion_limit=2, power_cutoff=2.5,
+                                    russian_roulette=True)
+        n_full, n = full[1].n_rays, traced[1].n_rays
+        self.assertTrue(0.3*n_full < n < 0.7*n_full)
+        P = (abs(traced[1].E1_amp)**2 + abs(traced[1].E2_amp)**2)*traced[1].refractive_index.real
+        self.assertTrue(numpy.allclose(P, 2.5))
+        again = ctracer.trace_rays(make_random_rays(2000), face_sets, all_faces,
+                                   recursion_limit=2, power_cutoff=2.5,
+                                   russian_roulette=True, num_threads=3)
+        self.assertTrue((again[1].copy_as_array() == traced[1].copy_as_array()).all())
+        
+    def test_hint(self):
+        face_sets, all_faces = make_scene()
+        full = ctracer.trace_rays(make_random_rays(2000), face_sets, all_faces,
+                                  recursion_limit=3)
+        rays = make_random_rays(2000)
+        first = ctracer.trace_rays(rays, face_sets, all_faces, recursion_limit=3,
+                                   sink=ctracer.HitCacheSink())
+        self.assertEqual(first.n_generations, len(full))
+        other = ctracer.trace_rays(make_random_rays(500, seed=3), face_sets, 
+                                   all_faces, recursion_limit=3, 
+                                   sink=ctracer.HitCacheSink())
+        for hint in (first, ctracer.HitCacheSink().replay(full[:1]), other):
+            rays.reset_length()
+            traced = ctracer.trace_rays(rays, face_sets, all_faces, 
+                                        recursion_limit=3, hint=hint)
+            self.assertEqual(len(traced), len(full))
+            for a, b in zip(traced, full):
+                self.assertTrue((a.copy_as_array() == b.copy_as_array()).all())
+                
+    def test_hint_match(self):
+        """Counterparts are found by ancestry, not by position"""
+        face_sets, all_faces = make_scene()
+        full = ctracer.trace_rays(make_random_rays(2000), face_sets, all_faces,
+                                  recursion_limit=3)
+        cache = ctracer.HitCacheSink().replay(full)
+        faces, match = cache.match(0, full[0])
+        self.assertTrue((faces == full[0].end_face_idx.astype(numpy.intc)).all())
+        faces, match = cache.match(1, full[1], match)
+        self.assertTrue((match == numpy.arange(full[1].n_rays)).all())
+        #reverse the parents, and their children along with them
+        n = full[0].n_rays
+        parents = full[0].copy_as_array()[::-1].copy()
+        children = full[1].copy_as_array()[::-1].copy()
+        children['parent_idx'] = n - 1 - children['parent_idx']
+        parents = ctracer.RayCollection.from_array(parents)
+        children = ctracer.RayCollection.from_array(children)
+        faces, match = cache.match(0, parents)
+        self.assertTrue((match == numpy.arange(n)).all())
+        faces, match = cache.match(1, children, numpy.arange(n)[::-1])
+        self.assertTrue((match == numpy.arange(full[1].n_rays)[::-1]).all())
+        self.assertTrue((faces == children.end_face_idx.astype(numpy.intc)).all())
+
+
+class TestRaySinks(unittest.TestCase):
+    def trace(self, sink=None, recursion_limit=4):
+        face_sets, all_faces = make_scene()
+        return ctracer.trace_rays(make_random_rays(1000), face_sets, all_faces,
+                                  recursion_limit=recursion_limit, sink=sink)
+    
+    def test_keep_all(self):
+        full = self.trace()
+        kept = self.trace(ctracer.KeepAllSink())
+        self.assertEqual(len(kept), len(full))
+        for a, b in zip(kept, full):
+            self.assertTrue((a.copy_as_array() == b.copy_as_array()).all())
+        for a, b in zip(kept[1:], kept):
+            self.assertTrue(a.parent is b)
+            
+    def test_terminal(self):
+        #the children of the last generation are untraced, but not terminal
+        full = self.trace(recursion_limit=5)
+        self.assertEqual(len(full), 5)
+        terminal = self.trace(ctracer.TerminalRaySink())
+        expected = []
+        for rays, children in zip(full[:-1], full[1:]):
+            arr = rays.copy_as_array()
+            if children is not None:
+                arr = arr[~numpy.in1d(numpy.arange(len(arr)), children.parent_idx)]
+            expected.append(arr)
+        expected = numpy.concatenate(expected)
+        self.assertEqual(terminal.n_rays, len(expected))
+        self.assertTrue((terminal.copy_as_array() == expected).all())
+        
+    def test_file(self):
+        d = tempfile.mkdtemp()
+        try:
+            sink = ctracer.GenerationFileSink(d)
+            names = self.trace(sink)
+            full = self.trace()
+            self.assertEqual(len(names), len(full))
+            for i, rays in enumerate(full):
+                self.assertTrue((sink.load(i) == rays.copy_as_array()).all())
+        finally:
+            shutil.rmtree(d)
+            
+    def test_last_generation(self):
+        full = self.trace()
+        sink = ctracer.LastGenerationSink()
+        last = self.trace(sink)
+        self.assertTrue((last.copy_as_array() == full[-1].copy_as_array()).all())
+        #the copy made at the end of the trace is kept
+        self.assertTrue((sink.finish().copy_as_array() == sink.last).all())
+        self.assertEqual(ctracer.LastGenerationSink().finish(), None)
+            
+    def test_root_and_optical_path(self):
+        full = self.trace()
+        self.assertTrue((full[0].root_idx == numpy.arange(full[0].n_rays)).all())
+        self.assertTrue((full[0].optical_path == 0).all())
+        for rays, parent in zip(full[1:], full):
+            pidx = rays.parent_idx
+            self.assertTrue((rays.root_idx == parent.root_idx[pidx]).all())
+            self.assertTrue(numpy.allclose(rays.optical_path, 
+                                           parent.total_optical_path[pidx]))
+        #check against walking back through the generations
+        last = full[-1]
+        total = last.length*last.refractive_index.real
+        idx = last.parent_idx
+        for rays in reversed(full[:-1]):
+            total += rays.length[idx]*rays.refractive_index.real[idx]
+            root = idx
+            idx = rays.parent_idx[idx]
+        self.assertTrue(numpy.allclose(total, last.total_optical_path))
+        self.assertTrue((root == last.root_idx).all())
+        
+    def test_compact(self):
+        full = self.trace()
+        for profile in ('geometry', 'power'):
+            compact = self.trace(ctracer.CompactRaySink(profile))
+            self.assertEqual(len(compact), len(full))
+            for c, rays in zip(compact, full):
+                self.assertTrue(c.dtype.itemsize*4 < ctracer.get_ray_size())
+                self.assertTrue(numpy.allclose(c['origin'], rays.origin))
+                self.assertTrue(numpy.allclose(c['termination'], rays.termination))
+                self.assertTrue((c['parent_idx'] == rays.parent_idx).all())
+                self.assertTrue((c['end_face_idx'] == rays.end_face_idx).all())
+                if profile == 'power':
+                    self.assertTrue(numpy.allclose(c['power'], ctracer.ray_power(rays)))
+        self.assertRaises(ValueError, ctracer.CompactRaySink, 'bogus')
+        
+    def test_face_tally(self):
+        full = self.trace()
+        tally = ctracer.FaceTally()
+        kept = self.trace(ctracer.SinkGroup([ctracer.KeepAllSink(), tally]))
+        self.assertEqual(len(kept), len(full))
+        idx = numpy.concatenate([r.end_face_idx for r in full])
+        P = numpy.concatenate([ctracer.ray_power(r) for r in full])
+        for i in set(idx[idx < 2**32-1]):
+            self.assertEqual(tally.face_count(i), (idx==i).sum())
+            self.assertAlmostEqual(tally.face_power(i), P[idx==i].sum())
+        self.assertAlmostEqual(tally.input_power, ctracer.ray_power(full[0]).sum())
+        again = ctracer.FaceTally().replay(full)
+        self.assertTrue((again.counts == tally.counts).all())
+        
+        
+class TestTraceSequence(unittest.TestCase):
+    def test_sequence(self):
+        face_sets, all_faces = make_scene()
+        rays = make_random_rays(2000)
+        traced = ctracer.trace_rays(rays, face_sets, all_faces, recursion_limit=3)
+        first = traced[0].end_face_idx
+        hit = sorted(set(first[first < len(all_faces)]), 
+                     key=lambda i: -(first==i).sum())
+        group = [all_faces[i] for i in hit[:3]]
+        
+        rays = make_random_rays(2000)
+        seq = ctracer.trace_sequence(rays, [group, all_faces], face_sets, all_faces)
+        self.assertEqual(len(seq), 2)
+        idx = seq[0].end_face_idx
+        mask = numpy.in1d(first, hit[:3])
+        #rays hitting a face of the group end on the same face as before
+        self.assertTrue((idx[mask] == first[mask]).all())
+        self.assertTrue(numpy.in1d(idx[idx < len(all_faces)], hit[:3]).all())
+        self.assertEqual(seq[1].n_rays, (idx < len(all_faces)).sum())
+        #the second step tests every face, so matches the full trace
+        parents = numpy.nonzero(mask)[0]
+        children = traced[1].copy_as_array()
+        children = children[numpy.in1d(children['parent_idx'], parents)]
+        seq_children = seq[1].copy_as_array()
+        seq_children = seq_children[numpy.in1d(seq_children['parent_idx'], parents)]
+        self.assertTrue(len(children) > 0)
+        self.assertTrue((seq_children['end_face_idx'] == children['end_face_idx']).all())
+        
+    def test_matches_trace_rays(self):
+        #with every face at each step, the output is that of trace_rays
+        face_sets, all_faces = make_scene()
+        traced = ctracer.trace_rays(make_random_rays(500), face_sets, all_faces,
+                                    recursion_limit=3)
+        seq = ctracer.trace_sequence(make_random_rays(500), [all_faces]*3,
+                                     face_sets, all_faces)
+        self.assertEqual(len(seq), len(traced))
+        for a, b in zip(seq, traced):
+            self.assertTrue((a.copy_as_array() == b.copy_as_array()).all())
+        
+    def test_single_face(self):
+        face_sets, all_faces = make_scene()
+        seq = ctracer.trace_sequence(make_random_rays(500), [all_faces[0]],
+                                     face_sets, all_faces)
+        idx = seq[0].end_face_idx
+        self.assertTrue(set(idx) <= set([0, 2**32-1]))
+        
+    def test_power_cutoff(self):
+        face_sets, all_faces = make_scene()
+        seq = ctracer.trace_sequence(make_random_rays(500), [all_faces]*3,
+                                     face_sets, all_faces)
+        self.assertTrue(len(seq) > 1)
+        #every child has less power than the strongest input ray
+        seq = ctracer.trace_sequence(make_random_rays(500), [all_faces]*3,
+                                     face_sets, all_faces,
+                                     relative_power_cutoff=1.01)
+        self.assertEqual(len(seq), 1)
+        
+    def test_missing_wavelengths(self):
+        m = cmaterials.SingleLayerCoatedMaterial()
+        face_sets, all_faces = make_scene(material=m)
+        rays = make_random_rays(50)
+        self.assertRaises(ValueError, ctracer.trace_sequence, rays, 
+                          [all_faces], face_sets, all_faces)
+        m.wavelengths = numpy.array([0.8])
+        seq = ctracer.trace_sequence(rays, [all_faces]*2, face_sets, all_faces)
+        self.assertTrue(len(seq) > 1)
+        
+        
+class TestRayArena(unittest.TestCase):
+    def test_allocate(self):
+        arena = ctracer.RayArena(8)
+        rc = arena.allocate(4)
+        self.assertEqual(rc.max_size, 4)
+        self.assertTrue(rc.block is arena.blocks[0])
+        rays = make_random_rays(5)
+        for r in list(rays)[:4]:
+            rc.add_ray(r)
+        self.assertTrue(rc.block is not None)
+        rc.add_ray(rays[4])
+        self.assertTrue(rc.block is None)
+        self.assertEqual(arena.blocks[0].n_users, 0)
+        self.assertTrue((rc.copy_as_array() == rays.copy_as_array()).all())
+        
+    def test_reuse(self):
+        face_sets, all_faces = make_scene(material=cmaterials.LinearPolarisingMaterial())
+        arena = ctracer.RayArena()
+        traced = ctracer.trace_rays(make_random_rays(500), face_sets, all_faces,
+                                    recursion_limit=5, arena=arena)
+        expected = ctracer.trace_rays(make_random_rays(500), face_sets, all_faces,
+                                      recursion_limit=5)
+        self.assertTrue(len(traced) > 2)
+        for a, b in zip(traced, expected):
+            self.assertTrue((a.copy_as_array() == b.copy_as_array()).all())
+        capacity = arena.capacity
+        del traced
+        traced = ctracer.trace_rays(make_random_rays(500), face_sets, all_faces,
+                                    recursion_limit=5, arena=arena)
+        self.assertEqual(arena.capacity, capacity)
+        
+        
 class TestInterfaceMaterial(unittest.TestCase):
     def test_wavelengths(self):
         m = ctracer.InterfaceMaterial()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+
+from raytrace import ctracer, cfaces
+from raytrace.sources import ParallelRaySource
+from raytrace.results import MeanOpticalPathLength, \
+            get_total_intersections, get_total_power
+
+
+class TestExtrusionTarget(unittest.TestCase):
+    """Results targeting the sides of an extrusion, which are one face 
+    with an idx for each edge
+    """
+    def setUp(self):
+        square = [[-1,-1], [1,-1], [1,1], [-1,1]]
+        self.f = cfaces.ExtrudedPolygonFace(xy_points=square, z1=-1, z2=1)
+        self.f.idx = 2
+        fl = ctracer.FaceList()
+        fl.faces = [self.f]
+        all_faces = [cfaces.CircularFace()]*2 + [self.f]*self.f.n_idx
+        rays = ctracer.RayCollection(4)
+        for d in [(1,0,0), (0,1,0), (-1,0,0), (0,-1,0)]:
+            rays.add_ray(ctracer.Ray(origin=(0,0,0), direction=d,
+                                     E_vector=(0,0,1), E1_amp=1.0,
+                                     refractive_index=1.0))
+        ctracer.trace_segment(rays, [fl], all_faces)
+        self.rays = rays
+        self.source = ParallelRaySource()
+        self.source.TracedRays = [rays]
+        
+    def test_every_edge(self):
+        self.assertEqual(sorted(self.rays.end_face_idx), [2, 3, 4, 5])
+        self.assertEqual(get_total_intersections([self.rays], self.f), 4)
+        self.assertAlmostEqual(get_total_power([self.rays], self.f), 
+                               sum(ray.power for ray in self.rays))
+        
+    def test_mean_optical_path(self):
+        r = MeanOpticalPathLength(source=self.source, target=self.f)
+        self.assertAlmostEqual(r.result, 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()